@@ -6,27 +6,33 @@ import os
 import glob
 import pickle
 from collections import OrderedDict
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from sys import platform as sys_pf
 import matplotlib
 if sys_pf == 'darwin':
     matplotlib.use("TkAgg") # This fixes crashes on mac
 import matplotlib.pyplot as plt
-from imageio import imread
-from scipy import ndimage
-from scipy.signal import argrelextrema
-from scipy.optimize import curve_fit
+# Heavy packages are imported on first use, so the window shows up quickly
+from lazy_imports import LazyImport, preload
+pd = LazyImport('pandas')
+imread = LazyImport('imageio','imread')
+imwrite = LazyImport('imageio','imwrite')
+ndimage = LazyImport('scipy.ndimage')
+# Memory maps uncompressed tiffs for tiled processing (optional)
+tifffile = LazyImport('tifffile')
 # sci-kit image
-from skimage import exposure
-from skimage.color import rgb2gray
-from skimage.filters.rank import median
-from skimage.morphology import disk
-from skimage.measure import profile_line
+exposure = LazyImport('skimage.exposure')
+median = LazyImport('skimage.filters.rank','median')
+disk = LazyImport('skimage.morphology','disk')
+profile_line = LazyImport('skimage.measure','profile_line')
 # GUI imports
 import os
 import csv
 import time
+import atexit
+import shutil
+import tempfile
 import datetime
 import tkinter as tk
 from tkinter import LEFT, RIGHT, W, E, N, S, INSERT, END, BOTH
@@ -39,18 +45,27 @@ import tkinter.ttk as ttk
 from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg,
                                          NavigationToolbar2Tk)
 from matplotlib.figure import Figure
-# Scalebar
-from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
-import matplotlib.font_manager as fm
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 # Misc.
-from matplotlib.colors import LinearSegmentedColormap
 from matplotlib.widgets import SpanSelector
 from matplotlib.ticker import AutoMinorLocator, MaxNLocator
 from matplotlib.patches import Rectangle
 # Colors
-from palettable.tableau import Tableau_10, Tableau_20
-from palettable.colorbrewer.qualitative import Set1_9
+Tableau_10 = LazyImport('palettable.tableau','Tableau_10')
+# Growth rate fitting
+from streaming_fit import StreamingLinearFit
+# Hot path timing and run metrics
+from stage_timer import StageTimer
+from run_log import write_run_log, settings_hash, peak_rss_mb, hit_rate
+# Memory accounting of image buffers
+from frame_store import FrameStore, MemoryBudget
+# Thresholding, despeckle and mask sampling, compiled when numba is installed
+import fast_kernels
+# Archives of the distances, fits and masks of each saved run
+from session_archive import write_session_archive, archive_extension
 matplotlib.rc("savefig",dpi=100)
+# Stage times of the image processing, turned on with "Time Stages" in the GUI
+stage_timer = StageTimer()
 ################################################################################
 
 def setNiceTicks(ax,Nx=4,Ny=4,yminor=2,xminor=2,
@@ -97,73 +112,504 @@ def threshold_crop_denoise(img_file,x1,x2,y1,y2,threshold_lower,threshold_upper,
     '''
     # Read image in gray scale (format='tiff-pil',pilmode='L'), unless a pre-loaded image is passed
     if img is None:
-        img=imread(img_file,format='tiff-pil',pilmode='L')
-    if rescale:
-        img = exposure.rescale_intensity(img,in_range=rescale)
-    if equalize_hist:
-        img = exposure.equalize_adapthist(img,clip_limit=clip_limit)
-        img = 255 * img
+        with stage_timer.stage('decode'):
+            img=imread(img_file,format='tiff-pil',pilmode='L')
+    with stage_timer.stage('contrast'):
+        img = enhance_contrast(img,rescale=rescale,equalize_hist=equalize_hist,clip_limit=clip_limit)
     # Crop
     cropped = img[y1:y2,x1:x2]
+    denoised,thresholded = threshold_and_despeckle(cropped,threshold_lower,threshold_upper,d,
+                                                   threshold_out=threshold_out,
+                                                   multiple_ranges=multiple_ranges)
+    return denoised,thresholded,cropped
+
+def threshold_and_despeckle(cropped,threshold_lower,threshold_upper,d,
+                            threshold_out=False,multiple_ranges=False):
+    '''
+    Thresholds a cropped (contrast enhanced) image and despeckles it with a disk
+    of size d. See threshold_crop_denoise for the arguments.
+    Returns the despeckled and the thresholded masks
+    '''
+    if fast_kernels.jit_enabled:
+        # Threshold and despeckle in one compiled pass (numba, see fast_kernels.py)
+        if not multiple_ranges:
+            threshold_lower = [threshold_lower]
+            threshold_upper = [threshold_upper]
+        with stage_timer.stage('threshold + despeckle'):
+            return fast_kernels.threshold_despeckle(
+                cropped,threshold_lower,threshold_upper,d,threshold_out=threshold_out)
     # Threshold above or below given pixel intensity
     # This converts image to black and white
-    if not multiple_ranges:
-        if not threshold_out:
-            thresholded = np.logical_and(cropped>threshold_lower,cropped<threshold_upper)
-        else:
-            thresholded = np.logical_or(cropped<threshold_lower,cropped>threshold_upper)
-    else:
-        if not threshold_out:
-            thresholded = np.logical_and(cropped>threshold_lower[0],cropped<threshold_upper[0])
-            for r_idx in range(1,len(threshold_lower)):
-                temp = np.logical_and(cropped>threshold_lower[r_idx],cropped<threshold_upper[r_idx])
-                thresholded = np.logical_or(thresholded,temp)
-        else:
-            thresholded = np.logical_or(cropped<threshold_lower[0],cropped>threshold_upper[0])
-            for r_idx in range(1,len(threshold_lower)):
-                temp = np.logical_or(cropped<threshold_lower[r_idx],cropped>threshold_upper[r_idx])
-                thresholded = np.logical_and(thresholded,temp)
+    with stage_timer.stage('threshold'):
+        thresholded = apply_threshold(cropped,threshold_lower,threshold_upper,
+                                      threshold_out=threshold_out,multiple_ranges=multiple_ranges)
+    # Despeckle with disk size d
+    with stage_timer.stage('median despeckle'):
+        denoised = fast_kernels.despeckle(thresholded,d)
+    return denoised,thresholded
+
+def open_frame(img_file):
+    '''
+    Opens a frame without reading it into memory where possible: .npy files and
+    uncompressed tiffs (with tifffile) are memory mapped, so tiles can be read
+    from frames larger than RAM. Other files are decoded as usual.
+    '''
+    extension = os.path.splitext(img_file)[1].lower()
+    if extension=='.npy':
+        return np.load(img_file,mmap_mode='r')
+    if extension in ('.tif','.tiff'):
+        try:
+            return tifffile.memmap(img_file,mode='r')
+        except Exception as e:
+            # Compressed or tiled tiffs, or tifffile isn't installed
+            print('Could not memory map ' + os.path.basename(img_file) + ' (' + str(e)
+                  + '), reading the whole frame')
+    with stage_timer.stage('decode'):
+        return imread(img_file,format='tiff-pil',pilmode='L')
+
+def to_gray(img):
+    # Color tiles are converted like pilmode='L' (ITU-R 601-2 luma)
+    if img.ndim==3:
+        img = img[...,0]*(299/1000) + img[...,1]*(587/1000) + img[...,2]*(114/1000)
+    return img
+
+def display_copy(img,max_size=2048):
+    '''
+    Gray scale copy of a frame for display, keeping every n-th row and column so
+    that neither side is longer than max_size. Only those pixels are read from
+    memory mapped frames. Returns the copy and n.
+    '''
+    step = max(1,int(np.ceil(max(img.shape[:2])/max_size)))
+    return to_gray(np.asarray(img[::step,::step])),step
 
+def tile_windows(shape,tile_size,halo):
+    '''
+    Splits an image of the given shape into tiles of up to tile_size x tile_size pixels
+    Yields the (row slice,col slice) of each tile, and of the tile grown by halo
+    pixels on each side (clipped to the image)
+    '''
+    for r0 in range(0,shape[0],tile_size):
+        for c0 in range(0,shape[1],tile_size):
+            r1 = min(r0+tile_size,shape[0])
+            c1 = min(c0+tile_size,shape[1])
+            yield ((slice(r0,r1),slice(c0,c1)),
+                   (slice(max(r0-halo,0),min(r1+halo,shape[0])),
+                    slice(max(c0-halo,0),min(c1+halo,shape[1]))))
+
+def threshold_crop_denoise_tiled(img,x1,x2,y1,y2,threshold_lower,threshold_upper,d,
+                                 out_path,tile_size=1024,rescale=None,equalize_hist=False,
+                                 threshold_out=False,multiple_ranges=False,clip_limit=0.05,
+                                 clahe_kernel_size=None):
+    ''' threshold_crop_denoise_tiled
+    threshold_crop_denoise for frames too large for memory. img is any array-like
+    that can be sliced without loading it all (e.g. from open_frame). The crop is
+    processed in tiles, each read with a halo so the despeckle disk sees the same
+    pixels as for the whole crop, and written into a .npy file at out_path, which
+    is returned memory mapped.
+    Without equalize_hist the mask is identical to threshold_crop_denoise.
+    CLAHE can only be approximated per tile: each tile is equalized with a halo of
+    one CLAHE kernel (clahe_kernel_size, default 1/8 of the frame as for the whole
+    frame), and the intensity stretch is per tile.
+    '''
+    crop_shape = (y2-y1,x2-x1)
+    out = np.lib.format.open_memmap(out_path,mode='w+',dtype=np.uint8,shape=crop_shape)
+    contrast_halo = 0
+    if equalize_hist:
+        if clahe_kernel_size is None:
+            clahe_kernel_size = (img.shape[0]//8,img.shape[1]//8)
+        contrast_halo = max(clahe_kernel_size)
+    for core,padded in tile_windows(crop_shape,tile_size,d):
+        # Despeckle window in image coordinates, and the larger window read for contrast
+        ry0,ry1 = padded[0].start+y1,padded[0].stop+y1
+        rx0,rx1 = padded[1].start+x1,padded[1].stop+x1
+        cy0,cy1 = max(ry0-contrast_halo,0),min(ry1+contrast_halo,img.shape[0])
+        cx0,cx1 = max(rx0-contrast_halo,0),min(rx1+contrast_halo,img.shape[1])
+        with stage_timer.stage('decode'):
+            window = to_gray(np.asarray(img[cy0:cy1,cx0:cx1]))
+        with stage_timer.stage('contrast'):
+            window = enhance_contrast(window,rescale=rescale,equalize_hist=equalize_hist,
+                                      clip_limit=clip_limit,kernel_size=clahe_kernel_size)
+        cropped = window[ry0-cy0:ry1-cy0,rx0-cx0:rx1-cx0]
+        denoised = threshold_and_despeckle(cropped,threshold_lower,threshold_upper,d,
+                                           threshold_out=threshold_out,
+                                           multiple_ranges=multiple_ranges)[0]
+        out[core] = denoised[core[0].start-padded[0].start:core[0].stop-padded[0].start,
+                             core[1].start-padded[1].start:core[1].stop-padded[1].start]
+    out.flush()
+    return out
+
+def enhance_contrast(img,rescale=None,equalize_hist=False,clip_limit=0.05,kernel_size=None):
+    '''
+    Contrast enhancement applied before thresholding
+    rescale stretches the intensity range, equalize_hist applies adaptive
+    histogram equalization (CLAHE) and returns values from 0 to 255
+    kernel_size is the CLAHE kernel (default 1/8 of the image)
+    '''
+    if rescale:
+        img = exposure.rescale_intensity(img,in_range=rescale)
+    if equalize_hist:
+        # float32 is plenty for 0-255 values and halves the size of the equalized image
+        img = exposure.equalize_adapthist(img,kernel_size=kernel_size,
+                                          clip_limit=clip_limit).astype(np.float32)
+        img *= 255
+    return img
 
-    # Despeckle with disk size d
-    denoised = median(thresholded, disk(d))
-    return denoised,thresholded,cropped
+def bin_image(img,factor):
+    '''
+    Downsamples an image by averaging factor x factor blocks
+    Rows and columns that don't fill a whole block are dropped
+    '''
+    if factor==1:
+        return img
+    h = img.shape[0]//factor*factor
+    w = img.shape[1]//factor*factor
+    return img[:h,:w].reshape(h//factor,factor,w//factor,factor).mean(axis=(1,3))
+
+def apply_threshold(cropped,threshold_lower,threshold_upper,
+                    threshold_out=False,multiple_ranges=False):
+    '''
+    Returns a boolean mask of the pixels inside (or outside, with threshold_out)
+    the threshold range(s). See threshold_crop_denoise for the arguments.
+    '''
+    if not multiple_ranges:
+        threshold_lower = [threshold_lower]
+        threshold_upper = [threshold_upper]
+    return fast_kernels.threshold_ranges(cropped,threshold_lower,threshold_upper,
+                                         threshold_out=threshold_out)
 
 def subtract_and_denoise(img_file1,img_file2,x1,x2,y1,y2,d,threshold=None,
-                         rescale=None,img1=None,img2=None,equalize_hist=False,clip_limit=0.05):
+                         rescale=None,img1=None,img2=None,equalize_hist=False,clip_limit=0.05,
+                         crop2=None):
+    # crop2 = (x1,x2,y1,y2) of the second image, if it differs (e.g. stage drift)
     # Read image in gray scale (format='tiff-pil',pilmode='L'), unless a pre-loaded image is passed
-    if img1 is None:
-        img1=imread(img_file1,format='tiff-pil',pilmode='L')
-    if img2 is None:
-        img2=imread(img_file2,format='tiff-pil',pilmode='L')
-    if rescale:
-        img1 = exposure.rescale_intensity(img1,in_range=rescale)
-        img2 = exposure.rescale_intensity(img2,in_range=rescale)
-    if equalize_hist:
-        img1 = exposure.equalize_adapthist(img1,clip_limit=clip_limit)
-        img1 = 255 * img1
-        img2 = exposure.equalize_adapthist(img2,clip_limit=clip_limit)
-        img2 = 255 * img2
+    with stage_timer.stage('decode'):
+        if img1 is None:
+            img1=imread(img_file1,format='tiff-pil',pilmode='L')
+        if img2 is None:
+            img2=imread(img_file2,format='tiff-pil',pilmode='L')
+    with stage_timer.stage('contrast'):
+        if rescale:
+            img1 = exposure.rescale_intensity(img1,in_range=rescale)
+            img2 = exposure.rescale_intensity(img2,in_range=rescale)
+        if equalize_hist:
+            img1 = exposure.equalize_adapthist(img1,clip_limit=clip_limit)
+            img1 = 255 * img1
+            img2 = exposure.equalize_adapthist(img2,clip_limit=clip_limit)
+            img2 = 255 * img2
     cropped1 = img1[y1:y2,x1:x2]
+    if crop2 is not None:
+        x1,x2,y1,y2 = crop2
     cropped2 = img2[y1:y2,x1:x2]
-    # Subtract and take absolute value. Convert to float so that negative values are possible
-    subtract=np.abs(cropped2.astype(np.float32)-cropped1.astype(np.float32))
-    # Normalize from 0 to 1
-    subtract_norm = (subtract-subtract.min())/(subtract.max()-subtract.min())
-    # Threshold, if lower threshold is given:
-    if threshold is None:
-        thresholded = subtract_norm
-    else:
-        thresholded = subtract_norm > threshold
-    denoised = median(thresholded, disk(d))
+    with stage_timer.stage('subtraction'):
+        # Subtract and take absolute value. Convert to float so that negative values are possible
+        subtract=np.abs(cropped2.astype(np.float32)-cropped1.astype(np.float32))
+        # Normalize from 0 to 1
+        subtract_norm = (subtract-subtract.min())/(subtract.max()-subtract.min())
+        # Threshold, if lower threshold is given:
+        if threshold is None:
+            thresholded = subtract_norm
+        else:
+            thresholded = subtract_norm > threshold
+    with stage_timer.stage('median despeckle'):
+        denoised = fast_kernels.despeckle(thresholded,d)
     return denoised,thresholded,subtract_norm,cropped2
 
-def set_new_im_data(ax,im_data,new_img):
-    # Change data extent to match new image
-    im_data.set_extent((0, new_img.shape[1], new_img.shape[0], 0))
+def crop_histogram(img,x1,x2,y1,y2,rescale=None,equalize_hist=False,clip_limit=0.05):
+    '''
+    Histogram of the cropped region after the same contrast enhancement used by
+    threshold_crop_denoise. Returns counts and bin edges for 256 bins over 0-256
+    '''
+    if rescale:
+        img = exposure.rescale_intensity(img,in_range=rescale)
+    if equalize_hist:
+        img = exposure.equalize_adapthist(img,clip_limit=clip_limit)
+        img = 255 * img
+    return np.histogram(img[y1:y2,x1:x2],bins=256,range=(0,256))
+
+def otsu_levels(hist,classes=2):
+    '''
+    Otsu (classes=2) or multi-Otsu threshold levels computed from a histogram
+    Returns classes-1 bin indices, where class k spans bins [level[k-1],level[k])
+    Levels maximize the between-class variance, found by dynamic programming over
+    the cumulative sums so the cost does not depend on the number of pixels
+    '''
+    hist = np.asarray(hist,dtype=float)
+    n_bins = hist.shape[0]
+    if classes < 2 or classes > n_bins:
+        raise ValueError('classes must be between 2 and the number of bins')
+    p = hist/hist.sum()
+    # Cumulative probability and first moment, P[j] = sum of p[:j]
+    P = np.concatenate(([0],np.cumsum(p)))
+    M = np.concatenate(([0],np.cumsum(p*np.arange(n_bins))))
+    def class_score(i,j):
+        # between-class variance contribution of bins [i,j), i and j may be arrays
+        w = P[j]-P[i]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            score = (M[j]-M[i])**2/w
+        return np.where(w>0,score,0)
+    # best[j] = best score for splitting bins [0,j) into the current number of classes
+    best = class_score(0,np.arange(n_bins+1))
+    back = []
+    for k in range(1,classes):
+        new_best = np.full(n_bins+1,-np.inf)
+        arg = np.zeros(n_bins+1,dtype=int)
+        for j in range(k+1,n_bins+1):
+            i = np.arange(k,j)
+            scores = best[i] + class_score(i,j)
+            arg[j] = i[np.argmax(scores)]
+            new_best[j] = scores.max()
+        best = new_best
+        back.append(arg)
+    # Trace back the levels from the last class
+    levels = []
+    j = n_bins
+    for arg in reversed(back):
+        j = arg[j]
+        levels.append(int(j))
+    return sorted(levels)
+
+def histogram_threshold_ranges(hist_first,hist_last,bin_edges,classes=2):
+    '''
+    Proposes threshold ranges for the grains from histograms of the first and last frames
+    Multi-Otsu levels are computed from the summed histogram, and classes whose
+    pixel fraction grows between the first and last frame are taken as crystalline.
+    Neighboring crystalline classes are merged into one range.
+    Returns lists threshold_lower, threshold_upper (one entry per range)
+    '''
+    hist_first = np.asarray(hist_first,dtype=float)
+    hist_last = np.asarray(hist_last,dtype=float)
+    levels = otsu_levels(hist_first/hist_first.sum()+hist_last/hist_last.sum(),classes)
+    bounds = [0] + list(levels) + [len(hist_last)]
+    growth = np.array([hist_last[i:j].sum()/hist_last.sum() - hist_first[i:j].sum()/hist_first.sum()
+                       for i,j in zip(bounds[:-1],bounds[1:])])
+    growing = growth > 0
+    if not growing.any():
+        growing[np.argmax(growth)] = True
+    # threshold_crop_denoise uses strict inequalities, so shift edges by half a bin
+    # (for integer images this includes the first and last value of each class)
+    half_bin = (bin_edges[1]-bin_edges[0])/2
+    threshold_lower = []
+    threshold_upper = []
+    for c_idx in range(len(growth)):
+        if not growing[c_idx]:
+            continue
+        if c_idx>0 and growing[c_idx-1]:
+            threshold_upper[-1] = bin_edges[bounds[c_idx+1]]-half_bin
+        else:
+            threshold_lower.append(bin_edges[bounds[c_idx]]-half_bin)
+            threshold_upper.append(bin_edges[bounds[c_idx+1]]-half_bin)
+    return threshold_lower,threshold_upper
+
+def phase_correlation_shift(reference,moving):
+    '''
+    Translation (dx,dy) in pixels of moving relative to reference, from the peak
+    of their phase correlation, with sub-pixel (parabolic) peak interpolation
+    The cross power spectrum is only partly normalized (square root of its
+    magnitude), which is less sensitive to noise than pure phase correlation.
+    Also returns the height of the peak over the standard deviation of the
+    correlation, which is low when the images share no features.
+    '''
+    window = np.outer(np.hanning(reference.shape[0]),np.hanning(reference.shape[1]))
+    f_ref = np.fft.fft2((reference-reference.mean())*window)
+    f_mov = np.fft.fft2((moving-moving.mean())*window)
+    cross_power = f_mov*np.conj(f_ref)
+    cross_power /= np.sqrt(np.abs(cross_power))+1e-12
+    correlation = np.real(np.fft.ifft2(cross_power))
+    peak = np.unravel_index(np.argmax(correlation),correlation.shape)
+    shift = []
+    for axis,size in enumerate(correlation.shape):
+        # Parabola through the peak and its neighbors (wrapped around)
+        before = list(peak)
+        after = list(peak)
+        before[axis] = (peak[axis]-1)%size
+        after[axis] = (peak[axis]+1)%size
+        c0,c1,c2 = correlation[tuple(before)],correlation[peak],correlation[tuple(after)]
+        denominator = c0-2*c1+c2
+        offset = 0.5*(c0-c2)/denominator if denominator<0 else 0
+        # Peaks past the middle are negative shifts
+        position = peak[axis]+offset
+        shift.append(position-size if position>size/2 else position)
+    return shift[1],shift[0],correlation[peak]/(correlation.std()+1e-12)
+
+def estimate_drift(images,x1,x2,y1,y2,margin=100,min_size=32,min_contrast=1.6):
+    '''
+    Stage drift (dx,dy) in pixels of each image (in time order) relative to the first
+    Each frame is compared with the first in the crop region plus margin, moved
+    along with the drift so far. Images are band-pass filtered first, so small
+    features such as dust and film texture set the drift, rather than the lamp
+    vignetting or noise. Comparing with the first frame (rather than summing
+    frame to frame steps) keeps errors from adding up.
+    The crop region itself is left out of the comparison, since the growing grain
+    in it would pull the drift along with the front. Near the image edge, only
+    the part of the region still inside the image is compared (at least
+    min_size pixels on each side).
+    A frame only counts as matched if its correlation peak is at least
+    min_contrast times the peak of the reference compared with itself turned by
+    180 degrees (same features, nothing aligned). Unmatched frames, e.g. of a
+    featureless film, keep the drift of the frame before.
+    Returns an array of shape (number of images,2)
+    '''
+    def features(img):
+        img = np.asarray(img,dtype=np.float32)
+        return ndimage.gaussian_filter(img,1.5)-ndimage.gaussian_filter(img,6)
+    drift = np.zeros((len(images),2))
+    reference = None
+    unaligned = {}
+    unmatched = 0
+    for idx,img in enumerate(images):
+        if reference is None:
+            ry0,rx0 = max(y1-margin,0),max(x1-margin,0)
+            reference = features(img[ry0:y2+margin,rx0:x2+margin])
+            # Weight 0 in the crop region, rising to 1 over a few pixels around it
+            # so the edge of the masked area doesn't correlate
+            outside = np.ones(reference.shape,dtype=np.float32)
+            outside[y1-ry0:y2-ry0,x1-rx0:x2-rx0] = 0
+            if outside.mean()<0.1:
+                print('The crop region fills most of the image, so the growing grain may '
+                      'set the drift. Use a smaller crop or reference points.')
+                weight = np.ones(reference.shape,dtype=np.float32)
+            else:
+                weight = ndimage.gaussian_filter(outside,3)*outside
+            reference = reference*weight
+            continue
+        # Same region as in the first frame, where this frame has drifted to,
+        # cut to the part inside the image
+        dx,dy = np.round(drift[idx-1]).astype(int)
+        r0,c0 = ry0+dy,rx0+dx
+        v0,v1 = max(r0,0),min(r0+reference.shape[0],img.shape[0])
+        u0,u1 = max(c0,0),min(c0+reference.shape[1],img.shape[1])
+        if v1-v0<min_size or u1-u0<min_size:
+            # Drifted out of the image, keep the last estimate
+            print('Drift region left the image at frame ' + str(idx))
+            drift[idx:] = drift[idx-1]
+            break
+        overlap = (slice(v0-r0,v1-r0),slice(u0-c0,u1-c0))
+        step = phase_correlation_shift(reference[overlap],features(img[v0:v1,u0:u1])*weight[overlap])
+        key = (v0-r0,v1-r0,u0-c0,u1-c0)
+        if key not in unaligned:
+            # Only depends on the compared part of the reference
+            unaligned[key] = phase_correlation_shift(reference[overlap],
+                                                     reference[overlap][::-1,::-1])[2]
+        if step[2]<min_contrast*unaligned[key]:
+            unmatched += 1
+            drift[idx] = drift[idx-1]
+            continue
+        drift[idx] = (dx+step[0],dy+step[1])
+    if unmatched:
+        print('No features to follow the drift by outside the crop region in {} of {} frames, '
+              'their drift was kept from the frame before. Use reference points if the '
+              'stage drifted.'.format(unmatched,len(images)-1))
+    return drift
+
+def reference_point_drift(times,ref_times,ref_x,ref_y):
+    '''
+    Drift (dx,dy) at times from reference points (e.g. a particle picked in the
+    manual analyzer) at ref_times, relative to the first reference point
+    Points are interpolated linearly in time, and held before the first and after
+    the last
+    '''
+    order = np.argsort(ref_times)
+    ref_times = np.asarray(ref_times,dtype=float)[order]
+    ref_x = np.asarray(ref_x,dtype=float)[order]
+    ref_y = np.asarray(ref_y,dtype=float)[order]
+    return np.column_stack((np.interp(times,ref_times,ref_x-ref_x[0]),
+                            np.interp(times,ref_times,ref_y-ref_y[0])))
+
+def drift_crop_windows(drift,reference_drift,x1,x2,y1,y2,shape):
+    '''
+    Crop region of each frame, following the drift relative to reference_drift
+    (the drift of the frame the crop region and directions were picked on), so
+    the grain stays in the same place in every cropped frame
+    Windows move by whole pixels and are kept inside the image (shape)
+    Returns a list of (x1,x2,y1,y2) and a mask of the frames where the window hit
+    the image edge, so the grain isn't aligned in those frames
+    '''
+    shift = np.round(np.asarray(drift)-reference_drift).astype(int)
+    windows = []
+    clamped = np.zeros(len(shift),dtype=bool)
+    for idx,(dx,dy) in enumerate(shift):
+        dx_in = int(np.clip(dx,-x1,shape[1]-x2))
+        dy_in = int(np.clip(dy,-y1,shape[0]-y2))
+        clamped[idx] = not (dx_in==dx and dy_in==dy)
+        windows.append((x1+dx_in,x2+dx_in,y1+dy_in,y2+dy_in))
+    return windows,clamped
+
+def auto_threshold(img_first,img_last,x1,x2,y1,y2,classes=2,
+                   rescale=None,equalize_hist=False,clip_limit=0.05):
+    '''
+    Headless threshold selection for threshold_crop_denoise
+    Returns threshold_lower, threshold_upper and multiple_ranges
+    '''
+    hist_first,bin_edges = crop_histogram(img_first,x1,x2,y1,y2,rescale=rescale,
+                                       equalize_hist=equalize_hist,clip_limit=clip_limit)
+    hist_last = crop_histogram(img_last,x1,x2,y1,y2,rescale=rescale,
+                               equalize_hist=equalize_hist,clip_limit=clip_limit)[0]
+    threshold_lower,threshold_upper = histogram_threshold_ranges(
+        hist_first,hist_last,bin_edges,classes=classes)
+    if len(threshold_lower)==1:
+        return threshold_lower[0],threshold_upper[0],False
+    return threshold_lower,threshold_upper,True
+
+def sweep_parameters(images,times,x1,x2,y1,y2,lines,length_per_pixel,
+                     threshold_ranges,disks,clip_limits,equalize_hist=True,
+                     rescale=None,threshold_out=False,n_workers=None):
+    '''
+    Growth rate of each line for every combination of threshold range, disk size
+    and clip limit on one series
+    images are decoded gray scale frames sorted by time, with matching times
+    threshold_ranges is a list of (threshold_lower,threshold_upper) pairs. Use lists
+        of lower and upper values for multiple ranges.
+    Frames are equalized and cropped once per clip limit and thresholded once per
+        range, then shared by all disk sizes. Threshold ranges are evaluated in
+        parallel threads, which share the frames without copying them (the numpy
+        and skimage filters release the GIL).
+    Returns a DataFrame with one row per combination and line
+    '''
+    times = np.asarray(times)
+    if not equalize_hist:
+        clip_limits = [None]
+    rows = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for clip_limit in clip_limits:
+            # Equalize and crop each frame once for this clip limit
+            cropped_images = list(executor.map(
+                lambda img: enhance_contrast(img,rescale=rescale,equalize_hist=equalize_hist,
+                                           clip_limit=clip_limit)[y1:y2,x1:x2],
+                images))
+            def evaluate(threshold_range):
+                threshold_lower,threshold_upper = threshold_range
+                multiple_ranges = np.ndim(threshold_lower)>0
+                thresholded = [apply_threshold(cropped,threshold_lower,threshold_upper,
+                                               threshold_out=threshold_out,
+                                               multiple_ranges=multiple_ranges)
+                               for cropped in cropped_images]
+                results = []
+                for d in disks:
+                    denoised = [fast_kernels.despeckle(t,d) for t in thresholded]
+                    distances = compute_distances(denoised,lines,length_per_pixel)
+                    slopes,intercepts,stderrs = fit_distances(times,distances)[0].get_params()
+                    for line_idx in range(0,len(lines)):
+                        results.append({'clip_limit':clip_limit,
+                                        'threshold_lower':threshold_lower,
+                                        'threshold_upper':threshold_upper,
+                                        'disk':d,
+                                        'line_number':line_idx+1,
+                                        'growth_rate_umps':slopes[line_idx],
+                                        'growth_rate_stderr_umps':stderrs[line_idx]})
+                return results
+            for results in executor.map(evaluate,threshold_ranges):
+                rows.extend(results)
+    return pd.DataFrame(rows)
+
+def set_new_im_data(ax,im_data,new_img,shape=None):
+    # Change data extent to match new image (or shape, for downsampled images
+    # shown in full resolution pixel coordinates)
+    if shape is None:
+        shape = new_img.shape
+    im_data.set_extent((0, shape[1], shape[0], 0))
     # Reset axes limits
-    ax.set_xlim(0,new_img.shape[1])
-    ax.set_ylim(new_img.shape[0],0)
+    ax.set_xlim(0,shape[1])
+    ax.set_ylim(shape[0],0)
     # Now set the data
     im_data.set_data(new_img)
 
@@ -176,11 +622,19 @@ image_width_microns = {'4x':  2942.5,
                          '20x':  588.5,
                          '10x': 1170.3,
                          '50x':  233.7}
+def get_length_per_pixel(img,mag):
+    # Check if images dimensions are as expected. If not use image width
+    # Not very robust yet
+    if img.shape[1]==2048:
+        return micron_per_pixel[mag]
+    else:
+        return image_width_microns[mag]/img.shape[1]
 def get_growth_edge(img,line,length_per_pixel):
     # Get line profile
-    profile = profile_line(img,
-                           (line[0][1],line[0][0]),
-                           (line[1][1],line[1][0]))
+    with stage_timer.stage('profile sampling'):
+        profile = profile_line(img,
+                               (line[0][1],line[0][0]),
+                               (line[1][1],line[1][0]))
     # Find last point on grain (where image is still saturated)
     growth_front_endpoint = np.where(profile==np.amax(profile))[0][-1]
     line_endpoint = profile.shape[0]
@@ -193,6 +647,549 @@ def get_growth_edge(img,line,length_per_pixel):
                              / line_endpoint)
     return distance_to_growth_front
     
+def compute_distances(denoised_images,lines,length_per_pixel):
+    '''
+    Distance to the growth front (um) for each line (rows) and image (columns)
+    '''
+    distances = np.zeros((len(lines),len(denoised_images)))
+    for idx,denoised in enumerate(denoised_images):
+        for line_idx in range(0,len(lines)):
+            distances[line_idx][idx] = get_growth_edge(
+                denoised,lines[line_idx],
+                length_per_pixel=length_per_pixel
+                )
+    return distances
+
+def window_front_samples(cropped,rows,cols,threshold_lower,threshold_upper,d,
+                         threshold_out=False,multiple_ranges=False):
+    '''
+    Indices of the crystalline samples at (rows,cols), thresholding and despeckling
+    only the pixels around them, with a margin of the disk size so the despeckle
+    matches the whole crop
+    '''
+    margin = d+2
+    r0 = max(int(np.floor(rows.min()))-margin,0)
+    r1 = min(int(np.ceil(rows.max()))+margin+1,cropped.shape[0])
+    c0 = max(int(np.floor(cols.min()))-margin,0)
+    c1 = min(int(np.ceil(cols.max()))+margin+1,cropped.shape[1])
+    mask = threshold_and_despeckle(cropped[r0:r1,c0:c1],threshold_lower,threshold_upper,d,
+                                   threshold_out=threshold_out,
+                                   multiple_ranges=multiple_ranges)[0]
+    with stage_timer.stage('profile sampling'):
+        profile = ndimage.map_coordinates(mask.astype(float),[rows-r0,cols-c0],
+                                          order=1,mode='constant')
+    # Crystalline where the whole interpolation neighborhood is on
+    return np.flatnonzero(np.isclose(profile,255))
+
+def refine_growth_edge(cropped,line,coarse_idx,threshold_lower,threshold_upper,d,
+                       half_window,threshold_out=False,multiple_ranges=False):
+    '''
+    Index of the last crystalline sample along line (samples spaced as profile_line),
+    searching only a window of +-half_window samples around the estimate coarse_idx
+    Only the pixels around the window are thresholded and despeckled. The window
+    grows while the front is at its edge. Returns the index and the number of samples.
+    '''
+    rows,cols,total_length = sample_path(line)
+    n_samples = len(rows)
+    i0 = max(coarse_idx-half_window,0)
+    i1 = min(coarse_idx+half_window,n_samples-1)
+    while True:
+        on = window_front_samples(cropped,rows[i0:i1+1],cols[i0:i1+1],threshold_lower,
+                                  threshold_upper,d,threshold_out=threshold_out,
+                                  multiple_ranges=multiple_ranges)
+        if len(on)>0 and on[-1]<i1-i0:
+            return i0+on[-1],n_samples
+        if len(on)>0 and i1==n_samples-1:
+            return n_samples-1,n_samples
+        if len(on)==0 and i0==0:
+            if i1==n_samples-1:
+                # Nothing crystalline, the whole line as in get_growth_edge
+                return n_samples-1,n_samples
+            i1 = min(i1+2*half_window,n_samples-1)
+        elif len(on)>0:
+            # Still crystalline at the end of the window, the front is further out
+            i0 = i0+on[-1]
+            i1 = min(i1+2*half_window,n_samples-1)
+        else:
+            # Nothing crystalline in the window, the front is further in
+            i1 = i0
+            i0 = max(i0-2*half_window,0)
+        half_window *= 2
+
+def coarse_to_fine_distances(img,x1,x2,y1,y2,lines,length_per_pixel,
+                             threshold_lower,threshold_upper,d,factor=4,rescale=None,
+                             threshold_out=False,multiple_ranges=False,half_window=None):
+    '''
+    Distance to the growth front (um) along each line for one frame, without
+    processing the whole crop at full resolution
+    The crop is binned by factor, thresholded and despeckled (disk scaled down) to
+    estimate the front, which is then refined at full resolution in a window of
+    +-half_window samples (default 2*factor+d) around the estimate.
+    Histogram equalization isn't supported, since CLAHE needs the whole frame.
+    '''
+    if rescale:
+        img = exposure.rescale_intensity(img,in_range=rescale)
+    cropped = img[y1:y2,x1:x2]
+    with stage_timer.stage('coarse front'):
+        coarse = threshold_and_despeckle(bin_image(cropped,factor),threshold_lower,threshold_upper,
+                                         max(1,int(round(d/factor))),threshold_out=threshold_out,
+                                         multiple_ranges=multiple_ranges)[0]
+    if half_window is None:
+        half_window = 2*factor+d
+    distances = np.zeros(len(lines))
+    for line_idx,line in enumerate(lines):
+        # Estimate on the binned mask, nearest pixel
+        coarse_line = [(x/factor-0.5+0.5/factor,y/factor-0.5+0.5/factor) for x,y in line]
+        rows,cols,_ = path_pixels(coarse_line,coarse.shape)
+        on = np.flatnonzero(coarse[rows,cols]>0)
+        n_coarse = len(rows)
+        n_samples = len(sample_path(line)[0])
+        coarse_idx = int(round(on[-1]*(n_samples-1)/max(n_coarse-1,1))) if len(on)>0 else 0
+        front_idx,n_samples = refine_growth_edge(cropped,line,coarse_idx,threshold_lower,
+                                                 threshold_upper,d,half_window,
+                                                 threshold_out=threshold_out,
+                                                 multiple_ranges=multiple_ranges)
+        total_length = get_line_length(line,mag=None,unit='um',length_per_pixel=length_per_pixel)
+        distances[line_idx] = total_length*(front_idx+1)/n_samples
+    return distances
+
+def track_front_distances(frames,times,x1,x2,y1,y2,lines,length_per_pixel,
+                          threshold_lower,threshold_upper,d,max_velocity,rescale=None,
+                          equalize_hist=False,threshold_out=False,multiple_ranges=False,
+                          clip_limit=0.05,crop_windows=None):
+    '''
+    Distance to the growth front (um) along each line (rows) in each frame (columns),
+    following the front from frame to frame
+    frames are the full images in time order (any iterable, e.g. a generator that
+    reads them one at a time). Fronts only advance, so each frame is only searched
+    between the previous front and where the front would be at max_velocity (um/s).
+    Only the pixels around that window are thresholded and despeckled, and
+    detections behind the front (e.g. a dark frame) are ignored. The first frame is
+    searched along the whole line.
+    crop_windows optionally gives the crop region (x1,x2,y1,y2) of each frame,
+    e.g. following stage drift (see drift_crop_windows)
+    Returns the distances, and a mask of the fronts clipped at the end of the
+    window (the front moved faster than max_velocity)
+    '''
+    paths = [sample_path(line) for line in lines]
+    # Line length (um) per sample
+    spacings = [get_line_length(line,mag=None,unit='um',length_per_pixel=length_per_pixel)
+                /len(rows) for line,(rows,cols,_) in zip(lines,paths)]
+    distances = np.zeros((len(lines),len(times)))
+    clipped = np.zeros((len(lines),len(times)),dtype=bool)
+    fronts = [None]*len(lines)
+    for idx,img in enumerate(frames):
+        with stage_timer.stage('contrast'):
+            img = enhance_contrast(img,rescale=rescale,equalize_hist=equalize_hist,
+                                   clip_limit=clip_limit)
+        if crop_windows is not None:
+            x1,x2,y1,y2 = crop_windows[idx]
+        cropped = img[y1:y2,x1:x2]
+        for line_idx,(rows,cols,_) in enumerate(paths):
+            n_samples = len(rows)
+            if fronts[line_idx] is None:
+                i0,i1 = 0,n_samples-1
+            else:
+                i0 = fronts[line_idx]
+                max_advance = int(np.ceil(max_velocity*(times[idx]-times[idx-1])/spacings[line_idx]))+1
+                i1 = min(i0+max_advance,n_samples-1)
+            on = window_front_samples(cropped,rows[i0:i1+1],cols[i0:i1+1],threshold_lower,
+                                      threshold_upper,d,threshold_out=threshold_out,
+                                      multiple_ranges=multiple_ranges)
+            if len(on)>0:
+                front = i0+on[-1]
+                clipped[line_idx,idx] = fronts[line_idx] is not None and front==i1<n_samples-1
+                fronts[line_idx] = front
+            # Nothing crystalline: no grain yet, or the front is kept where it was
+            front = fronts[line_idx] if fronts[line_idx] is not None else -1
+            distances[line_idx,idx] = spacings[line_idx]*(front+1)
+    return distances,clipped
+
+def label_grains(mask,min_area=0):
+    '''
+    Labels the connected grains (nonzero pixels) of a despeckled mask
+    Grains smaller than min_area pixels are dropped
+    Returns the label image (0 = background, grains numbered from 1) and the number of grains
+    '''
+    labels,n_grains = ndimage.label(mask>0)
+    if min_area>0 and n_grains>0:
+        areas = np.bincount(labels.ravel())
+        keep = areas>=min_area
+        keep[0] = False
+        # Renumber the remaining grains from 1
+        new_labels = np.zeros(n_grains+1,dtype=labels.dtype)
+        new_labels[keep] = np.arange(1,np.count_nonzero(keep)+1)
+        labels = new_labels[labels]
+        n_grains = int(np.count_nonzero(keep))
+    return labels,n_grains
+
+def track_grains(denoised_images,length_per_pixel,min_area=20):
+    '''
+    Follows every grain in the crop through a time ordered stack of masks
+    A grain is the same grain as the one it overlaps most in the previous frame.
+    When grains merge, the merged grain continues the track with the largest
+    overlap, and the other tracks end.
+    Returns:
+        radii: area equivalent radius (um) of each track (rows) in each frame
+            (columns), NaN where the track doesn't exist
+        touches_edge: True for tracks touching the crop edge in any frame, so
+            part of the grain area is cut off
+        track_map: track number of each pixel in the last frame (-1 = background)
+    '''
+    track_map = None
+    n_tracks = 0
+    areas = [] # area (pixels) of each track in each frame
+    touches_edge = []
+    for frame_idx,mask in enumerate(denoised_images):
+        labels,n_grains = label_grains(mask,min_area=min_area)
+        grain_area = np.bincount(labels.ravel(),minlength=n_grains+1)
+        edge_labels = np.unique(np.concatenate((labels[0],labels[-1],labels[:,0],labels[:,-1])))
+        # Track number of each grain in this frame
+        grain_track = np.full(n_grains+1,-1)
+        if track_map is not None and n_grains>0 and n_tracks>0:
+            # Overlap (pixels) of each (grain,previous track) pair, largest first
+            both = np.logical_and(labels>0,track_map>=0)
+            pairs,overlap = np.unique(labels[both].astype(np.int64)*n_tracks + track_map[both],
+                                      return_counts=True)
+            used_tracks = set()
+            for pair in pairs[np.argsort(overlap)[::-1]]:
+                grain,track = divmod(int(pair),n_tracks)
+                if grain_track[grain]<0 and not track in used_tracks:
+                    grain_track[grain] = track
+                    used_tracks.add(track)
+        # Grains without a previous track start a new one
+        for grain in range(1,n_grains+1):
+            if grain_track[grain]<0:
+                grain_track[grain] = n_tracks
+                n_tracks += 1
+                areas.append(np.full(len(denoised_images),np.nan))
+                touches_edge.append(False)
+            areas[grain_track[grain]][frame_idx] = grain_area[grain]
+        for grain in edge_labels[edge_labels>0]:
+            touches_edge[grain_track[grain]] = True
+        grain_track[0] = -1
+        track_map = grain_track[labels]
+    if n_tracks==0:
+        return np.zeros((0,len(denoised_images))),np.zeros(0,dtype=bool),track_map
+    radii = np.sqrt(np.array(areas)/np.pi)*length_per_pixel
+    return radii,np.array(touches_edge),track_map
+
+def grain_growth_rates(radii,times,min_points=3):
+    '''
+    Fits radius vs. time for all grains at once (rows of radii, NaN = missing)
+    Returns slope (um/s), intercept and standard error for each grain,
+    NaN for grains seen in fewer than min_points frames
+    '''
+    grain_fit = StreamingLinearFit(n_lines=radii.shape[0])
+    for idx in range(0,len(times)):
+        grain_fit.add(times[idx],radii[:,idx])
+    slopes,intercepts,stderrs = grain_fit.get_params()
+    too_few = np.count_nonzero(~np.isnan(radii),axis=1)<min_points
+    slopes[too_few] = np.nan
+    intercepts[too_few] = np.nan
+    stderrs[too_few] = np.nan
+    return slopes,intercepts,stderrs
+
+def polar_sampling_maps(shape,center,n_angles=360,dr=1.0):
+    '''
+    Pixel indices which unwrap an image of the given shape into polar coordinates
+    around center (x,y in pixels). Computed once, then every mask of the series is
+    resampled with a single indexing operation (nearest pixel).
+    Angles are in degrees, counterclockwise on screen from the +x direction
+    Returns rows and cols (angles x radii index arrays), inside (False where the ray
+    has left the image), the radius of each sample (pixels) and the angles
+    '''
+    cx,cy = center
+    height,width = shape[:2]
+    # Far enough to reach every corner of the image
+    r_max = max(np.hypot(x-cx,y-cy) for x in (0,width-1) for y in (0,height-1))
+    radii_px = np.arange(0,r_max+dr,dr)
+    angles = np.arange(0,n_angles)*360/n_angles
+    theta = np.deg2rad(angles)
+    # Image rows increase downwards, so y is flipped for counterclockwise angles
+    x = cx + np.outer(np.cos(theta),radii_px)
+    y = cy - np.outer(np.sin(theta),radii_px)
+    cols = np.rint(x).astype(np.intp)
+    rows = np.rint(y).astype(np.intp)
+    inside = np.logical_and.reduce((cols>=0,cols<width,rows>=0,rows<height))
+    # Samples outside the image point at pixel (0,0) and are masked with inside
+    cols[~inside] = 0
+    rows[~inside] = 0
+    # Once a ray leaves the image it stays outside (the image is convex)
+    inside = np.logical_and.accumulate(inside,axis=1)
+    return rows,cols,inside,radii_px,angles
+
+def polar_front_radii(mask,polar_maps):
+    '''
+    Radius (pixels) of the growth front in every angle bin of polar_maps, in one pass
+    The front is the last crystalline sample along each ray, like get_growth_edge,
+    plus half a sample step. NaN where the ray has no crystalline pixels or is
+    still crystalline where it leaves the image (the front is outside the crop).
+    '''
+    rows,cols,inside,radii_px,angles = polar_maps
+    polar = np.logical_and(fast_kernels.sample_mask(mask,rows,cols),inside)
+    n_radii = polar.shape[1]
+    # argmax finds the first True, so search the reversed rays for the last one
+    last = n_radii-1-np.argmax(polar[:,::-1],axis=1)
+    step = radii_px[1]-radii_px[0] if n_radii>1 else 0
+    front = radii_px[last] + step/2
+    last_inside = np.count_nonzero(inside,axis=1)-1
+    front[np.logical_or(~np.any(polar,axis=1),last>=last_inside)] = np.nan
+    return front
+
+def angular_growth_rates(denoised_images,times,center,length_per_pixel,
+                         n_angles=360,min_points=3,arrival=None):
+    '''
+    Growth rate vs. angle around a nucleation center (x,y in pixels of the masks)
+    Each time ordered mask is unwrapped with the same precomputed polar maps, and
+    the front radius of all angle bins is fit at once
+    If the arrival frame map of the masks (arrival_frame_map) is passed, it is
+    unwrapped once instead of every mask
+    Returns angles (degrees), front radii (um, angles x frames), and the slope
+    (um/s), intercept and standard error of each angle bin
+    '''
+    polar_maps = polar_sampling_maps(denoised_images[0].shape,center,n_angles=n_angles)
+    if arrival is not None:
+        with stage_timer.stage('polar sampling'):
+            radii = arrival_front_radii(arrival,polar_maps,len(denoised_images))*length_per_pixel
+    else:
+        radii = np.full((n_angles,len(denoised_images)),np.nan)
+        for idx,mask in enumerate(denoised_images):
+            with stage_timer.stage('polar sampling'):
+                radii[:,idx] = polar_front_radii(mask,polar_maps)*length_per_pixel
+    slopes,intercepts,stderrs = grain_growth_rates(radii,times,min_points=min_points)
+    return polar_maps[4],radii,slopes,intercepts,stderrs
+
+def arrival_frame_map(denoised_images):
+    '''
+    Index of the frame from which each pixel of the time ordered masks stays
+    crystalline up to the last mask (-1 = not crystalline in the last mask),
+    built in one pass over the stack
+    A pixel crystalline in a single frame only (a speck of noise) is dropped again,
+    so it can't set the front of the frames after it.
+    Frame indices rather than times are stored so front lookups compare exactly,
+    and the map fits a 16 bit image. The time of frame k is times[k].
+    '''
+    arrival = np.full(denoised_images[0].shape,-1,dtype=np.int32)
+    for idx,mask in enumerate(denoised_images):
+        update_arrival_map(arrival,mask,idx)
+    return arrival
+
+def update_arrival_map(arrival,mask,frame_idx):
+    # Adds the next mask (in place): crystalline pixels which were not crystalline in
+    # the previous mask arrive at frame_idx, pixels not crystalline are reset
+    crystalline = np.asarray(mask)>0
+    arrival[np.logical_and(arrival<0,crystalline)] = frame_idx
+    arrival[~crystalline] = -1
+    return arrival
+
+def last_arrived_index(arrival_samples,n_frames):
+    '''
+    For samples of the arrival map along paths (paths x samples), the index of the
+    last crystalline sample of each path in each frame (paths x frames, -1 = none)
+    A sample is crystalline from its arrival frame on, so the last crystalline
+    sample is a running maximum over the frames
+    '''
+    arrival_samples = np.atleast_2d(arrival_samples)
+    last = np.full((arrival_samples.shape[0],n_frames),-1,dtype=np.intp)
+    path_idx,sample_idx = np.nonzero(np.logical_and(arrival_samples>=0,arrival_samples<n_frames))
+    np.maximum.at(last,(path_idx,arrival_samples[path_idx,sample_idx]),sample_idx)
+    return np.maximum.accumulate(last,axis=1)
+
+def sample_path(path):
+    '''
+    Pixel coordinates along a line or polyline [(x1,y1),(x2,y2),...], spaced like
+    profile_line (about one sample per pixel, both ends included)
+    Returns the rows, cols and the total length of the path (pixels)
+    '''
+    rows = []
+    cols = []
+    total_length = 0
+    for (x1,y1),(x2,y2) in zip(path[:-1],path[1:]):
+        segment_length = np.hypot(x2-x1,y2-y1)
+        n_points = int(np.ceil(segment_length+1))
+        # Joints are only sampled once
+        start = 0 if len(rows)==0 else 1
+        rows.append(np.linspace(y1,y2,n_points)[start:])
+        cols.append(np.linspace(x1,x2,n_points)[start:])
+        total_length += segment_length
+    return np.concatenate(rows),np.concatenate(cols),total_length
+
+def path_pixels(path,shape):
+    # Nearest pixel (rows,cols) of the samples along a path, kept inside the image
+    rows,cols,total_length = sample_path(path)
+    rows = np.clip(np.rint(rows).astype(np.intp),0,shape[0]-1)
+    cols = np.clip(np.rint(cols).astype(np.intp),0,shape[1]-1)
+    return rows,cols,total_length
+
+def arrival_path_distances(arrival,paths,n_frames,length_per_pixel):
+    '''
+    Distance to the growth front (um) along each line or polyline (rows) in each
+    frame (columns), looked up in the arrival frame map instead of every mask
+    Uses the nearest pixel and the same convention as get_growth_edge: the front is
+    the fraction of the path up to the last crystalline sample, and the whole path
+    when nothing along it is crystalline yet
+    '''
+    distances = np.zeros((len(paths),n_frames))
+    for path_idx,path in enumerate(paths):
+        rows,cols,total_length = path_pixels(path,arrival.shape)
+        last = last_arrived_index(arrival[rows,cols],n_frames)[0]
+        last[last<0] = len(rows)-1
+        distances[path_idx] = total_length*length_per_pixel*(last+1)/len(rows)
+    return distances
+
+def arrival_front_radii(arrival,polar_maps,n_frames):
+    '''
+    Front radius (pixels) of every angle bin of polar_maps (rows) in each frame
+    (columns), from one unwrapping of the arrival frame map. Same convention as
+    polar_front_radii.
+    '''
+    rows,cols,inside,radii_px,angles = polar_maps
+    last = last_arrived_index(np.where(inside,arrival[rows,cols],-1),n_frames)
+    step = radii_px[1]-radii_px[0] if len(radii_px)>1 else 0
+    front = radii_px[np.maximum(last,0)] + step/2
+    last_inside = np.count_nonzero(inside,axis=1)-1
+    front[np.logical_or(last<0,last>=last_inside[:,np.newaxis])] = np.nan
+    return front
+
+def check_arrival_map(shape=(120,160),n_frames=20,speck_frame=3,speck_size=12):
+    '''
+    Compares the fronts looked up in the arrival map with get_growth_edge on every
+    mask, for a grain growing in from the left edge, before and after adding a
+    speck ahead of the front in a single frame. The speck must only move the
+    front of its own frame in get_growth_edge, and no front in the arrival map.
+    Raises an AssertionError if they differ by more than one pixel.
+    '''
+    cols = np.arange(0,shape[1])
+    masks = [np.tile(cols<5+6*idx,(shape[0],1)).astype(np.uint8)*255
+             for idx in range(0,n_frames)]
+    lines = [[(0,20),(shape[1]-1,20)],[(0,shape[0]//2),(shape[1]-1,shape[0]//2)],
+             [(0,10),(shape[1]-1,shape[0]-10)]]
+    clean = compute_distances(masks,lines,1.0)
+    lookup = arrival_path_distances(arrival_frame_map(masks),lines,n_frames,1.0)
+    assert np.all(np.abs(lookup-clean)<=1.0), 'arrival map fronts differ on clean masks'
+    # Speck on the middle line, well ahead of the front
+    row = shape[0]//2
+    speck = masks[speck_frame].copy()
+    speck[row-speck_size//2:row+speck_size//2,-2*speck_size:-speck_size] = 255
+    masks[speck_frame] = speck
+    per_frame = compute_distances(masks,lines,1.0)
+    assert per_frame[1,speck_frame]>clean[1,speck_frame]+speck_size, 'speck not on the line'
+    assert np.array_equal(np.delete(per_frame,speck_frame,axis=1),
+                          np.delete(clean,speck_frame,axis=1)), 'speck outside its frame'
+    lookup = arrival_path_distances(arrival_frame_map(masks),lines,n_frames,1.0)
+    assert np.all(np.abs(lookup-clean)<=1.0), 'speck moved the arrival map fronts'
+    print('Arrival map fronts match get_growth_edge, the single frame speck is ignored')
+
+def line_kymographs(denoised_images,lines):
+    '''
+    Kymograph (frames x samples along the line) of every line, True where crystalline
+    The sample pixels of all lines are computed once and gathered from each mask
+    with a single indexing operation
+    '''
+    shape = denoised_images[0].shape
+    pixels = [path_pixels(line,shape) for line in lines]
+    rows = np.concatenate([p[0] for p in pixels])
+    cols = np.concatenate([p[1] for p in pixels])
+    samples = np.zeros((len(denoised_images),len(rows)),dtype=bool)
+    for idx,mask in enumerate(denoised_images):
+        samples[idx] = fast_kernels.sample_mask(mask,rows,cols)
+    splits = np.cumsum([len(p[0]) for p in pixels])[:-1]
+    return np.split(samples,splits,axis=1)
+
+def kymograph_front_distances(kymographs,lines,length_per_pixel,time_window=3):
+    '''
+    Distance to the growth front (um) for each line (rows) and frame (columns),
+    found on the kymographs instead of each frame on its own
+    Every sample is first replaced by the majority over time_window frames, so a
+    front missed or overshot in a single frame follows its neighbors. The front is
+    then the last crystalline sample, as in get_growth_edge (the whole line when
+    nothing is crystalline).
+    Returns the distances and the front sample index of each line and frame
+    '''
+    distances = np.zeros((len(lines),kymographs[0].shape[0]))
+    fronts = np.zeros(distances.shape,dtype=np.intp)
+    for line_idx,(kymograph,line) in enumerate(zip(kymographs,lines)):
+        if time_window>1:
+            kymograph = ndimage.median_filter(kymograph.astype(np.uint8),
+                                              size=(time_window,1),mode='nearest')>0
+        n_samples = kymograph.shape[1]
+        last = n_samples-1-np.argmax(kymograph[:,::-1],axis=1)
+        fronts[line_idx] = last
+        total_length = get_line_length(line,mag=None,unit='um',length_per_pixel=length_per_pixel)
+        distances[line_idx] = total_length*(last+1)/n_samples
+    return distances,fronts
+
+def velocity_field(arrival,times,length_per_pixel,sigma=3.0):
+    '''
+    Local front speed (um/s) and propagation direction from the arrival frame map
+    The arrival time T of each pixel is smoothed with a NaN aware gaussian (sigma in
+    pixels), since T only changes in steps of one frame. The speed is 1/|grad T|.
+    Pixels which never crystallize, or were already crystalline in the first frame
+    (their arrival time is unknown), are NaN.
+    Returns the speed and the direction (degrees counterclockwise on screen from +x)
+    '''
+    times = np.asarray(times,dtype=float)
+    known = arrival>0
+    arrival_time = np.where(known,times[np.maximum(arrival,0)],0)
+    # Normalized convolution, so unknown pixels don't pull the times down
+    weight = ndimage.gaussian_filter(known.astype(float),sigma)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        smoothed = ndimage.gaussian_filter(arrival_time,sigma)/weight
+    smoothed[~known] = np.nan
+    d_row,d_col = np.gradient(smoothed)
+    gradient = np.hypot(d_row,d_col)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        speed = np.where(gradient>0,length_per_pixel/gradient,np.nan)
+    # Rows increase downwards, so the row gradient is flipped
+    direction = np.degrees(np.arctan2(-d_row,d_col))%360
+    direction[np.isnan(speed)] = np.nan
+    return speed,direction
+
+def group_statistics(values,groups,n_groups):
+    '''
+    Count, mean, median and standard deviation of values for groups 0..n_groups-1
+    (pixels with a negative group or NaN value are skipped)
+    Returns a dict of arrays, one entry per group
+    '''
+    valid = np.logical_and(~np.isnan(values),groups>=0)
+    values = values[valid]
+    groups = groups[valid].astype(np.intp)
+    order = np.argsort(groups,kind='stable')
+    bounds = np.searchsorted(groups[order],np.arange(0,n_groups+1))
+    stats = {'pixels':np.diff(bounds),'mean':np.full(n_groups,np.nan),
+             'median':np.full(n_groups,np.nan),'std':np.full(n_groups,np.nan)}
+    for group in range(0,n_groups):
+        group_values = values[order[bounds[group]:bounds[group+1]]]
+        if len(group_values)>0:
+            stats['mean'][group] = np.mean(group_values)
+            stats['median'][group] = np.median(group_values)
+            stats['std'][group] = np.std(group_values)
+    return stats
+
+def save_arrival_map(save_dir,arrival,times):
+    '''
+    Saves the arrival frame map as a 16 bit png (0 = not crystalline in the last frame,
+    k = frame k-1) and the time of each frame as a csv
+    '''
+    if arrival.max()>=2**16-1:
+        print('Too many frames for a 16 bit arrival map, not saved')
+        return
+    imwrite(os.path.join(save_dir,'arrival_frames.png'),(arrival+1).astype(np.uint16))
+    with open(os.path.join(save_dir,'arrival_frame_times.csv'),'w',newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pixel_value','time_s'])
+        for idx,t in enumerate(times):
+            writer.writerow([idx+1,t])
+
+def save_crop_windows(save_dir,times,drift,crop_windows):
+    # Saves the drift and the crop region of each frame followed as a csv
+    with open(os.path.join(save_dir,'drift_crop_windows.csv'),'w',newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time_s','drift_x_px','drift_y_px','x1','x2','y1','y2'])
+        for t,(dx,dy),window in zip(times,drift,crop_windows):
+            writer.writerow([t,dx,dy]+list(window))
+
 def get_line_length(line,mag,unit='um',length_per_pixel=None):
     '''
     ax = axis handle
@@ -218,7 +1215,130 @@ def get_line_length(line,mag,unit='um',length_per_pixel=None):
     length = pixels * length_per_pixel * factor
     return length
 
+def get_file_time(time_file,time_source,t0_file=None):
+    '''
+    Returns the time (in seconds) associated with a single image file
+    time_source is 'Filename (time=*s)' or 'Date Modified'
+    t0_file is the reference file for 'Date Modified' (defaults to time_file itself)
+    '''
+    if time_source=='Date Modified':
+        # Get time from last modified time
+        if t0_file is None:
+            t0_file = time_file
+        t0 = datetime.datetime.fromtimestamp(os.path.getmtime(t0_file))
+        ti = datetime.datetime.fromtimestamp(os.path.getmtime(time_file))
+        return (ti-t0).total_seconds()
+    elif time_source=='Filename (time=*s)':
+        # Split first by "time=" then by "s" to get the numbers in between
+        return float((time_file.split('time=')[1]).split('s')[0])
+
+def filter_growth_points(times,distances):
+    '''
+    Returns indices of the points in distances (one line) which should be fit
+    '''
+    # Filter out points that are:
+        # less than 80% of the median of the first three points, 
+        # 5% greater than the median of the last three points
+    # old routine filtering less than 10% of the mean
+        # distances>np.mean(distances)*0.1 
+    # This filtering could be smarter. Could add derivative filtering, or could
+    # iteratively fit and reject points with large MSE
+    # logical_and.reduce((condition1,condition2,...,conditionN)) is used so that
+    # more than two conditions can be added (logical_and only accepts one arg)
+    # See https://stackoverflow.com/questions/20528328/numpy-logical-or-for-more-than-two-arguments
+    filterIdx = np.where(np.logical_and.reduce(
+        (distances>np.median(distances[0:3])*0.8,
+        distances<np.median(distances[-3:])*1.05,
+        )))[0]
+    # Check for empty filter results, if so return full array
+    if len(filterIdx)==0:
+        filterIdx = np.arange(0,len(times))
+    return filterIdx
+
+def fit_distances(times,distances):
+    '''
+    Fits distance vs. time for each line after filter_growth_points
+    Returns the StreamingLinearFit and the mask of points included in the fit
+    '''
+    times = np.asarray(times)
+    fit_mask = np.zeros(distances.shape,dtype=bool)
+    for line_idx in range(0,distances.shape[0]):
+        # x,y,filterIdx=cleanSignal_curvature(times,distances[line_idx],
+                           # curvature_threshold = 0.004,
+                           # return_index=True,remove_less_than=1)
+        filterIdx = filter_growth_points(times,distances[line_idx])
+        fit_mask[line_idx][filterIdx] = True
+    # Fit the data with a line using running sums, so later frames and
+    # excluded points update the fit without refitting every point
+    growth_fit = StreamingLinearFit(n_lines=distances.shape[0])
+    for idx in range(0,len(times)):
+        growth_fit.add(times[idx],np.where(fit_mask[:,idx],distances[:,idx],np.nan))
+    return growth_fit,fit_mask
+
+def adaptive_frame_distances(times,frame_distances,target_stderr,tolerance,
+                             n_initial=9,max_rounds=20):
+    '''
+    Growth front distances from a subset of the frames, chosen so the growth rates
+    are pinned to target_stderr (um/s) without processing every frame
+    times are the frame times in time order, and frame_distances(idx) returns the
+    distance along each line in frame idx. n_initial evenly spaced frames are
+    processed and fit first. Each round then adds the frame halfway through the
+    gaps on either side of a point that is off the line through its neighbors (the
+    residual of a local linear fit) by more than 3 times the noise, or tolerance
+    (um), e.g. where growth starts, stops or changes speed. Where growth looks
+    linear but the rate uncertainty is above target_stderr, every gap is halved.
+    Returns the distances (NaN for skipped frames) and the mask of processed frames
+    '''
+    times = np.asarray(times,dtype=float)
+    n_frames = len(times)
+    distances = None
+    processed = np.zeros(n_frames,dtype=bool)
+    n_initial = min(max(n_initial,3),n_frames)
+    processed[np.unique(np.round(np.linspace(0,n_frames-1,n_initial)).astype(int))] = True
+    for round_idx in range(0,max_rounds+1):
+        for idx in np.flatnonzero(processed):
+            if distances is None:
+                first = np.asarray(frame_distances(idx),dtype=float)
+                distances = np.full((len(first),n_frames),np.nan)
+                distances[:,idx] = first
+            elif np.all(np.isnan(distances[:,idx])):
+                distances[:,idx] = frame_distances(idx)
+        frames = np.flatnonzero(processed)
+        if len(frames)==n_frames or round_idx==max_rounds:
+            break
+        growth_fit = fit_distances(times[frames],distances[:,frames])[0]
+        stderrs = growth_fit.get_params()[2]
+        # Deviation of each interior point from the chord through its neighbors
+        t = times[frames]
+        d = distances[:,frames]
+        chord = d[:,:-2] + (d[:,2:]-d[:,:-2])*((t[1:-1]-t[:-2])/(t[2:]-t[:-2]))
+        deviation = np.abs(d[:,1:-1]-chord)
+        # Noise from the typical deviation, at least tolerance
+        noise = np.fmax(np.median(deviation,axis=1)*1.4826,tolerance)
+        off_line = np.zeros(len(frames),dtype=bool)
+        off_line[1:-1] = np.any(deviation>3*noise[:,None],axis=0)
+        # Gaps between processed frames with unprocessed frames inside
+        gaps = np.flatnonzero(np.diff(frames)>1)
+        refine = gaps[off_line[gaps] | off_line[gaps+1]]
+        if len(refine)==0:
+            if np.all(np.where(np.isnan(stderrs),np.inf,stderrs)<=target_stderr):
+                break
+            refine = gaps
+        processed[(frames[refine]+frames[refine+1])//2] = True
+    return distances,processed
+
+def growth_rate_label(line_idx,growth_rate):
+    # Make legend label, decide units based on size of value
+    if growth_rate>10:
+        label_string = '#' + str(line_idx+1) + ', ' + '{:.1f}'.format(growth_rate)+' $\mu$m/s'
+    elif growth_rate>0.1:
+        label_string = '#' + str(line_idx+1) + ', ' + '{:.2f}'.format(growth_rate)+' $\mu$m/s'
+    else:
+        label_string = '#' + str(line_idx+1) + ', ' + '{:.1f}'.format(growth_rate*1e3)+' nm/s'
+    return label_string
 
+# Polling interval (ms) used to check the acquisition directory in live mode
+live_poll_ms = 1000
 
 class GrowthRateAnalyzer(ttk.Frame):
     def __init__(self,parent):
@@ -231,6 +1351,40 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.axes_ranges_initialized = False
         self.threshold_initialized = False
         self.save_initialized = False
+        self.live_mode_on = False
+        # Masks of tiled processing are written here (temporary directory)
+        self.tile_dir = None
+        # Stage drift of each frame in time order, and the crop region following it
+        self.drift = None
+        self.crop_windows = None
+        self.drift_cache = {}
+        # Reference points picked in the manual analyzer {file:(x,y)}
+        self.reference_points = {}
+        # Growth rates of all grains found by track_grains_click
+        self.grain_table = None
+        # Growth rate vs. angle found by angular_growth_map_click
+        self.angular_table = None
+        self.angular_fig = None
+        # First frame each pixel of the masks is crystalline, see get_arrival_map
+        self.arrival_map = None
+        # Kymographs of the last extraction with Kymograph Edges, saved as a diagnostic
+        self.kymograph_fig = None
+        # Local front speed found by velocity_field_click, with its statistics
+        self.velocity_map = None
+        self.velocity_tables = {}
+        self.velocity_fig = None
+        # Cropped histograms keyed by file, crop and contrast settings
+        self.histogram_cache = {}
+        self.histogram_cache_hits = 0
+        self.histogram_cache_misses = 0
+        # Decoded frames and despeckled masks count against the memory budget,
+        # set in the GUI. Frames are spilled to disk before masks.
+        self.memory_budget = MemoryBudget()
+        self.full_images = self.memory_budget.add_store(FrameStore('frames'))
+        self.denoised_images = self.memory_budget.add_store(
+            FrameStore('masks',allow_downcast=True))
+        self.memory_budget.add_cache('histograms',self.histogram_cache_nbytes,
+                                     self.histogram_cache.clear)
         self.df_file = None
         self.base_dir = os.getcwd()
         # Default dir for troubleshooting purposes
@@ -243,7 +1397,7 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.configure_gui()
     def configure_gui(self):
         # Master Window
-        self.parent.title("Growth Rate Analysis")
+        self.winfo_toplevel().title("Growth Rate Analysis")
         #self.style = Style()
         #self.style.theme_use("default")
         # Set ttk style
@@ -290,6 +1444,14 @@ class GrowthRateAnalyzer(ttk.Frame):
                                 *['Date Modified','Filename (time=*s)'])
         self.e_time_source.grid(row=0,column=5)
         self.e_time_source.config(width=17)
+        # Memory budget for frames, masks and caches (blank = no limit)
+        ttk.Label(file_container,text="Memory budget (MB):").grid(row=0,column=6)
+        self.s_memory_budget = tk.StringVar()
+        self.s_memory_budget.set('')
+        self.e_memory_budget = ttk.Entry(file_container,textvariable=self.s_memory_budget,width=7)
+        self.e_memory_budget.grid(row=0,column=7)
+        self.l_memory = ttk.Label(file_container,text='Memory: 0 MB')
+        self.l_memory.grid(row=1,column=1,columnspan=7,sticky=W)
         
         # Set-up sample properties:
         self.configure_sample_props()
@@ -302,6 +1464,7 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.canvas.get_tk_widget().pack(fill=BOTH, expand=True)
         self.toolbar = NavigationToolbar2Tk(self.canvas, plotContainer)
         self.toolbar.update()
+        self.canvas.mpl_connect('pick_event',self.toggle_fit_point)
 
         # Crop Region buttons
         #self.fileDirLabel = ttk.Label(file_container, text = 'Pick image files')
@@ -348,6 +1511,106 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.b_save_results.grid(row=6, column=0, sticky=W)
         self.b_save_results.config(width=b_width)
         
+        # Watch the time series directory and process new frames as they are written
+        self.b_live_mode = ttk.Button(crop_container, command=self.toggle_live_mode)
+        self.b_live_mode.configure(text="Start Live Mode")
+        self.b_live_mode.grid(row=7, column=0, sticky=W)
+        self.b_live_mode.config(width=b_width)
+        
+        # Growth rates of every grain in the crop, without drawing directions
+        self.b_track_grains = ttk.Button(crop_container, command=self.track_grains_click)
+        self.b_track_grains.configure(text="Track All Grains")
+        self.b_track_grains.grid(row=8, column=0, sticky=W)
+        self.b_track_grains.config(width=b_width)
+        
+        # Growth rate vs. angle around the nucleation site (first point of the directions)
+        self.b_angular_map = ttk.Button(crop_container, command=self.angular_growth_map_click)
+        self.b_angular_map.configure(text="Angular Growth Map")
+        self.b_angular_map.grid(row=9, column=0, sticky=W)
+        self.b_angular_map.config(width=b_width)
+        
+        # Local front speed at every pixel, from the arrival map
+        self.b_velocity_field = ttk.Button(crop_container, command=self.velocity_field_click)
+        self.b_velocity_field.configure(text="Velocity Field")
+        self.b_velocity_field.grid(row=10, column=0, sticky=W)
+        self.b_velocity_field.config(width=b_width)
+        
+        # Find the fronts on kymographs of each line, with temporal continuity
+        self.bool_kymograph = tk.BooleanVar()
+        self.bool_kymograph.set(False)
+        self.e_kymograph = ttk.Checkbutton(crop_container,variable=self.bool_kymograph,
+                                           text='Kymograph Edges')
+        self.e_kymograph.grid(row=11, column=0, sticky=W)
+        
+        # Process frames larger than memory in tiles read from disk (Threshold Grain)
+        self.bool_tiled = tk.BooleanVar()
+        self.bool_tiled.set(False)
+        self.e_tiled = ttk.Checkbutton(crop_container,variable=self.bool_tiled,
+                                       text='Tiled (Large Frames)')
+        self.e_tiled.grid(row=12, column=0, sticky=W)
+        
+        # Find the fronts on 4x binned frames, refined at full resolution near the front
+        self.bool_coarse_to_fine = tk.BooleanVar()
+        self.bool_coarse_to_fine.set(False)
+        self.e_coarse_to_fine = ttk.Checkbutton(crop_container,variable=self.bool_coarse_to_fine,
+                                                text='Coarse-to-Fine Edges')
+        self.e_coarse_to_fine.grid(row=13, column=0, sticky=W)
+        
+        # Process a sparse subset of frames, adding frames until the growth rate
+        # uncertainty (um/s) is below the target
+        self.bool_adaptive_frames = tk.BooleanVar()
+        self.bool_adaptive_frames.set(False)
+        self.e_adaptive_frames = ttk.Checkbutton(crop_container,variable=self.bool_adaptive_frames,
+                                                 text='Adaptive Frames')
+        self.e_adaptive_frames.grid(row=14, column=0, sticky=W)
+        adaptive_container = ttk.Frame(crop_container)
+        adaptive_container.grid(row=15, column=0, sticky=W)
+        ttk.Label(adaptive_container,text='Rate Uncertainty (um/s)').pack(side=LEFT)
+        self.s_target_stderr = tk.StringVar()
+        self.s_target_stderr.set('0.01')
+        self.e_target_stderr = ttk.Entry(adaptive_container,textvariable=self.s_target_stderr,width=6)
+        self.e_target_stderr.pack(side=LEFT)
+        
+        # Follow the front from frame to frame, searching only as far as it can
+        # grow at the maximum velocity (um/s)
+        self.bool_track_fronts = tk.BooleanVar()
+        self.bool_track_fronts.set(False)
+        self.e_track_fronts = ttk.Checkbutton(crop_container,variable=self.bool_track_fronts,
+                                              text='Track Fronts')
+        self.e_track_fronts.grid(row=16, column=0, sticky=W)
+        tracking_container = ttk.Frame(crop_container)
+        tracking_container.grid(row=17, column=0, sticky=W)
+        ttk.Label(tracking_container,text='Max Velocity (um/s)').pack(side=LEFT)
+        self.s_max_velocity = tk.StringVar()
+        self.s_max_velocity.set('10')
+        self.e_max_velocity = ttk.Entry(tracking_container,textvariable=self.s_max_velocity,width=6)
+        self.e_max_velocity.pack(side=LEFT)
+        
+        # Move the crop region with the stage drift, so a tight crop can be used
+        drift_container = ttk.Frame(crop_container)
+        drift_container.grid(row=18, column=0, sticky=W)
+        ttk.Label(drift_container,text='Drift').pack(side=LEFT)
+        self.s_drift = tk.StringVar()
+        self.e_drift = ttk.OptionMenu(drift_container,self.s_drift,'None',
+                                      *['None','Automatic','Reference Points'])
+        self.e_drift.pack(side=LEFT)
+        
+        # Look up the fronts in the arrival map instead of every mask (Threshold Grain)
+        self.bool_arrival_map = tk.BooleanVar()
+        self.bool_arrival_map.set(False)
+        self.e_arrival_map = ttk.Checkbutton(crop_container,variable=self.bool_arrival_map,
+                                             text='Arrival Map Edges')
+        self.e_arrival_map.grid(row=19, column=0, sticky=W)
+        
+        # Time the image processing stages and show the breakdown after each run
+        self.bool_time_stages = tk.BooleanVar()
+        self.bool_time_stages.set(False)
+        self.e_time_stages = ttk.Checkbutton(crop_container,variable=self.bool_time_stages,
+                                             text='Time Stages')
+        self.e_time_stages.grid(row=20, column=0, sticky=W)
+        self.l_stage_times = ttk.Label(crop_container,text='',font='TkFixedFont',justify=LEFT)
+        self.l_stage_times.grid(row=21, column=0, sticky=W)
+        
         self.configure_subtract_fig()
 
         self.pack(fill=BOTH, expand=1)
@@ -532,6 +1795,40 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.b_check_threshold.configure(text="Check Threshold")
         self.b_check_threshold.grid(row=1, column=10, sticky=W)
 
+        # Automatic threshold from (multi-)Otsu levels of the first and last frames
+        ttk.Label(self.threshold_container,text="Classes").grid(row=0,column=11)
+        self.s_otsu_classes = tk.StringVar()
+        self.s_otsu_classes.set('2')
+        self.e_otsu_classes = ttk.Entry(self.threshold_container,textvariable=self.s_otsu_classes,width=5)
+        self.e_otsu_classes.grid(row=1,column=11)
+
+        self.b_auto_threshold = ttk.Button(self.threshold_container,
+                                    command=self.auto_threshold_click)
+        self.b_auto_threshold.configure(text="Auto Threshold")
+        self.b_auto_threshold.grid(row=1, column=12, sticky=W)
+
+        # Parameter sweep around the current settings
+        ttk.Label(self.threshold_container,text="Sweep (comma sep.):").grid(row=3,column=0)
+        ttk.Label(self.threshold_container,text="Shifts").grid(row=2,column=2,columnspan=2)
+        ttk.Label(self.threshold_container,text="Disks").grid(row=2,column=4)
+        ttk.Label(self.threshold_container,text="Clip Limits").grid(row=2,column=8)
+        self.s_sweep_shifts = tk.StringVar()
+        self.s_sweep_shifts.set('-10,-5,0,5,10')
+        self.e_sweep_shifts = ttk.Entry(self.threshold_container,textvariable=self.s_sweep_shifts,width=12)
+        self.e_sweep_shifts.grid(row=3,column=2,columnspan=2)
+        self.s_sweep_disks = tk.StringVar()
+        self.s_sweep_disks.set('3,5,8')
+        self.e_sweep_disks = ttk.Entry(self.threshold_container,textvariable=self.s_sweep_disks,width=8)
+        self.e_sweep_disks.grid(row=3,column=4)
+        self.s_sweep_clip_limits = tk.StringVar()
+        self.s_sweep_clip_limits.set('0.02,0.05,0.1')
+        self.e_sweep_clip_limits = ttk.Entry(self.threshold_container,textvariable=self.s_sweep_clip_limits,width=12)
+        self.e_sweep_clip_limits.grid(row=3,column=8,columnspan=2)
+        self.b_run_sweep = ttk.Button(self.threshold_container,
+                                    command=self.run_parameter_sweep)
+        self.b_run_sweep.configure(text="Run Sweep")
+        self.b_run_sweep.grid(row=3, column=10, sticky=W)
+
         self.rectangles=[]
         self.rectangle = Rectangle(
                             xy=(int(self.s_threshold_lower.get()),0),
@@ -673,6 +1970,8 @@ class GrowthRateAnalyzer(ttk.Frame):
         # If the prompt is canceled, returns empty string. Exit in this case.
         if files == '':
             return
+        self.load_series(files)
+    def load_series(self,files):
         # Reset initialization for other functions
         self.crop_initialized = False
         self.threshold_initialized = False
@@ -681,9 +1980,28 @@ class GrowthRateAnalyzer(ttk.Frame):
         if len(self.time_files)==1:
             raise Exception('Please select more than one image file')
         # Load images
-        self.full_images=['']*len(self.time_files)
-        for i,f in enumerate(self.time_files):
-            self.full_images[i] = imread(f,format='tiff-pil',pilmode='L')
+        t_start = self.start_stage_timing()
+        self.set_memory_budget()
+        self.full_images.clear()
+        self.denoised_images.clear()
+        self.histogram_cache.clear()
+        self.last_img_process_settings = {}
+        self.clear_derived_results()
+        for f in self.time_files:
+            if self.bool_tiled.get():
+                # Memory mapped where possible, tiles are read when processing
+                self.full_images.append(open_frame(f))
+            else:
+                with stage_timer.stage('decode'):
+                    self.full_images.append(imread(f,format='tiff-pil',pilmode='L'))
+        # The crop region is picked on a downsampled copy of large frames
+        if self.bool_tiled.get():
+            self.display_image,step = display_copy(self.full_images[-1])
+            print('Frames are memory mapped, shown at 1/{} resolution'.format(step))
+        else:
+            self.display_image = self.full_images[-1]
+        self.report_stage_times('Open Files',t_start)
+        self.update_memory_usage()
         # Try to find magnification and other metadata, if base_dir has changed
         new_base_dir = os.path.dirname(self.time_files[0])
         if not new_base_dir==self.base_dir:
@@ -737,13 +2055,15 @@ class GrowthRateAnalyzer(ttk.Frame):
     def pick_crop_region(self):
         # Zoom to region of interest in image. This will select crop region below
         # Pick the last time so the whole grain is contained within the crop region
-        img=imread(os.path.join(self.base_dir,self.time_files[-1]),format='tiff-pil',pilmode='L')
+        img=self.display_image
+        # Shown in the pixel coordinates of the full frame, also when downsampled
+        shape=self.full_images[-1].shape
         #img = exposure.rescale_intensity(img,in_range='image')
         img = exposure.equalize_adapthist(img,clip_limit=0.05)
         #fig,self.crop_ax=plt.subplots()
         #self.crop_fig, self.crop_ax = plt.subplots()
         if not self.crop_initialized:
-            self.cropData = self.ax[0].imshow(img)
+            self.cropData = self.ax[0].imshow(img,extent=(0,shape[1],shape[0],0))
             self.canvas.draw()
         else:
             # Remove old text, if exists
@@ -757,10 +2077,12 @@ class GrowthRateAnalyzer(ttk.Frame):
             except:
                 pass
             # Set new data
-            set_new_im_data(self.ax[0],self.cropData,img)
+            set_new_im_data(self.ax[0],self.cropData,img,shape=shape)
             self.canvas.draw()
         self.crop_initialized = True
         self.axes_ranges_initialized = False
+        # Directions have to be picked again for the new crop
+        self.__dict__.pop('linebuilder',None)
         # Reset threshold
         self.threshold_initialized = False
         #plt.show()
@@ -768,6 +2090,9 @@ class GrowthRateAnalyzer(ttk.Frame):
     def get_axes_ranges(self):
         x1,x2=self.ax[0].get_xlim()
         y2,y1=self.ax[0].get_ylim()
+        if not (int(x1),int(x2),int(y1),int(y2))==tuple(getattr(self,k,None) for k in ('x1','x2','y1','y2')):
+            # Tables and figures of the old crop
+            self.clear_derived_results()
         self.x1=int(x1)
         self.x2=int(x2)
         self.y2=int(y2)
@@ -782,6 +2107,76 @@ class GrowthRateAnalyzer(ttk.Frame):
         #                            ', y1 = ' + str(self.y1) +
         #                            ', y2 = ' + str(self.y2)))
         #print(x1,x2,y1,y2)
+    def crop_source(self,img):
+        '''
+        Frame and crop indices for previews and histograms of the crop region
+        Memory mapped frames (Tiled) are only read in the crop region, so their
+        contrast enhancement covers the crop rather than the whole frame
+        '''
+        if isinstance(img,np.memmap):
+            return (to_gray(np.asarray(img[self.y1:self.y2,self.x1:self.x2])),
+                    (0,self.x2-self.x1,0,self.y2-self.y1))
+        return img,(self.x1,self.x2,self.y1,self.y2)
+    def get_loaded_frame(self,time_file):
+        # Decoded frame of an opened file, or None if the file isn't loaded
+        try:
+            return self.full_images[self.time_files.index(time_file)]
+        except (AttributeError,ValueError):
+            return None
+    def get_shared_state(self):
+        '''
+        Files, crop region and growth directions, shared with the manual analyzer
+        Lines are returned in full image coordinates
+        '''
+        state = {'files':list(getattr(self,'time_files',[])),'crop':None,'lines':None}
+        if self.crop_initialized:
+            if not self.axes_ranges_initialized:
+                self.get_axes_ranges()
+            state['crop'] = (self.x1,self.x2,self.y1,self.y2)
+            if 'linebuilder' in self.__dict__:
+                self.get_line_segments()
+                state['lines'] = [[(x+self.x1,y+self.y1) for x,y in line] for line in self.lines]
+        return state
+    def set_shared_state(self,state):
+        # Opens the files, crop region and directions picked in the manual analyzer
+        if not state['files']:
+            return
+        if not sorted(state['files']) == sorted(getattr(self,'time_files',[])):
+            self.load_series(state['files'])
+        # Reference points picked in the manual analyzer, to follow stage drift
+        if state.get('reference_points') and not state['reference_points']==self.reference_points:
+            self.reference_points = state['reference_points']
+            if self.s_drift.get()=='Reference Points':
+                # Masks were cropped with the old drift
+                self.last_img_process_settings = {}
+        if state['crop'] is None:
+            return
+        if not self.crop_initialized:
+            self.pick_crop_region()
+        if not tuple(state['crop'])==tuple(getattr(self,k,None) for k in ('x1','x2','y1','y2')):
+            self.clear_derived_results()
+        self.x1,self.x2,self.y1,self.y2 = state['crop']
+        self.axes_ranges_initialized = True
+        self.threshold_initialized = False
+        if state['lines']:
+            # Directions are shown on the cropped last frame, as in draw_line_segments
+            for line in self.ax[0].lines:
+                line.remove()
+            img,(x1,x2,y1,y2) = self.crop_source(self.full_images[-1])
+            img = exposure.equalize_adapthist(img,clip_limit=0.05)
+            set_new_im_data(self.ax[0],self.cropData,img[y1:y2,x1:x2])
+            xs = [x-self.x1 for line in state['lines'] for x,y in line]
+            ys = [y-self.y1 for line in state['lines'] for x,y in line]
+            line, = self.ax[0].plot(xs,ys,'-or')
+            self.linebuilder = LineBuilder(line)
+            self.linebuilder.x1,self.linebuilder.y1 = xs[0],ys[0]
+            self.get_line_segments()
+        else:
+            self.ax[0].set_xlim(self.x1,self.x2)
+            self.ax[0].set_ylim(self.y2,self.y1)
+        self.ax[0].set_title('x1 = ' + str(self.x1)+', x2 = ' + str(self.x2) +
+                             ', y1 = ' + str(self.y1) + ', y2 = ' + str(self.y2))
+        self.canvas.draw()
     def eq_hist_cb_command(self):
         self.threshold_initialized=False
     def clear_threshold_ranges(self):
@@ -797,6 +2192,7 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.s_threshold_upper.set('')
         self.threshold_canvas.draw()
     def check_threshold(self):
+        t_start = self.start_stage_timing()
         # Update crop range
         if not self.axes_ranges_initialized:
             self.get_axes_ranges()
@@ -804,9 +2200,8 @@ class GrowthRateAnalyzer(ttk.Frame):
             self.threshold_initialized=False
             [b.remove() for b in self.threshold_plot_data[3][2]]
         if not self.threshold_initialized:
-            self.original_image=imread(os.path.join(self.base_dir,
-                                                  self.time_files[-1]),
-                                      format='tiff-pil',pilmode='L')
+            # The last frame is already loaded, so no second copy is decoded
+            self.original_image=self.full_images[-1]
             try:
                 [b.remove() for b in self.threshold_plot_data[3][2]]
             except:
@@ -819,12 +2214,14 @@ class GrowthRateAnalyzer(ttk.Frame):
         else:
             threshold_lower = float(self.s_threshold_lower.get())
             threshold_upper = float(self.s_threshold_upper.get())
+        img,crop = self.crop_source(self.full_images[-1])
         denoised,thresholded,cropped = threshold_crop_denoise(
                                       self.time_files[-1],
-                                      self.x1,self.x2,self.y1,self.y2,
+                                      *crop,
                                       threshold_lower,
                                       threshold_upper,
                                       int(self.s_disk.get()),
+                                      img=img,
                                       equalize_hist=self.bool_eq_hist.get(),
                                       multiple_ranges=self.bool_multi_ranges.get(),
                                       threshold_out=self.bool_threshold_out.get(),
@@ -833,25 +2230,79 @@ class GrowthRateAnalyzer(ttk.Frame):
 
         if not self.threshold_initialized:
             self.threshold_plot_data = ['']*4
-            self.threshold_plot_data[0] = self.threshold_ax[0].imshow(cropped,cmap=plt.get_cmap('gray'))
-            self.threshold_plot_data[1] = self.threshold_ax[1].imshow(thresholded,cmap=plt.get_cmap('gray'))
-            self.threshold_plot_data[2] = self.threshold_ax[2].imshow(denoised,cmap=plt.get_cmap('gray'))
+            with stage_timer.stage('plotting'):
+                self.threshold_plot_data[0] = self.threshold_ax[0].imshow(cropped,cmap=plt.get_cmap('gray'))
+                self.threshold_plot_data[1] = self.threshold_ax[1].imshow(thresholded,cmap=plt.get_cmap('gray'))
+                self.threshold_plot_data[2] = self.threshold_ax[2].imshow(denoised,cmap=plt.get_cmap('gray'))
             # Plot the histogram so we can select a good threshold for the grains
-            self.threshold_plot_data[3]=self.threshold_ax[3].hist(
-                    cropped.ravel(),bins=256,alpha=0.8,
-                    color=(228/255,26/255,28/255))
+            with stage_timer.stage('histogram'):
+                self.threshold_plot_data[3]=self.threshold_ax[3].hist(
+                        cropped.ravel(),bins=256,alpha=0.8,
+                        color=(228/255,26/255,28/255))
             self.threshold_ax[3].autoscale()
             # Set subplot titles
             self.threshold_ax[0].set_title('Original Image')
             self.threshold_ax[2].set_title('Despeckled')
             self.threshold_ax[3].set_title('Click and Drag \n to Select Threshold')
         elif self.threshold_initialized:
-            set_new_im_data(self.threshold_ax[1],self.threshold_plot_data[1],thresholded)
-            set_new_im_data(self.threshold_ax[2],self.threshold_plot_data[2],denoised)
+            with stage_timer.stage('plotting'):
+                set_new_im_data(self.threshold_ax[1],self.threshold_plot_data[1],thresholded)
+                set_new_im_data(self.threshold_ax[2],self.threshold_plot_data[2],denoised)
         self.threshold_ax[1].set_title('Thresholded Between \n' + self.s_threshold_lower.get() + ' and ' + self.s_threshold_upper.get())
-        self.threshold_canvas.draw()
+        with stage_timer.stage('plotting'):
+            self.threshold_canvas.draw()
         self.threshold_initialized = True
         self.last_clip_limit=self.s_clip_limit.get()
+        self.report_stage_times('Check Threshold',t_start)
+        self.update_memory_usage()
+
+    def histogram_cache_nbytes(self):
+        return sum(hist.nbytes + bin_edges.nbytes
+                   for hist,bin_edges in self.histogram_cache.values())
+    def get_cached_histogram(self,time_file):
+        # Histograms only depend on the file, crop and contrast settings, so they are
+        # computed once and reused when the thresholds are re-estimated
+        key = (time_file,(self.x1,self.x2,self.y1,self.y2),
+               self.bool_eq_hist.get(),self.s_clip_limit.get())
+        if key in self.histogram_cache:
+            self.histogram_cache_hits += 1
+        else:
+            self.histogram_cache_misses += 1
+            img,crop = self.crop_source(self.full_images[self.time_files.index(time_file)])
+            self.histogram_cache[key] = crop_histogram(
+                img,*crop,
+                equalize_hist=self.bool_eq_hist.get(),
+                clip_limit=float(self.s_clip_limit.get()))
+        return self.histogram_cache[key]
+    def auto_threshold_click(self):
+        # Update crop range
+        if not self.axes_ranges_initialized:
+            self.get_axes_ranges()
+        # First and last frames in time
+        file_times = [get_file_time(f,self.s_time_source.get(),t0_file=self.time_files[0])
+                      for f in self.time_files]
+        first_file = self.time_files[int(np.argmin(file_times))]
+        last_file = self.time_files[int(np.argmax(file_times))]
+        hist_first,bin_edges = self.get_cached_histogram(first_file)
+        hist_last = self.get_cached_histogram(last_file)[0]
+        threshold_lower,threshold_upper = histogram_threshold_ranges(
+            hist_first,hist_last,bin_edges,classes=int(self.s_otsu_classes.get()))
+        # Replace the current ranges with the proposed ones
+        self.clear_threshold_ranges()
+        self.bool_multi_ranges.set(len(threshold_lower)>1)
+        self.s_threshold_lower.set(','.join(['{:.1f}'.format(x) for x in threshold_lower]))
+        self.s_threshold_upper.set(','.join(['{:.1f}'.format(x) for x in threshold_upper]))
+        for lower,upper in zip(threshold_lower,threshold_upper):
+            rect = Rectangle(
+                        xy=(lower,0),width=(upper-lower),
+                        height=self.threshold_ax[3].get_ylim()[1],
+                        alpha=0.5,facecolor=(55/255,126/255,184/255),
+                        edgecolor=None)
+            self.rectangles.append(rect)
+            self.threshold_ax[3].add_patch(rect)
+        print('Auto threshold ranges: ' + self.s_threshold_lower.get()
+              + ' to ' + self.s_threshold_upper.get())
+        self.check_threshold()
 
     def check_subtraction(self):
         # Update crop range
@@ -861,9 +2312,7 @@ class GrowthRateAnalyzer(ttk.Frame):
             self.threshold_initialized=False
             [b.remove() for b in self.threshold_plot_data[3][2]]
         if not self.threshold_initialized:
-            self.original_image=imread(os.path.join(self.base_dir,
-                                                  self.time_files[-1]),
-                                      format='tiff-pil',pilmode='L')
+            self.original_image=self.full_images[-1]
             try:
                 [b.remove() for b in self.threshold_plot_data[3][2]]
             except:
@@ -1034,126 +2483,217 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.ax[0].plot(x_edge,y_edge,'ob')
         self.canvas.draw()
 
-    def extract_growth_rates(self):
-        # Update crop range
-        if not self.axes_ranges_initialized:
-            self.get_axes_ranges()
-        # Remove old data
-        self.ax[1].clear()
-        # Get growth directions
-        self.get_line_segments()
-        # Check if images dimensions are as expected. If not use image width
-        # Not very robust yet
-        img = self.full_images[-1]
-        if img.shape[1]==2048:
-            length_per_pixel = micron_per_pixel[self.s_mag.get()]
-        else:
-            length_per_pixel = image_width_microns[self.s_mag.get()]/img.shape[1]
+    def update_denoised_images(self):
+        '''
+        Thresholds (or subtracts) and despeckles every frame in time order into
+        self.denoised_images, unless the image processing settings are unchanged
+        Returns the settings, the processing time of each frame and the number of
+        frames reused from the previous run
+        '''
         # Check whether image processing settings have changed
         # If not, used stored copies of processed images
         current_img_process_settings = self.get_img_process_settings()
         # Get time from filenames, and sort by time
-        if not current_img_process_settings == self.last_img_process_settings:
-            self.extract_times_and_sort() # saves self.times and self.sort_indices
-        # Initialize distances array
-        self.distances = np.zeros((len(self.lines),len(self.times)))
+        # (also when reusing the masks, self.times may hold a subset of the frames)
+        self.extract_times_and_sort() # saves self.times and self.sort_indices
+        self.update_crop_windows()
         # Now process images if needed
+        frame_times = []
+        reused_frames = 0
         if not current_img_process_settings == self.last_img_process_settings:
-            self.denoised_images = ['']*len(self.times)
+            self.set_memory_budget()
+            self.denoised_images.clear()
+            self.clear_derived_results()
             for idx in range(0,len(self.times)):
-                sort_idx = self.sort_indices[idx]
-                timeFile = self.time_files[sort_idx]
-                if idx==0:
-                    t0=self.times[sort_idx]
-                    ti=0
-                else:
-                    ti = self.times[sort_idx]-t0
-                if self.s_edge_method.get()=='Threshold Grain':
-                    denoised = threshold_crop_denoise(self.time_files[sort_idx],
-                                                  self.x1,self.x2,self.y1,self.y2,
-                                                  current_img_process_settings['threshold_lower'],
-                                                  current_img_process_settings['threshold_upper'],
-                                                  int(self.s_disk.get()),
-                                                  img = self.full_images[sort_idx],
-                                                  equalize_hist=self.bool_eq_hist.get(),
-                                                  multiple_ranges=current_img_process_settings['multiple_ranges'],
-                                                  threshold_out=current_img_process_settings['threshold_out'],
-                                                  clip_limit=float(self.s_clip_limit.get())
-                                                  )[0]
-                elif self.s_edge_method.get()=='Subtract Images':
-                    denoised = subtract_and_denoise(
-                                            self.time_files[sort_idx],
-                                            self.time_files[self.sort_indices[idx+1]],
-                                            self.x1,self.x2,self.y1,self.y2,
-                                            int(self.s_disk.get()),
-                                            img1=self.full_images[sort_idx],
-                                            img2=self.full_images[self.sort_indices[idx+1]],
-                                            threshold=current_img_process_settings['threshold_lower'],
-                                            equalize_hist=self.bool_eq_hist.get(),
-                                            clip_limit=float(self.s_clip_limit.get()))[0]
-                self.denoised_images[idx] = denoised # save for speed if re-analyzing same area
+                frame_start = time.perf_counter()
+                denoised = self.process_frame(idx,current_img_process_settings)
+                self.denoised_images.append(denoised) # save for speed if re-analyzing same area
+                frame_times.append(time.perf_counter()-frame_start)
             self.last_img_process_settings = current_img_process_settings
-        # Now extract growth front at each time step
-        for idx,denoised in enumerate(self.denoised_images):
-            for line_idx in range(0,len(self.lines)):
-                self.distances[line_idx][idx] = get_growth_edge(
-                    denoised,self.lines[line_idx],
-                    length_per_pixel=length_per_pixel
-                    )
+        else:
+            reused_frames = len(self.denoised_images)
+        return current_img_process_settings,frame_times,reused_frames
+    def clear_derived_results(self):
+        # Drops the arrival map and the tables and figures computed from the masks,
+        # when the series, crop region or processing settings change, so Save
+        # Results never writes results of other masks
+        self.arrival_map = None
+        self.grain_table = None
+        self.angular_table = None
+        self.angular_fig = None
+        self.kymograph_fig = None
+        self.velocity_map = None
+        self.velocity_tables = {}
+        self.velocity_fig = None
+    def process_frame(self,idx,current_img_process_settings,tile_prefix=''):
+        # Despeckled mask of the idx-th frame in time order (subtracted from the
+        # next frame for Subtract Images)
+        sort_idx = self.sort_indices[idx]
+        x1,x2,y1,y2 = self.frame_crop(idx)
+        if self.s_edge_method.get()=='Threshold Grain' and current_img_process_settings['tiled']:
+            # Frames are read tile by tile from disk, and the masks written to disk
+            denoised = threshold_crop_denoise_tiled(
+                                          open_frame(self.time_files[sort_idx]),
+                                          x1,x2,y1,y2,
+                                          current_img_process_settings['threshold_lower'],
+                                          current_img_process_settings['threshold_upper'],
+                                          int(self.s_disk.get()),
+                                          self.get_tile_path(idx,tile_prefix),
+                                          equalize_hist=self.bool_eq_hist.get(),
+                                          multiple_ranges=current_img_process_settings['multiple_ranges'],
+                                          threshold_out=current_img_process_settings['threshold_out'],
+                                          clip_limit=float(self.s_clip_limit.get())
+                                          )
+        elif self.s_edge_method.get()=='Threshold Grain':
+            denoised = threshold_crop_denoise(self.time_files[sort_idx],
+                                          x1,x2,y1,y2,
+                                          current_img_process_settings['threshold_lower'],
+                                          current_img_process_settings['threshold_upper'],
+                                          int(self.s_disk.get()),
+                                          img = self.full_images[sort_idx],
+                                          equalize_hist=self.bool_eq_hist.get(),
+                                          multiple_ranges=current_img_process_settings['multiple_ranges'],
+                                          threshold_out=current_img_process_settings['threshold_out'],
+                                          clip_limit=float(self.s_clip_limit.get())
+                                          )[0]
+        elif self.s_edge_method.get()=='Subtract Images':
+            denoised = subtract_and_denoise(
+                                    self.time_files[sort_idx],
+                                    self.time_files[self.sort_indices[idx+1]],
+                                    x1,x2,y1,y2,
+                                    int(self.s_disk.get()),
+                                    img1=self.full_images[sort_idx],
+                                    img2=self.full_images[self.sort_indices[idx+1]],
+                                    threshold=current_img_process_settings['threshold_lower'],
+                                    equalize_hist=self.bool_eq_hist.get(),
+                                    clip_limit=float(self.s_clip_limit.get()),
+                                    crop2=self.frame_crop(idx+1))[0]
+        return denoised
+    def frame_crop(self,idx):
+        # Crop region of the idx-th frame in time order
+        if self.crop_windows is None:
+            return self.x1,self.x2,self.y1,self.y2
+        return self.crop_windows[idx]
+    def get_drift(self):
+        '''
+        Stage drift (dx,dy) in pixels of every frame in time order, relative to the
+        first, from the reference points picked in the manual analyzer or estimated
+        from the images. None when drift isn't followed.
+        '''
+        source = self.s_drift.get()
+        if source=='Automatic':
+            # Estimated once per series and crop region
+            key = (tuple(self.time_files),self.x1,self.x2,self.y1,self.y2)
+            if key not in self.drift_cache:
+                with stage_timer.stage('drift'):
+                    self.drift_cache = {key:estimate_drift(
+                        [self.full_images[sort_idx] for sort_idx in self.sort_indices],
+                        self.x1,self.x2,self.y1,self.y2)}
+            return self.drift_cache[key]
+        if source=='Reference Points':
+            picked = [f for f in self.time_files if f in self.reference_points]
+            if len(picked)==0:
+                print('No reference points picked in the manual analyzer, drift is not followed')
+                return None
+            ref_times = [get_file_time(f,self.s_time_source.get(),t0_file=self.time_files[0])
+                         for f in picked]
+            return reference_point_drift(self.sorted_file_times(),ref_times,
+                                         [self.reference_points[f][0] for f in picked],
+                                         [self.reference_points[f][1] for f in picked])
+        return None
+    def sorted_file_times(self):
+        # Times of all files in time order (self.times is one shorter for Subtract Images)
+        return np.array([get_file_time(self.time_files[sort_idx],self.s_time_source.get(),
+                                       t0_file=self.time_files[0])
+                         for sort_idx in self.sort_indices])
+    def update_crop_windows(self):
+        # Crop region of each frame following the drift. The crop region and
+        # directions are picked on the last loaded frame.
+        self.drift = self.get_drift()
+        if self.drift is None:
+            self.crop_windows = None
+            return
+        self.drift_reference = self.drift[self.sort_indices.index(len(self.time_files)-1)]
+        self.crop_windows,clamped = drift_crop_windows(self.drift,self.drift_reference,
+                                                       self.x1,self.x2,self.y1,self.y2,
+                                                       self.full_images[-1].shape)
+        if clamped.any():
+            print('The crop region reached the image edge in {} frames, so the grain '
+                  'is not aligned in them'.format(int(clamped.sum())))
+    def get_tile_path(self,idx,prefix=''):
+        # Memory mapped mask of frame idx written by tiled processing
+        if self.tile_dir is None:
+            self.tile_dir = tempfile.mkdtemp(prefix='growth_rate_tiles_')
+            atexit.register(shutil.rmtree,self.tile_dir,True)
+        return os.path.join(self.tile_dir,prefix+'{:06d}.npy'.format(idx))
+    def sorted_times(self):
+        # Times of self.denoised_images, both stored in time order
+        return np.array(self.times)[:len(self.denoised_images)]
+    def get_arrival_map(self):
+        # Arrival frame map of the current masks, built once per set of masks so
+        # redrawn or added directions are just lookups
+        if self.arrival_map is None:
+            with stage_timer.stage('arrival map'):
+                self.arrival_map = arrival_frame_map(self.denoised_images)
+        return self.arrival_map
+
+    def extract_growth_rates(self,all_frames=False):
+        # all_frames turns off the coarse-to-fine and adaptive frame modes, e.g.
+        # for live mode, which needs the masks of every frame
+        t_start = self.start_stage_timing()
+        # Update crop range
+        if not self.axes_ranges_initialized:
+            self.get_axes_ranges()
+        # Remove old data
+        self.ax[1].clear()
+        # Get growth directions
+        self.get_line_segments()
+        length_per_pixel = get_length_per_pixel(self.full_images[-1],self.s_mag.get())
+        self.kymograph_fig = None
+        tracking = not all_frames and self.use_front_tracking()
+        coarse_to_fine = not all_frames and not tracking and self.use_coarse_to_fine()
+        if tracking or coarse_to_fine or (not all_frames and self.bool_adaptive_frames.get()):
+            # Only some frames, or the band around the front, are processed, so
+            # there are no masks to store
+            current_img_process_settings,frame_times = self.frame_subset_distances(
+                length_per_pixel,coarse_to_fine=coarse_to_fine,tracking=tracking)
+            reused_frames = 0
+        else:
+            current_img_process_settings,frame_times,reused_frames = self.update_denoised_images()
+            self.extract_growth_distances(current_img_process_settings,length_per_pixel)
         
         # Could break this into separate function, for updating plot
+        self.times = np.array(self.times)
+        # fit_mask holds the points used in the fit of each line. Clicking a point toggles it.
+        with stage_timer.stage('fit'):
+            self.growth_fit,self.fit_mask = fit_distances(self.times,self.distances)
+            slopes,intercepts,stderrs = self.growth_fit.get_params()
+        plot_start = time.perf_counter()
         self.growth_rates=[]
         self.growth_rates_string=[]
         self.growth_lines_fit=['']*len(self.lines)
         self.growth_lines=['']*len(self.lines)
+        self.excluded_lines=['']*len(self.lines)
         c_idx=-1
         for line_idx,line in enumerate(self.lines):
             c_idx +=1
             if c_idx>9:
                 c_idx=0
-            # print(self.times)
-            # print(self.distances)
-            # x,y,filterIdx=cleanSignal_curvature(self.times,self.distances[line_idx],
-                               # curvature_threshold = 0.004,
-                               # return_index=True,remove_less_than=1)
-            # print(filterIdx)
-            # Filter out points that are:
-                # less than 80% of the median of the first three points, 
-                # 5% greater than the median of the last three points
-            # old routine filtering less than 10% of the mean
-                # self.distances[line_idx]>np.mean(self.distances[line_idx])*0.1 
-            # This filtering could be smarter. Could add derivative filtering, or could
-            # iteratively fit and reject points with large MSE
-            # logical_and.reduce((condition1,condition2,...,conditionN)) is used so that
-            # more than two conditions can be added (logical_and only accepts one arg)
-            # See https://stackoverflow.com/questions/20528328/numpy-logical-or-for-more-than-two-arguments
-            filterIdx = np.where(np.logical_and.reduce(
-                (self.distances[line_idx]>np.median(self.distances[line_idx][0:3])*0.8,
-                self.distances[line_idx]<np.median(self.distances[line_idx][-3:])*1.05,
-                )))[0]
-            # Check for empty filter results, if so return full array
-            if len(filterIdx)==0:
-                filterIdx = np.arange(0,len(self.times))
-            self.times = np.array(self.times)
-            # Fit the data with a line
-            params = np.polyfit(self.times[filterIdx], self.distances[line_idx][filterIdx], 1)
-            line1,=self.ax[1].plot(self.times,np.array(self.times)*params[0]+params[1],'--',
+            params = (slopes[line_idx],intercepts[line_idx])
+            self.growth_lines_fit[line_idx],=self.ax[1].plot(self.times,np.array(self.times)*params[0]+params[1],'--',
                 color=Tableau_10.mpl_colors[c_idx],linewidth=1.5)
-            self.growth_lines_fit.append(line1)
             self.ax[1].set_xlabel('Time (s)')
             self.ax[1].set_ylabel('Grain Radius ($\mu$m)')
             print('{:.2f}'.format(params[0])+' micron/sec')
             self.growth_rates_string.append('{:.2f}'.format(params[0])+' micron/sec')
             self.growth_rates.append(params[0])
-            # Make legend label, decide units based on size of value
-            if params[0]>10:
-                label_string = '#' + str(line_idx+1) + ', ' + '{:.1f}'.format(params[0])+' $\mu$m/s'
-            elif params[0]>0.1:
-                label_string = '#' + str(line_idx+1) + ', ' + '{:.2f}'.format(params[0])+' $\mu$m/s'
-            else:
-                label_string = '#' + str(line_idx+1) + ', ' + '{:.1f}'.format(params[0]*1e3)+' nm/s'
+            label_string = growth_rate_label(line_idx,params[0])
             self.growth_lines[line_idx],=self.ax[1].plot(self.times,self.distances[line_idx],'o',color=Tableau_10.mpl_colors[c_idx],
-                label=label_string)
+                label=label_string,picker=5)
+            # Points left out of the fit are marked with an x
+            excluded = ~self.fit_mask[line_idx]
+            self.excluded_lines[line_idx],=self.ax[1].plot(self.times[excluded],self.distances[line_idx][excluded],'x',
+                color='k',ms=4)
         self.legend = self.ax[1].legend(bbox_to_anchor=(1.0, 1.0),
                     title='click line to remove')
         # Need to figure out best way to modify data between the two classes
@@ -1164,7 +2704,596 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.ax[1].relim()
         self.canvas.draw()
         self.label_lines()
-
+        if stage_timer.enabled:
+            stage_timer.record('plotting',time.perf_counter()-plot_start)
+        self.report_stage_times('Extract Growth Rates',t_start)
+        self.log_extraction_run(current_img_process_settings,t_start,frame_times,reused_frames)
+        self.update_memory_usage()
+
+    def extract_growth_distances(self,current_img_process_settings,length_per_pixel):
+        # Growth front at each time step along each line, from self.denoised_images
+        if self.bool_kymograph.get():
+            with stage_timer.stage('profile sampling'):
+                kymographs = line_kymographs(self.denoised_images,self.lines)
+                self.distances,fronts = kymograph_front_distances(kymographs,self.lines,
+                                                                  length_per_pixel)
+            self.kymograph_fig = self.plot_kymographs(kymographs,fronts)
+        elif self.use_arrival_map(current_img_process_settings):
+            # The front along every line is looked up in the arrival map
+            arrival = self.get_arrival_map()
+            with stage_timer.stage('profile sampling'):
+                self.distances = arrival_path_distances(arrival,self.lines,
+                                                        len(self.denoised_images),length_per_pixel)
+        else:
+            self.distances = compute_distances(self.denoised_images,self.lines,length_per_pixel)
+    def use_arrival_map(self,settings):
+        # Subtracted images mark only the newly grown area, so they have no arrival map
+        return (self.bool_arrival_map.get() and settings['method']=='Threshold Grain'
+                and not self.bool_kymograph.get())
+    def use_front_tracking(self):
+        if not self.bool_track_fronts.get():
+            return False
+        if not self.s_edge_method.get()=='Threshold Grain':
+            print('Front tracking needs the Threshold Grain method, processing the full crop')
+            return False
+        return True
+    def use_coarse_to_fine(self):
+        if not self.bool_coarse_to_fine.get():
+            return False
+        if not self.s_edge_method.get()=='Threshold Grain' or self.bool_eq_hist.get():
+            print('Coarse-to-fine edges need Threshold Grain without histogram equalization, '
+                  'processing the full crop')
+            return False
+        return True
+    def frame_front_distances(self,idx,current_img_process_settings,length_per_pixel,
+                              coarse_to_fine=False,factor=4):
+        # Growth front distance along each line in the idx-th frame in time order,
+        # without storing the mask
+        if coarse_to_fine:
+            x1,x2,y1,y2 = self.frame_crop(idx)
+            return coarse_to_fine_distances(
+                self.full_images[self.sort_indices[idx]],x1,x2,y1,y2,
+                self.lines,length_per_pixel,current_img_process_settings['threshold_lower'],
+                current_img_process_settings['threshold_upper'],
+                current_img_process_settings['disk'],factor=factor,
+                threshold_out=current_img_process_settings['threshold_out'],
+                multiple_ranges=current_img_process_settings['multiple_ranges'])
+        denoised = self.process_frame(idx,current_img_process_settings,tile_prefix='subset_')
+        return [get_growth_edge(denoised,line,length_per_pixel) for line in self.lines]
+    def frame_subset_distances(self,length_per_pixel,coarse_to_fine=False,tracking=False):
+        '''
+        Growth front distances in self.distances, without storing the masks, from
+        front tracking, the coarse-to-fine search and/or an adaptive subset of the frames
+        With adaptive frames, self.times holds the times of the processed frames.
+        Returns the settings and the processing time of each frame
+        '''
+        current_img_process_settings = self.get_img_process_settings()
+        self.extract_times_and_sort()
+        self.update_crop_windows()
+        # Masks, arrival map and velocity map of an earlier run on every frame would
+        # otherwise be saved with the times of this run
+        self.denoised_images.clear()
+        self.last_img_process_settings = {}
+        self.clear_derived_results()
+        frame_times = []
+        if tracking:
+            if self.bool_adaptive_frames.get():
+                print('Front tracking processes every frame in time order, adaptive frames are ignored')
+            max_velocity = float(self.s_max_velocity.get())
+            def timed_frames():
+                for sort_idx in self.sort_indices[:len(self.times)]:
+                    frame_start = time.perf_counter()
+                    yield self.full_images[sort_idx]
+                    frame_times.append(time.perf_counter()-frame_start)
+            self.distances,clipped = track_front_distances(
+                timed_frames(),np.array(self.times),self.x1,self.x2,self.y1,self.y2,
+                self.lines,length_per_pixel,current_img_process_settings['threshold_lower'],
+                current_img_process_settings['threshold_upper'],
+                current_img_process_settings['disk'],max_velocity,
+                equalize_hist=current_img_process_settings['equalize_hist'],
+                threshold_out=current_img_process_settings['threshold_out'],
+                multiple_ranges=current_img_process_settings['multiple_ranges'],
+                clip_limit=current_img_process_settings['clip_limit'],
+                crop_windows=self.crop_windows)
+            if clipped.any():
+                print('{} fronts moved further than the maximum velocity allows, and were '
+                      'placed at the edge of the search window'.format(int(clipped.sum())))
+            current_img_process_settings['max_velocity'] = max_velocity
+            return current_img_process_settings,frame_times
+        def frame_distances(idx):
+            frame_start = time.perf_counter()
+            distances = self.frame_front_distances(idx,current_img_process_settings,
+                                                   length_per_pixel,coarse_to_fine=coarse_to_fine)
+            frame_times.append(time.perf_counter()-frame_start)
+            return distances
+        if coarse_to_fine:
+            current_img_process_settings['coarse_to_fine'] = 4
+        if self.bool_adaptive_frames.get():
+            times = np.array(self.times)
+            target_stderr = float(self.s_target_stderr.get())
+            distances,processed = adaptive_frame_distances(times,frame_distances,target_stderr,
+                                                           tolerance=length_per_pixel)
+            self.times = list(times[processed])
+            self.distances = distances[:,processed]
+            print('Adaptive frames: processed {} of {} frames, skipped {}'.format(
+                int(processed.sum()),len(times),int(len(times)-processed.sum())))
+            current_img_process_settings['adaptive_target_stderr'] = target_stderr
+            current_img_process_settings['frames_skipped'] = int(len(times)-processed.sum())
+        else:
+            self.distances = np.array([frame_distances(idx)
+                                       for idx in range(0,len(self.times))]).T
+        return current_img_process_settings,frame_times
+    def plot_kymographs(self,kymographs,fronts):
+        # Kymograph of each line with the detected front, saved by Save Results
+        times = self.sorted_times()
+        fig = Figure(figsize=(2.5*len(kymographs)+1,4))
+        FigureCanvasAgg(fig)
+        axes = np.atleast_1d(fig.subplots(ncols=len(kymographs),sharey=True))
+        for line_idx,(ax,kymograph) in enumerate(zip(axes,kymographs)):
+            ax.imshow(kymograph,aspect='auto',cmap='gray',interpolation='nearest',
+                      extent=(-0.5,kymograph.shape[1]-0.5,len(times)-0.5,-0.5))
+            ax.plot(fronts[line_idx],np.arange(0,len(times)),'-',
+                    color=Tableau_10.mpl_colors[line_idx%10])
+            ax.set_title('#'+str(line_idx+1))
+            ax.set_xlabel('Position (pixels)')
+        axes[0].set_ylabel('Frame')
+        return fig
+    def track_grains_click(self):
+        # Labels the grains in every despeckled mask, follows them through time
+        # and fits the area equivalent radius of each grain
+        if not self.s_edge_method.get()=='Threshold Grain':
+            print('Grain tracking is only available for the Threshold Grain method')
+            return
+        t_start = self.start_stage_timing()
+        if not self.axes_ranges_initialized:
+            self.get_axes_ranges()
+        self.update_denoised_images()
+        times = self.sorted_times()
+        length_per_pixel = get_length_per_pixel(self.full_images[-1],self.s_mag.get())
+        with stage_timer.stage('grain tracking'):
+            radii,touches_edge,track_map = track_grains(self.denoised_images,length_per_pixel)
+        with stage_timer.stage('fit'):
+            slopes,intercepts,stderrs = grain_growth_rates(radii,times)
+        self.grain_table = pd.DataFrame({'grain':np.arange(1,len(slopes)+1),
+                                         'growth_rate_umps':slopes,
+                                         'growth_rate_stderr_umps':stderrs,
+                                         'frames':np.count_nonzero(~np.isnan(radii),axis=1),
+                                         'final_radius_um':[r[~np.isnan(r)][-1] for r in radii],
+                                         'touches_crop_edge':touches_edge})
+        # Grains cut off by the crop are left out, since their area is too small
+        valid = np.flatnonzero(np.logical_and(~np.isnan(slopes),~touches_edge))
+        print(str(len(valid)) + ' grains tracked (' + str(np.count_nonzero(touches_edge))
+              + ' touching the crop edge left out)')
+        # Plot radius vs. time of each grain
+        self.ax[1].clear()
+        for c_idx,grain_idx in enumerate(valid):
+            color = Tableau_10.mpl_colors[c_idx%10]
+            self.ax[1].plot(times,radii[grain_idx],'o',color=color,ms=3,
+                            label=growth_rate_label(grain_idx,slopes[grain_idx]))
+            self.ax[1].plot(times,times*slopes[grain_idx]+intercepts[grain_idx],'--',
+                            color=color,linewidth=1)
+        self.ax[1].set_xlabel('Time (s)')
+        self.ax[1].set_ylabel('Grain Radius ($\mu$m)')
+        if 0<len(valid)<=10:
+            self.ax[1].legend(bbox_to_anchor=(1.0, 1.0))
+        # Number the grains on the last mask
+        for line in self.ax[0].lines:
+            line.remove()
+        for txt in getattr(self,'line_texts',[]):
+            txt.remove()
+        self.line_texts = []
+        set_new_im_data(self.ax[0],self.cropData,self.denoised_images[-1])
+        centers = ndimage.center_of_mass(track_map>=0,track_map,valid)
+        for grain_idx,(y,x) in zip(valid,centers):
+            # Grains that merged into another one are no longer in the last mask
+            if np.isnan(x):
+                continue
+            self.line_texts.append(self.ax[0].text(x,y,str(grain_idx+1),color='red',
+                                                   ha='center',va='center',weight='bold'))
+        self.ax[0].set_title('')
+        self.canvas.draw()
+        self.report_stage_times('Track All Grains',t_start)
+        self.update_memory_usage()
+
+    def get_nucleation_site(self):
+        # First point clicked with Pick Directions, otherwise the center of the
+        # first grain to appear in the masks
+        linebuilder = getattr(self,'linebuilder',None)
+        if linebuilder is not None and len(linebuilder.xs)>0:
+            return linebuilder.xs[0],linebuilder.ys[0]
+        for mask in self.denoised_images:
+            if np.any(mask):
+                y,x = ndimage.center_of_mass(np.asarray(mask)>0)
+                return x,y
+        return None
+    def angular_growth_map_click(self):
+        # Unwraps every mask around the nucleation site and fits the front radius
+        # of each angle bin, giving the growth rate vs. angle
+        if not self.s_edge_method.get()=='Threshold Grain':
+            print('The angular growth map is only available for the Threshold Grain method')
+            return
+        t_start = self.start_stage_timing()
+        if not self.axes_ranges_initialized:
+            self.get_axes_ranges()
+        self.update_denoised_images()
+        center = self.get_nucleation_site()
+        if center is None:
+            print('No grain found in the masks, check the threshold')
+            return
+        times = self.sorted_times()
+        length_per_pixel = get_length_per_pixel(self.full_images[-1],self.s_mag.get())
+        angles,radii,slopes,intercepts,stderrs = angular_growth_rates(
+            self.denoised_images,times,center,length_per_pixel,
+            arrival=self.get_arrival_map())
+        self.angular_table = pd.DataFrame({'angle_deg':angles,
+                                           'growth_rate_umps':slopes,
+                                           'growth_rate_stderr_umps':stderrs,
+                                           'frames':np.count_nonzero(~np.isnan(radii),axis=1),
+                                           'center_x':center[0]+self.x1,
+                                           'center_y':center[1]+self.y1})
+        valid = ~np.isnan(slopes)
+        print('Angular growth map: ' + str(np.count_nonzero(valid)) + ' of '
+              + str(len(angles)) + ' angle bins fit')
+        plot_start = time.perf_counter()
+        self.plot_angular_growth_map(angles,slopes,stderrs,radii,times)
+        if stage_timer.enabled:
+            stage_timer.record('plotting',time.perf_counter()-plot_start)
+        self.report_stage_times('Angular Growth Map',t_start)
+        self.update_memory_usage()
+    def velocity_field_click(self):
+        # Local front speed (1/|grad T|) of the smoothed arrival time map, with
+        # statistics per grain (grains of the last mask) and per growth direction
+        if not self.s_edge_method.get()=='Threshold Grain':
+            print('The velocity field is only available for the Threshold Grain method')
+            return
+        t_start = self.start_stage_timing()
+        if not self.axes_ranges_initialized:
+            self.get_axes_ranges()
+        self.update_denoised_images()
+        arrival = self.get_arrival_map()
+        length_per_pixel = get_length_per_pixel(self.full_images[-1],self.s_mag.get())
+        with stage_timer.stage('velocity field'):
+            speed,direction = velocity_field(arrival,self.sorted_times(),length_per_pixel)
+            labels,n_grains = label_grains(self.denoised_images[-1],min_area=20)
+            grain_stats = group_statistics(speed,labels-1,n_grains)
+            n_direction_bins = 12
+            bin_width = 360/n_direction_bins
+            direction_bins = np.where(np.isnan(direction),-1,
+                                      (np.nan_to_num(direction)//bin_width)).astype(np.intp)
+            direction_stats = group_statistics(speed,direction_bins,n_direction_bins)
+        self.velocity_map = speed
+        columns = [('pixels','pixels'),('mean','mean_speed_umps'),
+                   ('median','median_speed_umps'),('std','std_speed_umps')]
+        self.velocity_tables = {
+            'velocity_by_grain':pd.DataFrame(OrderedDict(
+                [('grain',np.arange(1,n_grains+1))]
+                + [(name,grain_stats[key]) for key,name in columns])),
+            'velocity_by_direction':pd.DataFrame(OrderedDict(
+                [('direction_deg',np.arange(0,n_direction_bins)*bin_width+bin_width/2)]
+                + [(name,direction_stats[key]) for key,name in columns]))}
+        print('Median front speed: ' + '{:.3g}'.format(np.nanmedian(speed)) + ' um/s')
+        plot_start = time.perf_counter()
+        self.plot_velocity_field(speed,labels,direction_stats,bin_width)
+        if stage_timer.enabled:
+            stage_timer.record('plotting',time.perf_counter()-plot_start)
+        self.report_stage_times('Velocity Field',t_start)
+        self.update_memory_usage()
+    def plot_velocity_field(self,speed,labels,direction_stats,bin_width):
+        # Speed map with the grains numbered, and the median speed vs. direction
+        window = tk.Toplevel(self.parent)
+        window.title('Velocity Field')
+        self.velocity_fig = Figure(figsize=(10,4))
+        ax_map = self.velocity_fig.add_subplot(1,2,1)
+        ax_polar = self.velocity_fig.add_subplot(1,2,2,projection='polar')
+        self.velocity_fig.subplots_adjust(wspace=0.35,bottom=0.15)
+        # Clip the color scale, single pixels with tiny gradients are very fast
+        finite = speed[~np.isnan(speed)]
+        vmax = np.percentile(finite,99) if len(finite)>0 else None
+        im = ax_map.imshow(speed,vmin=0,vmax=vmax)
+        self.velocity_fig.colorbar(im,ax=ax_map,label='Front Speed ($\mu$m/s)')
+        if labels.max()>0:
+            grains = np.arange(1,labels.max()+1)
+            for grain,(y,x) in zip(grains,ndimage.center_of_mass(labels>0,labels,grains)):
+                ax_map.text(x,y,str(grain),color='red',ha='center',va='center',weight='bold')
+        ax_map.axis('off')
+        theta = np.deg2rad(np.arange(0,len(direction_stats['median']))*bin_width)
+        ax_polar.bar(theta,direction_stats['median'],width=np.deg2rad(bin_width),
+                     align='edge',color=Tableau_10.mpl_colors[0],alpha=0.7)
+        ax_polar.set_title('Median Speed vs. Direction ($\mu$m/s)')
+        canvas = FigureCanvasTkAgg(self.velocity_fig, master=window)
+        canvas.draw()
+        canvas.get_tk_widget().pack(fill=BOTH, expand=True)
+    def plot_angular_growth_map(self,angles,slopes,stderrs,radii,times):
+        # Rate vs. angle on polar axes, and the front radius of every angle bin
+        # vs. time as an image
+        window = tk.Toplevel(self.parent)
+        window.title('Angular Growth Map')
+        self.angular_fig = Figure(figsize=(10,4))
+        ax_polar = self.angular_fig.add_subplot(1,2,1,projection='polar')
+        ax_radii = self.angular_fig.add_subplot(1,2,2)
+        self.angular_fig.subplots_adjust(wspace=0.35,bottom=0.15)
+        theta = np.deg2rad(angles)
+        ax_polar.plot(theta,slopes,'-',color=Tableau_10.mpl_colors[0])
+        ax_polar.fill_between(theta,slopes-stderrs,slopes+stderrs,
+                              color=Tableau_10.mpl_colors[0],alpha=0.3,linewidth=0)
+        ax_polar.set_title('Growth Rate ($\mu$m/s)')
+        im = ax_radii.imshow(radii,aspect='auto',origin='lower',
+                             extent=(times[0],times[-1],angles[0],angles[-1]))
+        ax_radii.set_xlabel('Time (s)')
+        ax_radii.set_ylabel('Angle (deg)')
+        self.angular_fig.colorbar(im,ax=ax_radii,label='Front Radius ($\mu$m)')
+        canvas = FigureCanvasTkAgg(self.angular_fig, master=window)
+        canvas.draw()
+        canvas.get_tk_widget().pack(fill=BOTH, expand=True)
+
+    def toggle_live_mode(self):
+        if self.live_mode_on:
+            self.stop_live_mode()
+        else:
+            self.start_live_mode()
+    def start_live_mode(self):
+        # Live mode watches the directory of the opened files while the microscope
+        # is still acquiring. Crop, directions and threshold settings must be picked
+        # on the frames which already exist before starting.
+        # Run the normal extraction once to process the existing frames and set up plots
+        self.extract_growth_rates(all_frames=True)
+        self.live_dir = os.path.dirname(self.time_files[0])
+        self.live_extension = os.path.splitext(self.time_files[0])[1]
+        self.live_seen_files = set(self.time_files)
+        # Files which have appeared but may still be being written {path:size}
+        self.live_pending_files = {}
+        self.live_last_time = get_file_time(self.time_files[self.sort_indices[-1]],
+                                         self.s_time_source.get(),
+                                         t0_file=self.time_files[0])
+        # Only the data points, fits and legend change as frames arrive, so these
+        # are drawn with blitting on top of a cached background
+        self.live_artists = (self.growth_lines + self.growth_lines_fit
+                           + self.excluded_lines + [self.legend])
+        for artist in self.live_artists:
+            artist.set_animated(True)
+        self.live_background = None
+        self.live_draw_cid = self.canvas.mpl_connect('draw_event',self.on_live_draw)
+        self.canvas.draw()
+        self.live_mode_on = True
+        self.b_live_mode.configure(text="Stop Live Mode")
+        self.live_after_id = self.after(live_poll_ms,self.poll_live_directory)
+    def stop_live_mode(self):
+        self.live_mode_on = False
+        try:
+            self.after_cancel(self.live_after_id)
+        except:
+            pass
+        self.canvas.mpl_disconnect(self.live_draw_cid)
+        for artist in self.live_artists:
+            artist.set_animated(False)
+        self.b_live_mode.configure(text="Start Live Mode")
+        self.canvas.draw()
+    def on_live_draw(self,event):
+        # Full redraws (new axes limits, window resize, zoom) invalidate the background
+        self.live_background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_live_artists()
+    def draw_live_artists(self):
+        for artist in self.live_artists:
+            self.fig.draw_artist(artist)
+    def poll_live_directory(self):
+        if not self.live_mode_on:
+            return
+        files = glob.glob(os.path.join(self.live_dir,'*'+self.live_extension))
+        ready_files = []
+        for f in files:
+            if f in self.live_seen_files:
+                continue
+            # Wait until the file size stops changing before reading it
+            size = os.path.getsize(f)
+            if self.live_pending_files.get(f) == size and size > 0:
+                ready_files.append(f)
+            else:
+                self.live_pending_files[f] = size
+        if ready_files:
+            # Process new frames in time order
+            ready_files.sort(key=lambda f: get_file_time(f,self.s_time_source.get(),
+                                                      t0_file=self.time_files[0]))
+            for f in ready_files:
+                try:
+                    img = imread(f,format='tiff-pil',pilmode='L')
+                except Exception:
+                    # Probably still being written, try again on the next poll
+                    continue
+                del self.live_pending_files[f]
+                self.live_seen_files.add(f)
+                self.process_live_frame(f,img)
+            self.update_live_plot()
+        self.live_after_id = self.after(live_poll_ms,self.poll_live_directory)
+    def process_live_frame(self,time_file,img):
+        settings = self.last_img_process_settings
+        t_new = get_file_time(time_file,self.s_time_source.get(),t0_file=self.time_files[0])
+        # Index of the previous latest frame, used for image subtraction
+        prev_idx = self.sort_indices[-1]
+        px1,px2,py1,py2 = self.frame_crop(len(self.sort_indices)-1)
+        self.time_files.append(time_file)
+        self.full_images.append(img)
+        self.sort_indices.append(len(self.time_files)-1)
+        if self.drift is not None:
+            self.add_live_crop_window(img)
+        x1,x2,y1,y2 = self.frame_crop(len(self.sort_indices)-1)
+        if settings['method']=='Threshold Grain':
+            denoised = threshold_crop_denoise(time_file,
+                                          x1,x2,y1,y2,
+                                          settings['threshold_lower'],
+                                          settings['threshold_upper'],
+                                          settings['disk'],
+                                          img = img,
+                                          equalize_hist=settings['equalize_hist'],
+                                          multiple_ranges=settings['multiple_ranges'],
+                                          threshold_out=settings['threshold_out'],
+                                          clip_limit=settings['clip_limit']
+                                          )[0]
+            t_point = t_new
+        elif settings['method']=='Subtract Images':
+            denoised = subtract_and_denoise(
+                                    self.time_files[prev_idx],time_file,
+                                    px1,px2,py1,py2,
+                                    settings['disk'],
+                                    img1=self.full_images[prev_idx],img2=img,
+                                    threshold=settings['threshold_lower'],
+                                    equalize_hist=settings['equalize_hist'],
+                                    clip_limit=settings['clip_limit'],
+                                    crop2=(x1,x2,y1,y2))[0]
+            # Subtraction points are assigned the time of the earlier image
+            t_point = self.live_last_time
+        self.live_last_time = t_new
+        # Tables and figures of the earlier frames are out of date, the arrival map
+        # is updated below
+        arrival_map = self.arrival_map
+        self.clear_derived_results()
+        self.arrival_map = arrival_map
+        self.denoised_images.append(denoised)
+        if self.arrival_map is not None and settings['method']=='Threshold Grain':
+            update_arrival_map(self.arrival_map,denoised,len(self.denoised_images)-1)
+        self.times = np.append(self.times,t_point)
+        # Append new distance point for each line, found the same way as the
+        # distances of the frames before live mode (see extract_growth_distances)
+        length_per_pixel = get_length_per_pixel(img,self.s_mag.get())
+        if self.arrival_map is not None and self.use_arrival_map(settings):
+            new_distances = arrival_path_distances(self.arrival_map,self.lines,
+                                                   len(self.denoised_images),length_per_pixel)[:,-1:]
+        else:
+            new_distances = np.zeros((len(self.lines),1))
+            for line_idx in range(0,len(self.lines)):
+                new_distances[line_idx] = get_growth_edge(
+                    denoised,self.lines[line_idx],length_per_pixel=length_per_pixel)
+        self.distances = np.hstack((self.distances,new_distances))
+        # Apply the same filter as extract_growth_rates to the new point only
+        new_mask = np.logical_and(
+            new_distances[:,0]>np.median(self.distances[:,0:3],axis=1)*0.8,
+            new_distances[:,0]<np.median(self.distances[:,-3:],axis=1)*1.05)
+        self.fit_mask = np.hstack((self.fit_mask,new_mask[:,np.newaxis]))
+        self.growth_fit.add(t_point,np.where(new_mask,new_distances[:,0],np.nan))
+    def add_live_crop_window(self,img):
+        # Crop region of a new frame in live mode. Automatic drift compares it with
+        # the first frame; with reference points the last drift is kept.
+        if self.s_drift.get()=='Automatic':
+            first = self.full_images[self.sort_indices[0]]
+            drift = estimate_drift([first,img],self.x1,self.x2,self.y1,self.y2)[1]
+        else:
+            drift = self.drift[-1]
+        self.drift = np.vstack((self.drift,drift))
+        windows,clamped = drift_crop_windows([drift],self.drift_reference,self.x1,self.x2,
+                                             self.y1,self.y2,img.shape)
+        self.crop_windows.append(windows[0])
+    def update_live_plot(self):
+        for line_idx in range(0,len(self.lines)):
+            self.growth_lines[line_idx].set_data(self.times,self.distances[line_idx])
+        self.update_fit_artists()
+        # A full redraw is only needed if the new points fall outside the axes
+        xlim = self.ax[1].get_xlim()
+        ylim = self.ax[1].get_ylim()
+        if (np.amax(self.times)>xlim[1] or np.amax(self.distances)>ylim[1]
+                or self.live_background is None):
+            self.ax[1].relim()
+            self.ax[1].autoscale_view()
+            # on_live_draw re-caches the background and draws the live artists
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.live_background)
+            self.draw_live_artists()
+        self.canvas.blit(self.fig.bbox)
+        self.canvas.flush_events()
+        self.update_memory_usage()
+    def update_fit_artists(self):
+        # Update growth rates, fit lines and legend labels from the running fit
+        slopes,intercepts,stderrs = self.growth_fit.get_params()
+        legend_texts = self.legend.get_texts()
+        for line_idx in range(0,len(self.lines)):
+            excluded = ~self.fit_mask[line_idx]
+            self.excluded_lines[line_idx].set_data(self.times[excluded],
+                                                self.distances[line_idx][excluded])
+            self.growth_rates[line_idx] = slopes[line_idx]
+            self.growth_rates_string[line_idx] = '{:.2f}'.format(slopes[line_idx])+' micron/sec'
+            self.growth_lines_fit[line_idx].set_data(self.times,
+                                                  self.times*slopes[line_idx]+intercepts[line_idx])
+            legend_texts[line_idx].set_text(growth_rate_label(line_idx,slopes[line_idx]))
+    def toggle_fit_point(self,event):
+        # Clicking a data point removes it from the fit, clicking again adds it back
+        if not event.artist in self.growth_lines:
+            return
+        line_idx = self.growth_lines.index(event.artist)
+        idx = event.ind[0]
+        point = np.full(len(self.lines),np.nan)
+        point[line_idx] = self.distances[line_idx][idx]
+        if self.fit_mask[line_idx][idx]:
+            self.growth_fit.remove(self.times[idx],point)
+        else:
+            self.growth_fit.add(self.times[idx],point)
+        self.fit_mask[line_idx][idx] = not self.fit_mask[line_idx][idx]
+        self.update_fit_artists()
+        print(self.growth_rates_string[line_idx])
+        if self.live_mode_on:
+            self.canvas.restore_region(self.live_background)
+            self.draw_live_artists()
+            self.canvas.blit(self.fig.bbox)
+        else:
+            self.canvas.draw_idle()
+    def run_parameter_sweep(self):
+        # Growth rate of each line vs. threshold shift, disk size and clip limit
+        if not self.s_edge_method.get()=='Threshold Grain':
+            print('Parameter sweep is only available for the Threshold Grain method')
+            return
+        if not self.axes_ranges_initialized:
+            self.get_axes_ranges()
+        self.get_line_segments()
+        self.extract_times_and_sort()
+        settings = self.get_img_process_settings()
+        images = [self.full_images[sort_idx] for sort_idx in self.sort_indices]
+        times = np.array(self.times)
+        # Shift the current threshold range(s) by each value
+        shifts = [float(x) for x in self.s_sweep_shifts.get().split(',')]
+        threshold_ranges = []
+        for shift in shifts:
+            if settings['multiple_ranges']:
+                threshold_ranges.append(([x+shift for x in settings['threshold_lower']],
+                                         [x+shift for x in settings['threshold_upper']]))
+            else:
+                threshold_ranges.append((np.ravel(settings['threshold_lower'])[0]+shift,
+                                         np.ravel(settings['threshold_upper'])[0]+shift))
+        disks = [int(x) for x in self.s_sweep_disks.get().split(',')]
+        clip_limits = [float(x) for x in self.s_sweep_clip_limits.get().split(',')]
+        df = sweep_parameters(images,times,self.x1,self.x2,self.y1,self.y2,self.lines,
+                              get_length_per_pixel(images[-1],self.s_mag.get()),
+                              threshold_ranges,disks,clip_limits,
+                              equalize_hist=settings['equalize_hist'],
+                              threshold_out=settings['threshold_out'])
+        df['threshold_shift'] = (df['threshold_lower'].apply(lambda x: np.ravel(x)[0])
+                                 - np.ravel(settings['threshold_lower'])[0])
+        # Save table of all combinations
+        save_dir = os.path.join(self.base_dir,'analysis_results')
+        if not os.path.isdir(save_dir):
+            os.mkdir(save_dir)
+        savename = self.increment_save_name(save_dir,'parameter_sweep','.csv')
+        df.to_csv(os.path.join(save_dir,savename+'.csv'))
+        print('parameter sweep saved to ' + os.path.join(save_dir,savename+'.csv'))
+        self.plot_parameter_sweep(df)
+    def plot_parameter_sweep(self,df):
+        # Median growth rate over the other parameters, with the full range as error bars
+        window = tk.Toplevel(self.parent)
+        window.title('Parameter Sweep')
+        fig = Figure(figsize=(10,3))
+        axes = fig.subplots(ncols=3)
+        fig.subplots_adjust(wspace=0.35,bottom=0.2)
+        params = [('threshold_shift','Threshold Shift'),('disk','Disk'),('clip_limit','Clip Limit')]
+        for ax,(param,label) in zip(axes,params):
+            for line_idx,df_line in df.groupby('line_number'):
+                stats = df_line.groupby(param)['growth_rate_umps'].agg(['median','min','max'])
+                ax.errorbar(stats.index,stats['median'],
+                            yerr=[stats['median']-stats['min'],stats['max']-stats['median']],
+                            fmt='-o',capsize=3,label='#'+str(line_idx),
+                            color=Tableau_10.mpl_colors[(line_idx-1)%10])
+            ax.set_xlabel(label)
+            ax.set_ylabel('Growth Rate ($\mu$m/s)')
+        axes[-1].legend(bbox_to_anchor=(1.0, 1.0))
+        canvas = FigureCanvasTkAgg(fig, master=window)
+        canvas.draw()
+        canvas.get_tk_widget().pack(fill=BOTH, expand=True)
     def get_img_process_settings(self):
         if self.s_edge_method.get()=='Threshold Grain':
             if self.bool_multi_ranges:
@@ -1191,30 +3320,25 @@ class GrowthRateAnalyzer(ttk.Frame):
                 'crop_region':(self.x1,self.x2,self.y1,self.y2),
                 'time_files':self.time_files,'equalize_hist':self.bool_eq_hist.get(),
                 'clip_limit':float(self.s_clip_limit.get()),
-                'threshold_out':threshold_out,'multiple_ranges':multiple_ranges}
+                'threshold_out':threshold_out,'multiple_ranges':multiple_ranges,
+                'tiled':self.bool_tiled.get(),'drift':self.s_drift.get()}
     def extract_times_and_sort(self):
-        if self.s_time_source.get()=='Date Modified':
-            # Get time from last modified time
-            t0 = datetime.datetime.fromtimestamp(os.path.getmtime(self.time_files[0]))
-            self.times=[0]*len(self.time_files)
-            for idx,timeFile in enumerate(self.time_files):
-                ti = datetime.datetime.fromtimestamp(os.path.getmtime(self.time_files[idx]))
-                self.times[idx] = (ti-t0).total_seconds()
-        elif self.s_time_source.get()=='Filename (time=*s)':
-            # Get time from filename'
-            self.times=[0]*len(self.time_files)
-            for idx,timeFile in enumerate(self.time_files):
-                # Split first by "time=" then by "s" to get the numbers in between
-                self.times[idx] = float((timeFile.split('time=')[1]).split('s')[0])
-                #self.times[idx] = float((timeFile.split('t=')[1]).split('.png')[0])    
+        # Get time from last modified time (relative to first file) or from filename
+        file_times=[0]*len(self.time_files)
+        for idx,timeFile in enumerate(self.time_files):
+            file_times[idx] = get_file_time(timeFile,self.s_time_source.get(),
+                                         t0_file=self.time_files[0])
         # Loop through files
-        self.sort_indices = sorted(range(len(self.times)), key=lambda k: self.times[k])
+        self.sort_indices = sorted(range(len(file_times)), key=lambda k: file_times[k])
+        # self.times is in time order, like the masks and distances
+        self.times = [file_times[k] for k in self.sort_indices]
         if self.s_edge_method.get()=='Subtract Images':
-            # Make sort_indices and times arrays smaller in length by one element,
+            # Make times array smaller in length by one element,
             # since subtraction reduces the number of datapoints by one
-            self.times.remove(max(self.times))
+            self.times = self.times[:-1]
             #self.sort_indices = self.sort_indices[:-1]
     def save_results(self):
+        t_start = self.start_stage_timing()
         # Make save directory
         self.save_dir = os.path.join(self.base_dir,'analysis_results')
         if not os.path.isdir(self.save_dir):
@@ -1240,11 +3364,24 @@ class GrowthRateAnalyzer(ttk.Frame):
             # for idx,growthRate in enumerate(self.growth_rates):
                 # line = str(idx+1) + ',' + str(growthRate) + '\n'
                 # f.write(line)
+        if not self.get_img_process_settings()==self.last_img_process_settings:
+            # The settings changed since the masks of the derived results were made
+            self.clear_derived_results()
         # Save figures
-        savename = self.increment_save_name(self.save_dir,'growth_rates_plot','.png')
-        self.fig.savefig(os.path.join(self.save_dir,savename+'.png'),dpi=200,bbox_inches='tight')
-        savename = self.increment_save_name(self.save_dir,'threshold_plot','.png')
-        self.threshold_fig.savefig(os.path.join(self.save_dir,savename+'.png'),dpi=200,bbox_inches='tight')
+        with stage_timer.stage('save figures'):
+            savename = self.increment_save_name(self.save_dir,'growth_rates_plot','.png')
+            self.fig.savefig(os.path.join(self.save_dir,savename+'.png'),dpi=200,bbox_inches='tight')
+            savename = self.increment_save_name(self.save_dir,'threshold_plot','.png')
+            self.threshold_fig.savefig(os.path.join(self.save_dir,savename+'.png'),dpi=200,bbox_inches='tight')
+            if self.angular_fig is not None:
+                savename = self.increment_save_name(self.save_dir,'angular_growth_plot','.png')
+                self.angular_fig.savefig(os.path.join(self.save_dir,savename+'.png'),dpi=200,bbox_inches='tight')
+            if self.kymograph_fig is not None:
+                savename = self.increment_save_name(self.save_dir,'kymographs','.png')
+                self.kymograph_fig.savefig(os.path.join(self.save_dir,savename+'.png'),dpi=200,bbox_inches='tight')
+            if self.velocity_fig is not None:
+                savename = self.increment_save_name(self.save_dir,'velocity_field_plot','.png')
+                self.velocity_fig.savefig(os.path.join(self.save_dir,savename+'.png'),dpi=200,bbox_inches='tight')
         # Save dataframe
         # If no file was selected make new filename and df
         if not self.df_file:
@@ -1262,9 +3399,12 @@ class GrowthRateAnalyzer(ttk.Frame):
             df_local = pd.read_pickle(df_local_file)
         else:
             df_local = pd.DataFrame()
+        # Save times, distances, fits and masks, so the run can be looked at without reprocessing
+        with stage_timer.stage('save archive'):
+            archive_path = self.save_session_archive()
         # Now append data
         data_dict_list=[]
-        img_process_settings = self.get_img_process_settings()
+        img_process_settings = self.get_run_settings()
         for line_idx,growth_rate in enumerate(self.growth_rates):
             temp_dict = {'growth_rate_umps':growth_rate,
                         'line':self.lines[line_idx],
@@ -1275,7 +3415,11 @@ class GrowthRateAnalyzer(ttk.Frame):
                         'threshold_upper':img_process_settings['threshold_upper'],
                         'disk':int(self.s_disk.get()),
                         'histogram_equalization':self.bool_eq_hist.get(),
-                        'edge_find_method':self.s_edge_method.get()}
+                        'edge_find_method':self.s_edge_method.get(),
+                        'drift':img_process_settings['drift'],
+                        'track_fronts':img_process_settings['track_fronts'],
+                        'max_velocity':img_process_settings['max_velocity'],
+                        'session_archive':archive_path}
             for key,input_dict in self.sample_props.items():
                 if input_dict['dtype']=='string':
                     temp_string = self.s_sample_props[key].get()
@@ -1302,12 +3446,111 @@ class GrowthRateAnalyzer(ttk.Frame):
         df_local = df_local.append(data_dict_list,ignore_index=True)
         #print(self.df)
         # Pickle the dataframe
-        self.df.to_pickle(os.path.join(self.df_dir,self.df_file))
-        df_local.to_pickle(df_local_file)
-        # Save csv of data
-        #savename = self.increment_save_name(self.save_dir,'growth_rates_data','.csv')+'.csv'
-        df_local.to_csv(os.path.join(self.save_dir,'growth_rates_data.csv'))
+        with stage_timer.stage('save dataframe'):
+            self.df.to_pickle(os.path.join(self.df_dir,self.df_file))
+            df_local.to_pickle(df_local_file)
+            # Save csv of data
+            #savename = self.increment_save_name(self.save_dir,'growth_rates_data','.csv')+'.csv'
+            df_local.to_csv(os.path.join(self.save_dir,'growth_rates_data.csv'))
+            if self.grain_table is not None:
+                self.grain_table.to_csv(os.path.join(self.save_dir,'grain_growth_rates.csv'),index=False)
+            if self.angular_table is not None:
+                self.angular_table.to_csv(os.path.join(self.save_dir,'angular_growth_rates.csv'),index=False)
+            if self.arrival_map is not None:
+                save_arrival_map(self.save_dir,self.arrival_map,self.sorted_times())
+            if self.crop_windows is not None:
+                save_crop_windows(self.save_dir,self.sorted_file_times(),self.drift,
+                                  self.crop_windows)
+            if self.velocity_map is not None:
+                # Float tiff, so the speeds (um/s) can be read back exactly
+                imwrite(os.path.join(self.save_dir,'velocity_map_umps.tif'),
+                        self.velocity_map.astype(np.float32))
+                for name,table in self.velocity_tables.items():
+                    table.to_csv(os.path.join(self.save_dir,name+'.csv'),index=False)
         print('results saved to ' + self.df_dir + self.df_file)
+        self.report_stage_times('Save Results',t_start)
+
+    def save_session_archive(self):
+        # Writes the last extraction to analysis_results/session_archive.h5 (.npz
+        # without h5py), see session_archive.py. Masks are included when the masks of
+        # every point are stored for the current settings (not with adaptive frames).
+        masks = None
+        if (len(self.denoised_images)==self.distances.shape[1]
+                and self.get_img_process_settings()==self.last_img_process_settings):
+            masks = self.denoised_images
+        settings = {key:value for key,value in self.get_run_settings().items()
+                    if not key=='time_files'}
+        savename = self.increment_save_name(self.save_dir,'session_archive',archive_extension)
+        return write_session_archive(os.path.join(self.save_dir,savename+archive_extension),
+                                     np.array(self.times),self.distances,settings,
+                                     fit=self.growth_fit.get_params(),fit_mask=self.fit_mask,
+                                     masks=masks,lines=self.lines,
+                                     crop_region=[self.x1,self.x2,self.y1,self.y2],
+                                     crop_windows=self.crop_windows,
+                                     image_files=[os.path.basename(self.time_files[sort_idx])
+                                                  for sort_idx in self.sort_indices])
+    def get_run_settings(self):
+        # Image processing settings and the edge finding options of a run, stored in
+        # session archives and result rows so reanalyze_results.py can repeat it
+        settings = self.get_img_process_settings()
+        settings['track_fronts'] = (self.bool_track_fronts.get()
+                                    and settings['method']=='Threshold Grain')
+        try:
+            settings['max_velocity'] = float(self.s_max_velocity.get())
+        except ValueError:
+            settings['max_velocity'] = None
+        settings['arrival_map'] = self.use_arrival_map(settings)
+        settings['time_source'] = self.s_time_source.get()
+        settings['mag'] = self.s_mag.get()
+        return settings
+    def set_memory_budget(self):
+        # Read the budget from the GUI, blank for no limit
+        try:
+            self.memory_budget.budget_mb = float(self.s_memory_budget.get())
+        except ValueError:
+            self.memory_budget.budget_mb = None
+    def update_memory_usage(self):
+        self.set_memory_budget()
+        self.memory_budget.enforce()
+        self.l_memory.configure(text=self.memory_budget.format_usage())
+    def start_stage_timing(self):
+        # Reset the stage times at the start of a run. Returns the run start time
+        stage_timer.enabled = self.bool_time_stages.get()
+        stage_timer.reset()
+        return time.perf_counter()
+    def report_stage_times(self,title,t_start):
+        # Print the stage breakdown and show it below the buttons
+        if not stage_timer.enabled:
+            return
+        summary = stage_timer.format_summary(title,run_time=time.perf_counter()-t_start)
+        print(summary)
+        self.l_stage_times.configure(text=summary)
+
+    def log_extraction_run(self,settings,t_start,frame_times,reused_frames):
+        # Append run time, memory and cache metrics of an extraction to
+        # analysis_results/run_log.jsonl
+        settings = {key:value for key,value in settings.items() if not key=='time_files'}
+        record = {'image_dir':self.base_dir,
+                  'frames':self.distances.shape[1],
+                  'lines':len(self.lines),
+                  'image_shape':list(self.full_images[-1].shape),
+                  'crop_region':[int(x) for x in (self.x1,self.x2,self.y1,self.y2)],
+                  'crop_size':[int(self.x2-self.x1),int(self.y2-self.y1)],
+                  'settings_hash':settings_hash(settings),
+                  'settings':settings,
+                  'run_time_s':time.perf_counter()-t_start,
+                  'frame_times_ms':[1e3*t for t in frame_times],
+                  'mean_frame_time_ms':1e3*np.mean(frame_times) if frame_times else None,
+                  'denoised_cache_hit_rate':hit_rate(reused_frames,len(frame_times)),
+                  'histogram_cache_hit_rate':hit_rate(self.histogram_cache_hits,
+                                                      self.histogram_cache_misses),
+                  'peak_rss_mb':peak_rss_mb()}
+        if stage_timer.enabled:
+            record['stages'] = stage_timer.summary()
+        try:
+            write_run_log(os.path.join(self.base_dir,'analysis_results'),record)
+        except OSError as e:
+            print('Could not write run log: ' + str(e))
 
     def increment_save_name(self,path,savename,extension):
         name_hold = savename
@@ -1495,6 +3738,8 @@ class InteractiveLegend(object):
 def main():
     root = tk.Tk()
     app = GrowthRateAnalyzer(root)
+    # Load the deferred packages while the user picks files
+    root.after(100,preload,pd,imread,ndimage,exposure,median,disk,profile_line,Tableau_10)
     root.mainloop()
     #app.arduino.close()
 
@@ -0,0 +1,50 @@
+# Automatic and manual growth rate analysis in one window
+# Both analyzers are tabs over the same time series. Switching tabs carries the
+# opened files, crop region and growth directions over, and the manual tab reuses
+# the frames decoded by the automatic tab, so spot checks need no extra file reads.
+import tkinter as tk
+import tkinter.ttk as ttk
+from tkinter import BOTH
+from GrowthRateAnalyzer import (GrowthRateAnalyzer, pd, imread, exposure, median, disk,
+                                profile_line, Tableau_10)
+from ManualGrowthRateAnalyzer import GrowthRateAnalyzer as ManualGrowthRateAnalyzer
+from lazy_imports import preload
+
+class GrowthRateApp(ttk.Frame):
+    def __init__(self,parent):
+        ttk.Frame.__init__(self, parent)
+        self.parent = parent
+        self.notebook = ttk.Notebook(self.parent)
+        self.notebook.pack(fill=BOTH, expand=True)
+        automatic_tab = ttk.Frame(self.notebook)
+        manual_tab = ttk.Frame(self.notebook)
+        self.notebook.add(automatic_tab,text='Automatic')
+        self.notebook.add(manual_tab,text='Manual')
+        self.automatic = GrowthRateAnalyzer(automatic_tab)
+        self.manual = ManualGrowthRateAnalyzer(manual_tab)
+        # Frames are decoded once, by the automatic analyzer
+        self.manual.frame_source = self.automatic.get_loaded_frame
+        self.current_tab = self.automatic
+        self.notebook.bind('<<NotebookTabChanged>>',self.on_tab_changed)
+        self.parent.title('Growth Rate Analysis')
+    def on_tab_changed(self,event):
+        tabs = [self.automatic,self.manual]
+        new_tab = tabs[self.notebook.index('current')]
+        if new_tab is self.current_tab:
+            return
+        # Carry the files, crop and directions over from the tab being left
+        try:
+            new_tab.set_shared_state(self.current_tab.get_shared_state())
+        except Exception as e:
+            print('Could not share the series between tabs: ' + str(e))
+        self.current_tab = new_tab
+
+def main():
+    root = tk.Tk()
+    app = GrowthRateApp(root)
+    # Load the deferred packages while the user picks files
+    root.after(100,preload,pd,imread,exposure,median,disk,profile_line,Tableau_10)
+    root.mainloop()
+
+if __name__ == '__main__':
+    main()
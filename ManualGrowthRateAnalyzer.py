@@ -10,23 +10,19 @@ import os
 import glob
 import pickle
 from collections import OrderedDict
-import pandas as pd
 import numpy as np
 from sys import platform as sys_pf
 import matplotlib
 if sys_pf == 'darwin':
     matplotlib.use("TkAgg") # This fixes crashes on mac
 import matplotlib.pyplot as plt
-from scipy import ndimage, misc
-import imageio
-from scipy.signal import argrelextrema
-from scipy.optimize import curve_fit
+# Heavy packages are imported on first use, so the window shows up quickly
+from lazy_imports import LazyImport, preload
+pd = LazyImport('pandas')
+imageio = LazyImport('imageio')
 # sci-kit image
-from skimage import exposure
-from skimage.color import rgb2gray
-from skimage.filters.rank import median
-from skimage.morphology import disk
-from skimage.measure import profile_line
+exposure = LazyImport('skimage.exposure')
+profile_line = LazyImport('skimage.measure','profile_line')
 # GUI imports
 import os
 import csv
@@ -43,17 +39,17 @@ import tkinter.ttk as ttk
 from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg,
                                          NavigationToolbar2Tk)
 from matplotlib.figure import Figure
-# Scalebar
-from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
-import matplotlib.font_manager as fm
 # Misc.
-from matplotlib.colors import LinearSegmentedColormap
 from matplotlib.widgets import SpanSelector
 from matplotlib.ticker import AutoMinorLocator, MaxNLocator
 from matplotlib.patches import Rectangle
 # Colors
-from palettable.tableau import Tableau_10, Tableau_20
-from palettable.colorbrewer.qualitative import Set1_9
+Tableau_10 = LazyImport('palettable.tableau','Tableau_10')
+# Growth rate fitting
+from streaming_fit import StreamingLinearFit
+# Helpers shared with the automatic analyzer
+from GrowthRateAnalyzer import (set_new_im_data, get_line_length, get_file_time,
+                                get_length_per_pixel, LineBuilder)
 matplotlib.rc("savefig",dpi=100)
 ################################################################################
 
@@ -84,52 +80,6 @@ def setNiceTicks(ax,Nx=4,Ny=4,yminor=2,xminor=2,
         ax.set_xticks([])
         ax.set_yticks([])
 
-def set_new_im_data(ax,im_data,new_img):
-    # Change data extent to match new image
-    im_data.set_extent((0, new_img.shape[1], new_img.shape[0], 0))
-    # Reset axes limits
-    ax.set_xlim(0,new_img.shape[1])
-    ax.set_ylim(new_img.shape[0],0)
-    # Now set the data
-    im_data.set_data(new_img)
-
-# Calibration values for Nikon microscope
-micron_per_pixel = {'4x':1000/696, '10x':1000/1750,
-                  '20x':500/1740, '50x':230/2016}
-# This is obtained by multiplying micron_per_pixel by 2048,
-# which is the pixel width for images saved by the Lumenera software
-image_width_microns = {'4x':  2942.5,
-                         '20x':  588.5,
-                         '10x': 1170.3,
-                         '50x':  233.7}
-    
-def get_line_length(line,mag,unit='um',length_per_pixel=None):
-    '''
-    ax = axis handle
-    length = length of scalebar in 'unit'
-    unit = unit of length, mm for millimeter or um for microns
-    mag = magnification of microscope, '4x','10x','20x',or '50x'
-    length_per_pixel = conversion from pixel to length
-        default is None, using calibration factors for the Nikon
-    height = height of scalebar
-    loc = location specifier of scalebar
-    '''
-    if unit == 'um':
-        factor = 1
-    if unit == 'mm':
-        factor = 1e-3
-    # calibration distances for the Nikon microscope
-    micron_per_pixel = {'4x':1000/696, '10x':1000/1750,
-                       '20x':500/1740, '50x':230/2016}
-    if not length_per_pixel:
-        length_per_pixel = micron_per_pixel[mag]
-    x,y = zip(*line)
-    pixels = np.sqrt( (x[1]-x[0])**2 + (y[1]-y[0])**2 )
-    length = pixels * length_per_pixel * factor
-    return length
-
-
-
 class GrowthRateAnalyzer(ttk.Frame):
     def __init__(self,parent):
         ttk.Frame.__init__(self, parent)
@@ -142,6 +92,9 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.threshold_initialized = False
         self.save_initialized = False
         self.df_file = None
+        # Function returning an already decoded frame for a file (or None),
+        # set when running next to the automatic analyzer
+        self.frame_source = None
         self.base_dir = os.getcwd()
         # Default crop coordinates
         self.x1,self.x2,self.y1,self.y2 = 1054,1852,372,1203
@@ -159,7 +112,7 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.configure_gui()
     def configure_gui(self):
         # Master Window
-        self.parent.title("Manual Growth Rate Analysis")
+        self.winfo_toplevel().title("Manual Growth Rate Analysis")
         #self.style = Style()
         #self.style.theme_use("default")
         # Set ttk style
@@ -264,15 +217,15 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.b_next_frame.configure(text="Forward ->")
         self.b_next_frame.grid(row=3, column=0, sticky=E)
         self.b_next_frame.config(width=b_width)
-        # Bind the arrow keys
-        self.parent.bind('<Right>', self.forward_frame)
+        # Bind the arrow keys (to the window, so they also work when this is a tab)
+        self.winfo_toplevel().bind('<Right>', self.forward_frame, add='+')
         
         self.b_reverse_frame = ttk.Button(button_container, command=self.reverse_frame)
         self.b_reverse_frame.configure(text="<- Reverse")
         self.b_reverse_frame.grid(row=4, column=0, sticky=E)
         self.b_reverse_frame.config(width=b_width)
         # Bind the arrow keys
-        self.parent.bind('<Left>', self.reverse_frame)
+        self.winfo_toplevel().bind('<Left>', self.reverse_frame, add='+')
         
         self.b_reset_crop = ttk.Button(button_container, command=self.reset_crop)
         self.b_reset_crop.configure(text="Reset Crop")
@@ -434,6 +387,8 @@ class GrowthRateAnalyzer(ttk.Frame):
         # If the prompt is canceled, returns empty string. Exit in this case.
         if files == '':
             return
+        self.load_series(files)
+    def load_series(self,files):
         # Reset initialization for other functions
         self.crop_initialized = False
         self.threshold_initialized = False
@@ -503,12 +458,12 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.reset_image_display(reset_crop=False)
         # Zoom to region of interest in image. This will select crop region below
         # Pick the last time so the whole grain is contained within the crop region
-        img=imageio.imread(os.path.join(self.base_dir,self.time_files[0]))#,mode='L'
+        img=self.read_frame(self.time_files[0])
         self.full_last_frame = img # store last frame 
         #img = exposure.rescale_intensity(img,in_range='image')
         #img = exposure.equalize_adapthist(img,clip_limit=0.05)
         if not self.crop_initialized:
-            self.cropData = self.image_ax.imshow(img)
+            self.cropData = self.image_ax.imshow(img,cmap=plt.get_cmap('gray'))
             self.image_canvas.draw()
         else:
             # Set new data
@@ -516,6 +471,7 @@ class GrowthRateAnalyzer(ttk.Frame):
             self.image_canvas.draw()
         self.crop_initialized = True
         self.axes_ranges_initialized = False
+        self.__dict__.pop('linebuilder',None)
     def get_axes_ranges(self):
         x1,x2=self.image_ax.get_xlim()
         y2,y1=self.image_ax.get_ylim()
@@ -537,7 +493,7 @@ class GrowthRateAnalyzer(ttk.Frame):
         # Update crop range
         self.get_axes_ranges()
         # load image
-        img=imageio.imread(os.path.join(self.base_dir,self.time_files[frame_index]))
+        img=self.read_frame(self.time_files[frame_index])
         # Set data
         self.cropData.set_data(img)
         self.image_canvas.draw()
@@ -545,6 +501,55 @@ class GrowthRateAnalyzer(ttk.Frame):
         #self.current_frame=img[self.y1:self.y2,self.x1:self.x2]
         # TODO enter contrast processing here
         #self.update_image_display(self.current_frame)
+    def get_shared_state(self):
+        '''
+        Files, crop region and growth directions, shared with the automatic analyzer
+        Lines are in full image coordinates
+        '''
+        state = {'files':list(getattr(self,'time_files',[])),'crop':None,'lines':None,
+                 'reference_points':{}}
+        # Reference points (scroll click) of each frame, {file:(x,y)}, used by the
+        # automatic analyzer to follow stage drift
+        if 'ref_point_x' in self.__dict__ and len(self.ref_point_x)==len(self.sort_indices):
+            for frame_idx,sort_idx in enumerate(self.sort_indices):
+                if self.ref_point_x[frame_idx] or self.ref_point_y[frame_idx]:
+                    state['reference_points'][self.time_files[sort_idx]] = (
+                        self.ref_point_x[frame_idx],self.ref_point_y[frame_idx])
+        if self.crop_initialized:
+            self.get_axes_ranges()
+            state['crop'] = (self.x1,self.x2,self.y1,self.y2)
+            if 'linebuilder' in self.__dict__:
+                self.get_line_segments()
+                state['lines'] = self.lines
+        return state
+    def set_shared_state(self,state):
+        # Shows the files, crop region and directions from the automatic analyzer
+        if not state['files']:
+            return
+        if not sorted(state['files']) == sorted(self.time_files):
+            self.load_series(state['files'])
+        if state['crop'] is None:
+            return
+        self.pick_crop_region()
+        self.x1,self.x2,self.y1,self.y2 = state['crop']
+        self.image_ax.set_xlim(self.x1,self.x2)
+        self.image_ax.set_ylim(self.y2,self.y1)
+        if state['lines']:
+            xs = [x for line in state['lines'] for x,y in line]
+            ys = [y for line in state['lines'] for x,y in line]
+            self.line, = self.image_ax.plot(xs,ys,'-or',ms=2,alpha=0.5)
+            self.linebuilder = LineBuilder(self.line)
+            self.linebuilder.x1,self.linebuilder.y1 = xs[0],ys[0]
+        self.image_canvas.draw()
+    def read_frame(self,time_file):
+        # Frames already decoded by the automatic analyzer (frame_source) are reused
+        if self.frame_source is not None:
+            img = self.frame_source(time_file)
+            if img is not None:
+                return img
+        return imageio.imread(os.path.join(self.base_dir,time_file))
+    def key_bindings_active(self):
+        return self.winfo_ismapped() and 'current_frame_index' in self.__dict__
     def update_image_display(self,new_image):
         # Change data extent to match new cropped image
         self.cropData.set_extent((0, new_image.shape[1], new_image.shape[0], 0))
@@ -620,18 +625,14 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.growth_edge_x = np.zeros(len(self.time_files))
         self.growth_edge_y = np.zeros(len(self.time_files))
         self.distances = np.zeros(len(self.time_files))
+        # Running fit of the picked points, updated as each edge is picked
+        self.growth_fit = StreamingLinearFit()
+        self.picked_frames = np.zeros(len(self.time_files),dtype=bool)
         # Stop the LineBuilder
         self.image_canvas.mpl_disconnect(self.linebuilder.cid)
         # Update crop range
         if not self.axes_ranges_initialized:
             self.get_axes_ranges()
-        # Check if images dimensions are as expected. If not use image width
-        # Not very robust yet
-        img = imageio.imread(os.path.join(self.base_dir,self.time_files[0]))
-        if img.shape[1]==2048:
-            length_per_pixel = micron_per_pixel[self.s_mag.get()]
-        else:
-            length_per_pixel = image_width_microns[self.s_mag.get()]/img.shape[1]
         # Get time from filenames, and sort by time
         self.extract_times_and_sort() # saves self.times and self.sort_indices
         sort_idx = self.sort_indices[self.current_frame_index]
@@ -726,13 +727,7 @@ class GrowthRateAnalyzer(ttk.Frame):
         return x1+a*dx, y1+a*dy
     
     def get_distance(self,nearby_point=None):
-        # Check if images dimensions are as expected. If not use image width
-        # Not very robust yet
-        img = self.full_last_frame
-        if img.shape[1]==2048:
-            length_per_pixel = micron_per_pixel[self.s_mag.get()]
-        else:
-            length_per_pixel = image_width_microns[self.s_mag.get()]/img.shape[1]
+        length_per_pixel = get_length_per_pixel(self.full_last_frame,self.s_mag.get())
         
         # Get movement of reference point to shift where line is drawn
         # Maybe should take int of this
@@ -762,12 +757,21 @@ class GrowthRateAnalyzer(ttk.Frame):
         total_line_length = get_line_length(
             line_to_growth_edge,mag=None,unit='um',length_per_pixel=length_per_pixel)
 
+        # Replace the previous pick for this frame in the running fit
+        t = self.sorted_times[self.current_frame_index]
+        if self.picked_frames[self.current_frame_index]:
+            self.growth_fit.remove(t,self.distances[self.current_frame_index])
+        self.growth_fit.add(t,total_line_length)
+        self.picked_frames[self.current_frame_index] = True
         self.distances[self.current_frame_index] = total_line_length
         self.distances_line.set_data(self.sorted_times,self.distances)
         self.plot_ax.axis([0,np.amax(self.times)*1.1,0,np.amax(self.distances)*1.1])
         self.plot_canvas.draw()
     # This function is connected to the right arrow key
     def forward_frame(self,_event=None):
+        # Ignore arrow keys while another tab is shown or before edge selection
+        if _event is not None and not self.key_bindings_active():
+            return
         # Get coordinates from last frame
         #self.growth_edge_x_coord[self.current_frame_index] = self.pointselector.xs[0]
         #self.growth_edge_y_coord[self.current_frame_index] = self.pointselector.ys[0]
@@ -780,6 +784,8 @@ class GrowthRateAnalyzer(ttk.Frame):
             print('last frame reached')
     # This function is connected to the left arrow key
     def reverse_frame(self,_event=None):
+        if _event is not None and not self.key_bindings_active():
+            return
         # Get coordinates from last frame
         #self.growth_edge_x_coord[self.current_frame_index] = self.pointselector.xs[0]
         #self.growth_edge_y_coord[self.current_frame_index] = self.pointselector.ys[0]
@@ -794,14 +800,16 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.growth_rates=[]
         self.growth_rates_string=[]
         self.growth_lines_fit=['']*len(self.lines)
-        params = np.polyfit(self.sorted_times, self.distances, 1)
+        # Only frames with a picked edge are included in the fit
+        slope,intercept,stderr = [x[0] for x in self.growth_fit.get_params()]
+        params = (slope,intercept)
         line1,=self.plot_ax.plot(self.sorted_times,self.sorted_times*params[0]+params[1],'--',
             color='k',linewidth=1.5) # Tableau_10.mpl_colors[c_idx]
         self.growth_lines_fit.append(line1)
-        print('{:.2f}'.format(params[0])+' micron/sec')
+        print('{:.2f}'.format(params[0])+' +/- '+'{:.2f}'.format(stderr)+' micron/sec')
         self.growth_rates_string.append('{:.2f}'.format(params[0])+' micron/sec')
         self.growth_rates.append(params[0])
-        self.plot_ax.set_title('{:.2f}'.format(params[0])+' $\mu$m/s')
+        self.plot_ax.set_title('{:.2f}'.format(params[0])+' $\pm$ '+'{:.2f}'.format(stderr)+' $\mu$m/s')
         self.plot_canvas.draw()
     def get_img_process_settings(self):
         if self.s_edge_method.get()=='Threshold Grain':
@@ -831,20 +839,11 @@ class GrowthRateAnalyzer(ttk.Frame):
                 'clip_limit':float(self.s_clip_limit.get()),
                 'threshold_out':threshold_out,'multiple_ranges':multiple_ranges}
     def extract_times_and_sort(self):
-        if self.s_time_source.get()=='Date Modified':
-            # Get time from last modified time
-            t0 = datetime.datetime.fromtimestamp(os.path.getmtime(self.time_files[0]))
-            self.times=[0]*len(self.time_files)
-            for idx,timeFile in enumerate(self.time_files):
-                ti = datetime.datetime.fromtimestamp(os.path.getmtime(self.time_files[idx]))
-                self.times[idx] = (ti-t0).total_seconds()
-        elif self.s_time_source.get()=='Filename (time=*s)':
-            # Get time from filename'
-            self.times=[0]*len(self.time_files)
-            for idx,timeFile in enumerate(self.time_files):
-                # Split first by "time=" then by "s" to get the numbers in between
-                self.times[idx] = float((timeFile.split('time=')[1]).split('s')[0])
-                #self.times[idx] = float((timeFile.split('t=')[1]).split('.png')[0])    
+        # Get time from last modified time (relative to first file) or from filename
+        self.times=[0]*len(self.time_files)
+        for idx,timeFile in enumerate(self.time_files):
+            self.times[idx] = get_file_time(timeFile,self.s_time_source.get(),
+                                         t0_file=self.time_files[0])
         # Loop through files
         self.sort_indices = sorted(range(len(self.times)), key=lambda k: self.times[k])
     def save_results(self):
@@ -995,39 +994,6 @@ class GrowthRateAnalyzer(ttk.Frame):
         self.image_canvas.draw()
 
 
-# Interactively draw line
-# You can draw multiple lines as well
-class LineBuilder:
-    def __init__(self, line):
-        self.line = line
-        self.xs = list(line.get_xdata())
-        self.ys = list(line.get_ydata())
-        self.cid = line.figure.canvas.mpl_connect('button_press_event', self)
-
-    def __call__(self, event):
-        #print('click', event)
-        if event.inaxes!=self.line.axes: return
-        #first click sets values of nucleation site, creates point at n-site
-        if len(self.xs) == 0:
-            self.x1 = event.xdata
-            self.y1 = event.ydata
-            self.xs.append(self.x1)
-            self.ys.append(self.y1)
-        #second click connects n-site to click point
-        elif len(self.xs) == 1:
-            self.xs.append(event.xdata)
-            self.ys.append(event.ydata)
-        #following clicks each create a line from n-site to click point
-        else:
-            self.xs.append(self.x1)
-            self.ys.append(self.y1)
-            self.xs.append(event.xdata)
-            self.ys.append(event.ydata)
-
-
-        self.line.set_data(self.xs, self.ys)
-        self.line.figure.canvas.draw()
-        
 # Interactively draw line
 # You can draw multiple lines as well
 class PointSelector:
@@ -1150,6 +1116,8 @@ class InteractiveLegend(object):
 def main():
     root = tk.Tk()
     app = GrowthRateAnalyzer(root)
+    # Load the deferred packages while the user picks files
+    root.after(100,preload,pd,imageio,exposure,profile_line,Tableau_10)
     root.mainloop()
     #app.arduino.close()
 
@@ -0,0 +1,434 @@
+# This program runs growth rate analyses of many time series without the GUI
+# A job file lists the series directories, each with its crop region, growth
+# directions and image processing settings (see the README). Jobs run in parallel
+# processes, and results are saved like Save Results in GrowthRateAnalyzer.py.
+# Every finished job is checkpointed, so an interrupted or crashed campaign is
+# resumed by running the same command again:
+#   python batch_analysis.py campaign_jobs.json --workers 4
+import os
+import glob
+import json
+import time
+import atexit
+import shutil
+import tempfile
+import argparse
+import datetime
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from GrowthRateAnalyzer import (pd, imread, threshold_crop_denoise, subtract_and_denoise,
+                                open_frame, to_gray, threshold_crop_denoise_tiled,
+                                auto_threshold, estimate_drift, drift_crop_windows,
+                                track_front_distances, arrival_frame_map,
+                                arrival_path_distances, compute_distances, fit_distances,
+                                get_file_time, get_length_per_pixel)
+from run_log import settings_hash
+from session_archive import write_session_archive, archive_extension
+
+# Settings used when a job doesn't give them, as in a new GUI session
+# 'auto' thresholds are picked from the first and last frame (Auto Threshold),
+# and turn off equalize_hist (the thresholds are picked before equalization).
+# drift is 'None' or 'Automatic'. track_fronts uses front tracking (Threshold
+# Grain only). mag is read from the file names (_mag=20x_) when not given.
+# tiled memory maps the frames and thresholds the crop in tiles (Threshold Grain
+# only), for frames larger than memory, as "Tiled (Large Frames)" in the GUI.
+# arrival_map looks up the fronts in the arrival map (Threshold Grain only) instead
+# of every mask, as "Arrival Map Edges" in the GUI.
+default_settings = {'method':'Threshold Grain','disk':5,
+                    'threshold_lower':'auto','threshold_upper':'auto',
+                    'equalize_hist':True,'clip_limit':0.05,'threshold_out':False,'tiled':False,
+                    'arrival_map':False,
+                    'drift':'None','track_fronts':False,'max_velocity':10.0,
+                    'time_source':'Filename (time=*s)','mag':None,'file_pattern':'*.tif'}
+
+def file_mag(time_file):
+    # Magnification from a file name with _mag=##x_ or _magnification=##x_, as the GUI
+    for split in os.path.basename(time_file).split('_'):
+        split2 = split.split('=')
+        if 'mag' in split.lower() and len(split2)>1:
+            return os.path.splitext(split2[1])[0]
+    return None
+
+def series_files(series_dir,settings,image_files=None):
+    '''
+    Image files of a series: image_files (names in series_dir) if given,
+    otherwise the files matching settings['file_pattern']
+    '''
+    if image_files is not None:
+        return [os.path.join(series_dir,f) for f in image_files]
+    files = sorted(glob.glob(os.path.join(series_dir,settings['file_pattern'])))
+    if settings['time_source']=='Filename (time=*s)':
+        files = [f for f in files if 'time=' in os.path.basename(f)]
+    return files
+
+def flat_lines(distances,length_per_pixel):
+    # Lines (indices) whose front moves less than one pixel over the whole series
+    return np.flatnonzero(np.ptp(distances,axis=1)<length_per_pixel)
+
+def analyze_series(files,crop,lines,settings,keep_masks=False,tile_dir=None):
+    '''
+    Headless Extract Growth Rates of one series
+    files are the image paths, in the order they were opened. crop (x1,x2,y1,y2)
+        and lines (growth directions in crop coordinates) are picked on the last
+        of them, as in the GUI.
+    settings are the keys of default_settings (missing keys use the defaults)
+    Returns a dict with the files (as given, and in time order as sorted_files),
+    frame times (s), distances (lines x frames, um), growth rates, intercepts and
+    standard errors of the fits, the mask of points in the fits, the crop windows
+    (when following drift) and the settings used, with 'auto' thresholds replaced
+    by the values found
+    keep_masks adds the masks of each frame (none with front tracking)
+    tile_dir is where tiled processing writes the masks (memory mapped .npy files).
+        By default a temporary directory removed when Python exits.
+    '''
+    settings = dict(default_settings,**settings)
+    if len(files)<2:
+        raise ValueError('A series needs at least two frames, found ' + str(len(files)))
+    x1,x2,y1,y2 = [int(x) for x in crop]
+    mag = settings['mag'] or file_mag(files[0])
+    if mag is None:
+        raise ValueError('No magnification in the settings or the file names')
+    # Sort by time, keeping track of the frame the crop region was picked on
+    times = np.array([get_file_time(f,settings['time_source'],t0_file=files[0]) for f in files])
+    sort_indices = list(np.argsort(times,kind='stable'))
+    times = times[sort_indices]
+    method = settings['method']
+    tiled = bool(settings['tiled']) and method=='Threshold Grain'
+    if tiled:
+        # Only the parts of each frame that are used are read
+        images = [open_frame(files[sort_idx]) for sort_idx in sort_indices]
+    else:
+        images = [imread(files[sort_idx],format='tiff-pil',pilmode='L') for sort_idx in sort_indices]
+    length_per_pixel = get_length_per_pixel(images[sort_indices.index(len(files)-1)],mag)
+    d = int(settings['disk'])
+    threshold_lower = settings['threshold_lower']
+    threshold_upper = settings['threshold_upper']
+    if method=='Threshold Grain' and 'auto' in (threshold_lower,threshold_upper):
+        if tiled:
+            # Only the crop is read
+            first,last = [to_gray(np.asarray(img[y1:y2,x1:x2])) for img in (images[0],images[-1])]
+            threshold_crop = (0,x2-x1,0,y2-y1)
+        else:
+            first,last = images[0],images[-1]
+            threshold_crop = (x1,x2,y1,y2)
+        # Two classes on the equalized crop split near mid gray rather than between
+        # grain and background, so the thresholds are picked on the histogram before
+        # equalization, and the frames are thresholded without it
+        if settings['equalize_hist']:
+            print('Auto thresholds are picked without histogram equalization, which is '
+                  'turned off for ' + os.path.dirname(files[0]))
+            settings['equalize_hist'] = False
+        threshold_lower,threshold_upper,multiple_ranges = auto_threshold(
+            first,last,*threshold_crop,equalize_hist=False)
+        settings['threshold_lower'] = threshold_lower
+        settings['threshold_upper'] = threshold_upper
+    elif method=='Subtract Images':
+        # Subtracted images are thresholded at threshold_lower only, if given
+        if threshold_lower=='auto':
+            threshold_lower = None
+        threshold_upper = None
+        settings['threshold_lower'] = threshold_lower
+        settings['threshold_upper'] = threshold_upper
+    elif not method=='Threshold Grain':
+        raise ValueError('Unknown method ' + str(method))
+    multiple_ranges = np.ndim(threshold_lower)>0
+    # Crop region of each frame
+    crop_windows = None
+    drift = None
+    if settings['drift']=='Automatic':
+        drift = estimate_drift(images,x1,x2,y1,y2)
+        crop_windows,clamped = drift_crop_windows(drift,drift[sort_indices.index(len(files)-1)],
+                                                  x1,x2,y1,y2,images[0].shape)
+        if clamped.any():
+            print('The crop region reached the image edge in {} frames of {}'.format(
+                int(clamped.sum()),os.path.dirname(files[0])))
+    elif not settings['drift']=='None':
+        raise ValueError('Drift can be None or Automatic in batch jobs, not ' + str(settings['drift']))
+    windows = crop_windows if crop_windows is not None else [(x1,x2,y1,y2)]*len(images)
+    masks = None
+    if settings['track_fronts'] and method=='Threshold Grain':
+        distances = track_front_distances(images,times,x1,x2,y1,y2,lines,length_per_pixel,
+                                          threshold_lower,threshold_upper,d,
+                                          float(settings['max_velocity']),
+                                          equalize_hist=settings['equalize_hist'],
+                                          threshold_out=settings['threshold_out'],
+                                          multiple_ranges=multiple_ranges,
+                                          clip_limit=settings['clip_limit'],
+                                          crop_windows=crop_windows)[0]
+    elif tiled:
+        if tile_dir is None:
+            tile_dir = tempfile.mkdtemp(prefix='growth_rate_tiles_')
+            atexit.register(shutil.rmtree,tile_dir,True)
+        masks = [threshold_crop_denoise_tiled(img,*windows[idx],threshold_lower,threshold_upper,d,
+                                              os.path.join(tile_dir,'{:06d}.npy'.format(idx)),
+                                              equalize_hist=settings['equalize_hist'],
+                                              threshold_out=settings['threshold_out'],
+                                              multiple_ranges=multiple_ranges,
+                                              clip_limit=settings['clip_limit'])
+                 for idx,img in enumerate(images)]
+    elif method=='Threshold Grain':
+        masks = [threshold_crop_denoise(None,*windows[idx],threshold_lower,threshold_upper,d,
+                                        img=img,equalize_hist=settings['equalize_hist'],
+                                        threshold_out=settings['threshold_out'],
+                                        multiple_ranges=multiple_ranges,
+                                        clip_limit=settings['clip_limit'])[0]
+                 for idx,img in enumerate(images)]
+    else:
+        masks = [subtract_and_denoise(None,None,*windows[idx],d,threshold=threshold_lower,
+                                      img1=images[idx],img2=images[idx+1],
+                                      equalize_hist=settings['equalize_hist'],
+                                      clip_limit=settings['clip_limit'],
+                                      crop2=windows[idx+1])[0]
+                 for idx in range(0,len(images)-1)]
+        # Subtraction gives one frame less
+        times = times[:-1]
+    if masks is not None:
+        # Fronts found on every mask, or looked up in the arrival map, as in the GUI
+        if settings['arrival_map'] and method=='Threshold Grain':
+            distances = arrival_path_distances(arrival_frame_map(masks),lines,len(masks),
+                                               length_per_pixel)
+        else:
+            distances = compute_distances(masks,lines,length_per_pixel)
+    flat = flat_lines(distances,length_per_pixel)
+    if len(flat)>0:
+        print('The front does not move along line(s) {} of {}, check the thresholds'.format(
+            ','.join(str(line_idx+1) for line_idx in flat),os.path.dirname(files[0])))
+    growth_fit,fit_mask = fit_distances(times,distances)
+    slopes,intercepts,stderrs = growth_fit.get_params()
+    settings['mag'] = mag
+    result = {'files':list(files),'sorted_files':[files[sort_idx] for sort_idx in sort_indices],
+              'times':times,'distances':distances,'fit_mask':fit_mask,
+              'growth_rates':slopes,'intercepts':intercepts,'stderrs':stderrs,
+              'length_per_pixel':length_per_pixel,'drift':drift,'crop_windows':crop_windows,
+              'settings':settings}
+    if keep_masks:
+        result['masks'] = masks
+    return result
+
+def archive_result(path,result,crop,lines):
+    # Writes the times, distances, fits, masks and settings of a result to a session archive
+    return write_session_archive(path,result['times'],result['distances'],result['settings'],
+                                 fit=(result['growth_rates'],result['intercepts'],result['stderrs']),
+                                 fit_mask=result['fit_mask'],masks=result.get('masks'),
+                                 lines=lines,crop_region=list(crop),
+                                 crop_windows=result['crop_windows'],
+                                 image_files=[os.path.basename(f) for f in result['sorted_files']])
+
+def result_rows(result,crop,lines,sample_props=None,batch_job=None):
+    '''
+    One DataFrame row per line, with the same columns as Save Results in the GUI
+    sample_props are the sample properties (growth_date, material, ...) as the GUI
+        stores them, e.g. {'material':['TPBi','Au'],'thickness_nm':[45.0,10.0]}
+    batch_job is stored in a 'batch_job' column, so rerun jobs replace their rows
+    '''
+    settings = result['settings']
+    rows = []
+    for line_idx,growth_rate in enumerate(result['growth_rates']):
+        row = {'growth_rate_umps':growth_rate,
+               'line':[tuple(point) for point in lines[line_idx]],
+               'x1,x2,y1,y2':tuple(int(x) for x in crop),
+               'image_files':[os.path.basename(x) for x in result['files']],
+               'image_dir':os.path.split(result['files'][0])[0],
+               'threshold_lower':settings['threshold_lower'],
+               'threshold_upper':settings['threshold_upper'],
+               'disk':int(settings['disk']),
+               'histogram_equalization':settings['equalize_hist'],
+               'edge_find_method':settings['method'],
+               'drift':settings['drift'],
+               'track_fronts':bool(settings['track_fronts']),
+               'max_velocity':float(settings['max_velocity'])}
+        if sample_props:
+            row.update(sample_props)
+        if result.get('session_archive') is not None:
+            row['session_archive'] = result['session_archive']
+        if batch_job is not None:
+            row['batch_job'] = batch_job
+        rows.append(row)
+    return rows
+
+def replace_job_rows(df_path,rows,batch_job):
+    '''
+    Appends rows to the DataFrame pickled at df_path (created if needed), replacing
+    rows from an earlier run of the same batch job
+    The file is replaced in one step, so an interruption can't leave it half written
+    '''
+    if os.path.isfile(df_path):
+        df = pd.read_pickle(df_path)
+        if 'batch_job' in df.columns:
+            df = df[~(df['batch_job']==batch_job)]
+    else:
+        df = pd.DataFrame()
+    df = pd.concat([df,pd.DataFrame(rows)],ignore_index=True)
+    temp_path = df_path + '.tmp'
+    df.to_pickle(temp_path)
+    os.replace(temp_path,df_path)
+    return df
+
+def save_job_results(rows,batch_job,series_dir,df_path=None):
+    # Local df.pkl and growth_rates_data.csv in analysis_results, and the campaign DataFrame
+    save_dir = os.path.join(series_dir,'analysis_results')
+    if not os.path.isdir(save_dir):
+        os.mkdir(save_dir)
+    df_local = replace_job_rows(os.path.join(save_dir,'df.pkl'),rows,batch_job)
+    df_local.to_csv(os.path.join(save_dir,'growth_rates_data.csv'))
+    if df_path is not None:
+        replace_job_rows(df_path,rows,batch_job)
+
+def load_jobs(job_file):
+    '''
+    Reads a job file (JSON) and returns the jobs with defaults filled in, and the
+    campaign DataFrame path (None to only save in each series directory)
+    Job directories and df_file are relative to base_dir, which defaults to the
+    directory of the job file. Each job gets an id from its name (or directory) and
+    a hash of its contents, so an edited job runs again on resume.
+    '''
+    with open(job_file) as f:
+        job_spec = json.load(f)
+    base_dir = job_spec.get('base_dir',os.path.dirname(os.path.abspath(job_file)))
+    defaults = job_spec.get('defaults',{})
+    jobs = []
+    for job in job_spec['jobs']:
+        job = dict(job)
+        job['dir'] = os.path.join(base_dir,job['dir'])
+        job['settings'] = dict(default_settings,**dict(defaults.get('settings',{}),
+                                                       **job.get('settings',{})))
+        job['sample'] = dict(defaults.get('sample',{}),**job.get('sample',{}))
+        name = job.get('name',os.path.basename(os.path.normpath(job['dir'])))
+        job['id'] = name + '_' + settings_hash(job)
+        jobs.append(job)
+    ids = [job['id'] for job in jobs]
+    if len(set(ids))<len(ids):
+        raise ValueError('The job file lists the same job more than once')
+    df_path = job_spec.get('df_file')
+    if df_path is not None:
+        df_path = os.path.join(base_dir,df_path)
+    return jobs,df_path
+
+def run_job(job):
+    '''
+    Runs one job in a worker process
+    With job['archive_path'], the run is also saved to a session archive there
+    (masks included), which is written by the worker so the masks aren't sent back
+    Returns the job id, the result of analyze_series (None if it failed), the
+    run time and the traceback of a failure
+    '''
+    t_start = time.perf_counter()
+    try:
+        files = series_files(job['dir'],job['settings'],job.get('files'))
+        if len(files)==0:
+            raise ValueError('No image files found in ' + job['dir'])
+        archive_path = job.get('archive_path')
+        # Masks of tiled processing, removed when the job is done (atexit doesn't
+        # run in worker processes)
+        tile_dir = tempfile.mkdtemp(prefix='growth_rate_tiles_')
+        try:
+            result = analyze_series(files,job['crop'],job['lines'],job['settings'],
+                                    keep_masks=archive_path is not None,tile_dir=tile_dir)
+            if archive_path is not None:
+                result['session_archive'] = archive_result(archive_path,result,job['crop'],job['lines'])
+                del result['masks']
+        finally:
+            shutil.rmtree(tile_dir,ignore_errors=True)
+        return job['id'],result,time.perf_counter()-t_start,None
+    except Exception:
+        return job['id'],None,time.perf_counter()-t_start,traceback.format_exc()
+
+def read_checkpoint(checkpoint_path):
+    # Ids of the jobs that finished in earlier runs
+    done = set()
+    if not os.path.isfile(checkpoint_path):
+        return done
+    with open(checkpoint_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line cut short by a crash
+                continue
+            if record['status']=='done':
+                done.add(record['job'])
+    return done
+
+def write_checkpoint(checkpoint_path,record):
+    record = dict(record,timestamp=datetime.datetime.now().isoformat())
+    with open(checkpoint_path,'a') as f:
+        f.write(json.dumps(record,default=str)+'\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def run_batch(job_file,n_workers=None,restart=False):
+    '''
+    Runs the jobs of job_file that haven't finished yet on a process pool
+    Results are saved by this process as each job finishes, then the job is added
+    to the checkpoint file (<job file>_checkpoint.jsonl). Failed jobs are logged
+    there with their traceback and run again on the next call.
+    Returns the number of jobs that finished, failed and were skipped
+    '''
+    jobs,df_path = load_jobs(job_file)
+    checkpoint_path = os.path.splitext(job_file)[0] + '_checkpoint.jsonl'
+    if restart and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+    done = read_checkpoint(checkpoint_path)
+    pending = [job for job in jobs if job['id'] not in done]
+    skipped = len(jobs)-len(pending)
+    if skipped:
+        print('Resuming: {} of {} jobs already finished'.format(skipped,len(jobs)))
+    for job in pending:
+        # Named by job id, so workers never write the same archive
+        job['archive_path'] = os.path.join(job['dir'],'analysis_results',
+                                           'session_' + job['id'] + archive_extension)
+    jobs_by_id = {job['id']:job for job in pending}
+    finished = 0
+    failed = 0
+    executor = ProcessPoolExecutor(max_workers=n_workers)
+    futures = [executor.submit(run_job,job) for job in pending]
+    try:
+        for future in as_completed(futures):
+            try:
+                job_id,result,run_time,error = future.result()
+            except Exception:
+                # The worker process died (e.g. out of memory), so the pool is broken
+                print('Worker process failed:\n' + traceback.format_exc())
+                print('Run the job file again to resume')
+                break
+            job = jobs_by_id[job_id]
+            if error is not None:
+                failed += 1
+                print('Job ' + job_id + ' failed:\n' + error)
+                write_checkpoint(checkpoint_path,{'job':job_id,'dir':job['dir'],'status':'failed',
+                                                  'run_time_s':run_time,'error':error})
+                continue
+            rows = result_rows(result,job['crop'],job['lines'],job['sample'],batch_job=job_id)
+            save_job_results(rows,job_id,job['dir'],df_path=df_path)
+            write_checkpoint(checkpoint_path,{'job':job_id,'dir':job['dir'],'status':'done',
+                                              'run_time_s':run_time,'frames':len(result['times']),
+                                              'growth_rates_umps':list(result['growth_rates']),
+                                              'settings':result['settings']})
+            finished += 1
+            print('[{}/{}] {}: '.format(skipped+finished+failed,len(jobs),job_id)
+                  + ', '.join('{:.3f}'.format(rate) for rate in result['growth_rates'])
+                  + ' um/s ({:.1f} s)'.format(run_time))
+    except KeyboardInterrupt:
+        print('Interrupted, run the job file again to resume')
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+    print('{} jobs finished, {} failed, {} skipped (already finished)'.format(finished,failed,skipped))
+    return finished,failed,skipped
+
+def main():
+    parser = argparse.ArgumentParser(description='Run growth rate analyses of the series '
+                                     'listed in a job file, resuming where the last run stopped')
+    parser.add_argument('job_file')
+    parser.add_argument('--workers',type=int,default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--restart',action='store_true',
+                        help='ignore the checkpoint and run every job again')
+    args = parser.parse_args()
+    run_batch(args.job_file,n_workers=args.workers,restart=args.restart)
+
+if __name__ == '__main__':
+    main()
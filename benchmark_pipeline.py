@@ -0,0 +1,173 @@
+# This program benchmarks the image processing hot paths of GrowthRateAnalyzer.py
+# on synthetic frames, so changes can be checked for speed regressions
+# Each run appends one JSON line per scenario to the output file, e.g.:
+#   python benchmark_pipeline.py --frames 100 1000 --lines 1 10 100
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import subprocess
+import tracemalloc
+import numpy as np
+import fast_kernels
+from GrowthRateAnalyzer import (threshold_crop_denoise, subtract_and_denoise,
+                                get_growth_edge, compute_distances, fit_distances)
+
+def synthetic_frame(k,width,height,rng,growth_px_per_frame=1.0,r0=50):
+    '''
+    Gray scale frame with a bright circular grain of radius r0+k*growth_px_per_frame
+    centered in the image, on a noisy amorphous background
+    '''
+    yy,xx = np.ogrid[0:height,0:width]
+    radius = r0 + k*growth_px_per_frame
+    img = rng.normal(70,8,(height,width))
+    img[(yy-height/2)**2 + (xx-width/2)**2 < radius**2] += 90
+    return np.clip(img,0,255).astype(np.uint8)
+
+def radial_lines(n_lines,width,height,length):
+    # Lines from the grain center, evenly spaced in angle
+    cx,cy = width/2,height/2
+    angles = np.linspace(0,2*np.pi,n_lines,endpoint=False)
+    return [[(cx,cy),(cx+length*np.cos(a),cy+length*np.sin(a))] for a in angles]
+
+class StageRecorder(object):
+    # Accumulates run time, call count and peak traced memory for one stage
+    def __init__(self):
+        self.total_s = 0
+        self.calls = 0
+        self.peak_bytes = 0
+    def run(self,func,*args,**kwargs):
+        if self.calls == 0:
+            # Peak memory of one call is measured in a separate traced call,
+            # since tracing would slow down the timed calls
+            tracemalloc.start()
+            func(*args,**kwargs)
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        t_start = time.perf_counter()
+        result = func(*args,**kwargs)
+        self.total_s += time.perf_counter() - t_start
+        self.calls += 1
+        return result
+    def summary(self,n_frames):
+        return {'total_s':self.total_s,
+                'calls':self.calls,
+                'per_call_ms':1e3*self.total_s/max(self.calls,1),
+                'frames_per_s':n_frames/self.total_s if self.total_s else None,
+                'calls_per_s':self.calls/self.total_s if self.total_s else None,
+                'peak_mb':self.peak_bytes/1e6}
+
+def run_scenario(n_frames,n_lines,width,height,crop,disk_size,equalize_hist,seed=0):
+    rng = np.random.RandomState(seed)
+    x1,x2,y1,y2 = crop
+    lines = radial_lines(n_lines,x2-x1,y2-y1,length=min(x2-x1,y2-y1)/2-1)
+    # Grow from a small grain to nearly filling the crop by the last frame
+    growth = (min(x2-x1,y2-y1)/2-60)/max(n_frames-1,1)
+    stages = {name:StageRecorder() for name in
+              ['threshold_crop_denoise','subtract_and_denoise','get_growth_edge',
+               'extract_growth_rates_loop']}
+    denoised_images = []
+    previous = None
+    for k in range(n_frames):
+        # Frames are generated one at a time, so only one full frame is held at once.
+        # The despeckled crops are all kept for the extraction loop (about 0.64 MB
+        # each for an 800x800 crop, 640 MB for 1000 frames).
+        img = synthetic_frame(k,width,height,rng,growth_px_per_frame=growth)
+        denoised = stages['threshold_crop_denoise'].run(
+            threshold_crop_denoise,None,x1,x2,y1,y2,120,256,disk_size,img=img,
+            equalize_hist=equalize_hist)[0]
+        denoised_images.append(denoised)
+        if previous is not None:
+            stages['subtract_and_denoise'].run(
+                subtract_and_denoise,None,None,x1,x2,y1,y2,disk_size,threshold=0.2,
+                img1=previous,img2=img,equalize_hist=equalize_hist)
+        for line in lines:
+            stages['get_growth_edge'].run(get_growth_edge,denoised,line,1.0)
+        previous = img
+    times = np.arange(n_frames,dtype=float)
+    def extract_loop():
+        distances = compute_distances(denoised_images,lines,1.0)
+        return fit_distances(times,distances)[0].get_params()
+    slopes = stages['extract_growth_rates_loop'].run(extract_loop)[0]
+    return {name:stage.summary(n_frames) for name,stage in stages.items()},float(np.median(slopes))
+
+def measure_startup(module_name,repeats=3):
+    '''
+    Time (s) to import an analyzer module in a fresh interpreter, i.e. the delay
+    before its window can be created. Returns the fastest of repeats runs.
+    '''
+    code = ('import time; t_start = time.perf_counter(); import ' + module_name
+            + '; print(time.perf_counter() - t_start)')
+    times = []
+    for _ in range(repeats):
+        try:
+            output = subprocess.check_output([sys.executable,'-c',code],
+                                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                                             stderr=subprocess.DEVNULL)
+            times.append(float(output.decode().strip().splitlines()[-1]))
+        except Exception:
+            return None
+    return min(times)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the growth rate image processing')
+    parser.add_argument('--frames',type=int,nargs='+',default=[100])
+    parser.add_argument('--lines',type=int,nargs='+',default=[1,10,100])
+    parser.add_argument('--width',type=int,default=2048)
+    parser.add_argument('--height',type=int,default=1536)
+    parser.add_argument('--crop',type=int,nargs=4,default=None,metavar=('X1','X2','Y1','Y2'),
+                        help='crop region, default is a centered 800x800 crop')
+    parser.add_argument('--disk',type=int,default=5)
+    parser.add_argument('--equalize-hist',action='store_true')
+    parser.add_argument('--no-jit',action='store_true',
+                        help='use the NumPy kernels even if numba is installed')
+    parser.add_argument('--output',default='benchmark_results.jsonl')
+    args = parser.parse_args()
+    fast_kernels.set_jit(not args.no_jit)
+    crop = args.crop
+    if crop is None:
+        half = min(400,args.width//2,args.height//2)
+        crop = (args.width//2-half,args.width//2+half,args.height//2-half,args.height//2+half)
+    startup = {name:measure_startup(name) for name in
+               ['GrowthRateAnalyzer','ManualGrowthRateAnalyzer']}
+    for name,startup_s in startup.items():
+        print('{} import: {}'.format(name,'failed' if startup_s is None
+                                     else '{:.2f} s'.format(startup_s)))
+    base_record = {'timestamp':datetime.datetime.now().isoformat(),
+                   'commit':git_commit(),
+                   'python':platform.python_version(),
+                   'numpy':np.__version__,
+                   'machine':platform.platform(),
+                   'width':args.width,'height':args.height,'crop':list(crop),
+                   'disk':args.disk,'equalize_hist':args.equalize_hist,
+                   'jit':fast_kernels.jit_enabled,
+                   'startup_s':startup}
+    with open(args.output,'a') as f:
+        for n_frames in args.frames:
+            for n_lines in args.lines:
+                stages,slope = run_scenario(n_frames,n_lines,args.width,args.height,crop,
+                                            args.disk,args.equalize_hist)
+                record = dict(base_record,frames=n_frames,lines=n_lines,stages=stages,
+                              median_growth_px_per_frame=slope)
+                f.write(json.dumps(record)+'\n')
+                print('frames=' + str(n_frames) + ', lines=' + str(n_lines))
+                for name,stage in stages.items():
+                    # get_growth_edge runs once per frame and line, so frames/s and calls/s differ
+                    print('  {:<28s}{:10.1f} ms/call {:10.1f} calls/s {:10.1f} frames/s {:8.1f} MB'.format(
+                        name,stage['per_call_ms'],stage['calls_per_s'] or 0,
+                        stage['frames_per_s'] or 0,stage['peak_mb']))
+    print('results appended to ' + args.output)
+
+if __name__ == '__main__':
+    main()
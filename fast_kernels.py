@@ -0,0 +1,253 @@
+# Optional JIT compiled kernels for the per-pixel image processing
+# Thresholding followed by the binary despeckle, and sampling masks along lines,
+# each make several full size temporary arrays with NumPy. With numba installed,
+# they run as compiled passes instead. Without numba, the NumPy / scikit-image code
+# is used, and the results are identical either way. Run this file to check that
+# and to time both:
+#   python fast_kernels.py
+import importlib.util
+import time
+import numpy as np
+from lazy_imports import LazyImport
+median = LazyImport('skimage.filters.rank','median')
+disk = LazyImport('skimage.morphology','disk')
+
+numba_available = importlib.util.find_spec('numba') is not None
+# Turned off to force the NumPy kernels, e.g. for comparisons
+jit_enabled = numba_available
+# Compiled on first use, since importing numba and compiling takes a few seconds
+_jit_kernels = None
+
+def set_jit(enabled):
+    global jit_enabled
+    jit_enabled = bool(enabled) and numba_available
+    return jit_enabled
+
+def _get_jit_kernels():
+    global _jit_kernels
+    if _jit_kernels is None:
+        _jit_kernels = _compile_jit_kernels()
+    return _jit_kernels
+
+def _compile_jit_kernels():
+    import numba
+
+    @numba.njit(cache=True)
+    def disk_majority(row_sums,half_widths,out):
+        # 255 where at least half of the disk (inside the image) is on, which is
+        # what the rank median gives for binary masks
+        height,width = out.shape
+        d = half_widths.shape[0]//2
+        for i in range(height):
+            for j in range(width):
+                count = 0
+                pop = 0
+                for k in range(half_widths.shape[0]):
+                    r = i+k-d
+                    if r<0 or r>=height:
+                        continue
+                    lo = max(j-half_widths[k],0)
+                    hi = min(j+half_widths[k]+1,width)
+                    count += row_sums[r,hi]-row_sums[r,lo]
+                    pop += hi-lo
+                out[i,j] = 255 if 2*count>=pop else 0
+        return out
+
+    @numba.njit(cache=True)
+    def binary_despeckle(mask,half_widths,out):
+        # Running sums along each row, then the majority in the disk
+        height,width = mask.shape
+        row_sums = np.zeros((height,width+1),dtype=np.int32)
+        for i in range(height):
+            run = 0
+            for j in range(width):
+                if mask[i,j]:
+                    run += 1
+                row_sums[i,j+1] = run
+        return disk_majority(row_sums,half_widths,out)
+
+    @numba.njit(cache=True)
+    def threshold_despeckle(cropped,lower,upper,threshold_out,half_widths,thresholded,out):
+        # Thresholds and sums each row in the same pass, then takes the majority
+        # Branch free, since noisy images make the comparisons unpredictable
+        height,width = cropped.shape
+        n_ranges = lower.shape[0]
+        row_sums = np.zeros((height,width+1),dtype=np.int32)
+        for i in range(height):
+            run = 0
+            for j in range(width):
+                v = cropped[i,j]
+                inside_any = False
+                outside_all = True
+                for r in range(n_ranges):
+                    inside_any = inside_any | ((v>lower[r]) & (v<upper[r]))
+                    outside_all = outside_all & ((v<lower[r]) | (v>upper[r]))
+                on = outside_all if threshold_out else inside_any
+                thresholded[i,j] = on
+                run += on
+                row_sums[i,j+1] = run
+        return disk_majority(row_sums,half_widths,out)
+
+    @numba.njit(cache=True)
+    def sample_mask(mask,rows,cols,out):
+        for k in range(rows.shape[0]):
+            out[k] = mask[rows[k],cols[k]]>0
+        return out
+
+    return {'binary_despeckle':binary_despeckle,
+            'threshold_despeckle':threshold_despeckle,
+            'sample_mask':sample_mask}
+
+def _comparison_bounds(cropped,thresholds):
+    # Float thresholds are rounded to the type NumPy compares them in (e.g. float32
+    # for float32 images), so both kernels agree on pixels right at a threshold.
+    # Integers are exact in float64.
+    bounds = []
+    for t in thresholds:
+        if isinstance(t,(float,np.floating)):
+            t = np.asarray(t,dtype=np.result_type(cropped,t))
+        bounds.append(float(t))
+    return np.array(bounds,dtype=np.float64)
+
+def disk_half_widths(d):
+    # Half width of each row of disk(d)
+    return np.array([int(np.sqrt(d*d-dy*dy)) for dy in range(-d,d+1)],dtype=np.intp)
+
+def threshold_ranges(cropped,threshold_lower,threshold_upper,threshold_out=False):
+    '''
+    Boolean mask of the pixels inside any of the ranges (lists of lower and upper
+    thresholds), or outside all of them with threshold_out
+    NumPy's vectorized comparisons beat a compiled loop on their own, so JIT is
+    only used with the threshold fused into the despeckle (threshold_despeckle)
+    '''
+    if not threshold_out:
+        thresholded = np.logical_and(cropped>threshold_lower[0],cropped<threshold_upper[0])
+        for r_idx in range(1,len(threshold_lower)):
+            temp = np.logical_and(cropped>threshold_lower[r_idx],cropped<threshold_upper[r_idx])
+            thresholded = np.logical_or(thresholded,temp)
+    else:
+        thresholded = np.logical_or(cropped<threshold_lower[0],cropped>threshold_upper[0])
+        for r_idx in range(1,len(threshold_lower)):
+            temp = np.logical_or(cropped<threshold_lower[r_idx],cropped>threshold_upper[r_idx])
+            thresholded = np.logical_and(thresholded,temp)
+    return thresholded
+
+def despeckle(thresholded,d):
+    '''
+    Median filter with a disk of radius d, as skimage.filters.rank.median
+    Binary masks use the JIT kernel (0/255 uint8 output), anything else the rank filter
+    '''
+    if thresholded.dtype==bool:
+        if jit_enabled:
+            out = np.empty(thresholded.shape,dtype=np.uint8)
+            return _get_jit_kernels()['binary_despeckle'](thresholded,disk_half_widths(d),out)
+        # Newer scikit-image rank filters don't take bool images
+        thresholded = thresholded.astype(np.uint8)*255
+    return median(thresholded,disk(d))
+
+def threshold_despeckle(cropped,threshold_lower,threshold_upper,d,threshold_out=False):
+    '''
+    threshold_ranges followed by despeckle, fused into one compiled pass with JIT
+    Returns the despeckled and the thresholded masks
+    '''
+    if jit_enabled:
+        thresholded = np.empty(cropped.shape,dtype=bool)
+        out = np.empty(cropped.shape,dtype=np.uint8)
+        _get_jit_kernels()['threshold_despeckle'](
+            np.asarray(cropped),_comparison_bounds(cropped,threshold_lower),
+            _comparison_bounds(cropped,threshold_upper),bool(threshold_out),
+            disk_half_widths(d),thresholded,out)
+        return out,thresholded
+    thresholded = threshold_ranges(cropped,threshold_lower,threshold_upper,threshold_out=threshold_out)
+    return despeckle(thresholded,d),thresholded
+
+def sample_mask(mask,rows,cols):
+    # mask[rows,cols]>0 for index arrays of any shape
+    mask = np.asarray(mask)
+    if jit_enabled:
+        out = np.empty(rows.size,dtype=bool)
+        _get_jit_kernels()['sample_mask'](mask,rows.ravel(),cols.ravel(),out)
+        return out.reshape(rows.shape)
+    return mask[rows,cols]>0
+
+def check_despeckle(shape=(200,240),seed=0,disks=(1,2,3,5,9),densities=(0.1,0.3,0.5,0.7,0.9)):
+    '''
+    Compares despeckle of random binary masks with skimage.filters.rank.median of
+    the same masks as uint8 0/255 images, for several disk sizes and densities of
+    crystalline pixels. Raises an AssertionError if any pixel differs.
+    '''
+    rng = np.random.RandomState(seed)
+    for density in densities:
+        mask = rng.uniform(size=shape)<density
+        reference_image = mask.astype(np.uint8)*255
+        for d in disks:
+            reference = median(reference_image,disk(d))
+            result = despeckle(mask,d)
+            assert result.dtype==np.uint8, 'despeckle returned ' + str(result.dtype)
+            assert np.array_equal(result,reference), \
+                'despeckle differs from the rank median for disk {}, density {} ({} pixels)'.format(
+                    d,density,int((result!=reference).sum()))
+    print('despeckle matches the rank median for disks {} and densities {} (JIT {})'.format(
+        list(disks),list(densities),'on' if jit_enabled else 'off'))
+
+def check_kernels(shape=(800,800),seed=0,d=5):
+    '''
+    Runs every kernel with and without JIT on noisy test images, raises an
+    AssertionError if the outputs differ, and prints the run times
+    The despeckle of both is first checked against the rank median (check_despeckle)
+    '''
+    jit_previous = jit_enabled
+    try:
+        for jit in (False,True) if numba_available else (False,):
+            set_jit(jit)
+            check_despeckle(seed=seed)
+    finally:
+        set_jit(jit_previous)
+    if not numba_available:
+        print('numba is not installed, only the NumPy kernels are used')
+        return
+    rng = np.random.RandomState(seed)
+    # A bright grain on a noisy background, in uint8 and in float32 (after CLAHE)
+    yy,xx = np.mgrid[0:shape[0],0:shape[1]]
+    img = 70 + 90*(np.hypot(yy-shape[0]/2,xx-shape[1]/2)<shape[0]/3) + rng.normal(0,25,shape)
+    images = {'uint8':np.clip(img,0,255).astype(np.uint8),
+              'float32':(np.clip(img,0,255)/255).astype(np.float32)*255}
+    cases = [('one range',[120.3],[256],False),
+             ('two ranges',[20,120.97],[60.5,256],False),
+             ('outside',[60.25,200],[120,230.5],True)]
+    rows = rng.randint(0,shape[0],10000)
+    cols = rng.randint(0,shape[1],10000)
+    kernels = ['threshold','threshold+despeckle','despeckle','sample']
+    jit_previous = jit_enabled
+    try:
+        # Compile first, so the JIT times don't include compilation
+        set_jit(True)
+        for image in images.values():
+            # Crops are strided views, whole images contiguous
+            for small in (image[:32,:32],image[:32,:32].copy()):
+                sample_mask(despeckle(threshold_despeckle(small,[120.5],[256],d)[1],d),rows%32,cols%32)
+        for dtype,image in images.items():
+            for name,lower,upper,out in cases:
+                results = {}
+                for jit in (False,True):
+                    set_jit(jit)
+                    t_start = time.perf_counter()
+                    denoised,thresholded = threshold_despeckle(image,lower,upper,d,threshold_out=out)
+                    t_fused = time.perf_counter()
+                    despeckled = despeckle(thresholded,d)
+                    t_despeckle = time.perf_counter()
+                    sampled = sample_mask(denoised,rows,cols)
+                    t_sample = time.perf_counter()
+                    results[jit] = (thresholded,denoised,despeckled,sampled,
+                                    (t_fused-t_start,t_despeckle-t_fused,t_sample-t_despeckle))
+                for idx,kernel in enumerate(kernels):
+                    assert np.array_equal(results[False][idx],results[True][idx]), \
+                        kernel + ' differs for ' + dtype + ', ' + name
+                print('{:8s} {:11s} identical. NumPy / JIT ms: '.format(dtype,name) + ', '.join(
+                    '{} {:.1f} / {:.1f}'.format(kernel,1e3*t_numpy,1e3*t_jit) for kernel,t_numpy,t_jit
+                    in zip(kernels[1:],results[False][4],results[True][4])))
+    finally:
+        set_jit(jit_previous)
+
+if __name__ == '__main__':
+    check_kernels()
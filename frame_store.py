@@ -0,0 +1,224 @@
+# Image buffers with memory accounting, and a memory budget shared between them
+# Long series at high magnification can hold several GB of frames and masks.
+# When the budget is exceeded, caches are dropped, masks are bit packed and the
+# least recently used frames are spilled to .npy files in a temporary directory
+import os
+import atexit
+import shutil
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+class FrameStore(object):
+    ''' FrameStore
+    List-like container of image arrays that counts the bytes held in memory
+    name is shown in the memory usage (e.g. 'frames', 'masks')
+    allow_downcast lets the budget bit pack binary masks (8x smaller). Packed
+        masks are unpacked on access, so they come back with the same values.
+    Spilled frames are returned as read-only memory maps of the .npy file
+    Frames stored as memory maps (e.g. by tiled processing) are already on disk,
+    so they don't count against the budget and are never packed or spilled
+    '''
+    def __init__(self,name,allow_downcast=False):
+        self.name = name
+        self.allow_downcast = allow_downcast
+        self.budget = None
+        self.spill_dir = None
+        self.clear()
+
+    def clear(self):
+        self.frames = []
+        # Bit packed masks: index -> (shape,dtype,on value)
+        self.packed = {}
+        # Spilled frames: index -> .npy path
+        self.spilled = {}
+        # Access order of in-memory frames, least recently used first
+        self.access_order = OrderedDict()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir,ignore_errors=True)
+            self.spill_dir = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        for idx in range(len(self.frames)):
+            yield self[idx]
+
+    def _index(self,idx):
+        if idx < 0:
+            idx += len(self.frames)
+        if not 0 <= idx < len(self.frames):
+            raise IndexError('FrameStore index out of range')
+        return idx
+
+    def __getitem__(self,idx):
+        idx = self._index(idx)
+        if idx in self.spilled:
+            return np.load(self.spilled[idx],mmap_mode='r')
+        if idx in self.access_order:
+            self.access_order.move_to_end(idx)
+        if idx in self.packed:
+            shape,dtype,value = self.packed[idx]
+            mask = np.unpackbits(self.frames[idx])[:int(np.prod(shape))].reshape(shape)
+            return (mask*value).astype(dtype)
+        return self.frames[idx]
+
+    def __setitem__(self,idx,img):
+        idx = self._index(idx)
+        self._forget(idx)
+        self.frames[idx] = img
+        if isinstance(img,np.memmap):
+            self.access_order.pop(idx,None)
+        else:
+            self.access_order[idx] = True
+        if self.budget is not None:
+            self.budget.enforce()
+
+    def append(self,img):
+        self.frames.append(None)
+        self[len(self.frames)-1] = img
+
+    def _forget(self,idx):
+        self.packed.pop(idx,None)
+        path = self.spilled.pop(idx,None)
+        if path is not None and os.path.isfile(path):
+            try:
+                os.remove(path)
+            except OSError:
+                # Still memory mapped somewhere (Windows), removed with the directory
+                pass
+
+    def nbytes(self):
+        # Bytes held in memory (spilled frames don't count)
+        return sum(self.frames[idx].nbytes for idx in self.access_order
+                   if isinstance(self.frames[idx],np.ndarray))
+
+    def downcast(self):
+        '''
+        Bit packs binary masks (all values 0 or one other value)
+        Returns the number of bytes freed
+        '''
+        freed = 0
+        for idx in list(self.access_order):
+            img = self.frames[idx]
+            if idx in self.packed or not isinstance(img,np.ndarray) or img.size == 0:
+                continue
+            value = img.max()
+            if not np.all((img == 0) | (img == value)):
+                continue
+            packed = np.packbits(img.ravel() != 0)
+            freed += img.nbytes - packed.nbytes
+            self.packed[idx] = (img.shape,img.dtype,value)
+            self.frames[idx] = packed
+        return freed
+
+    def spill(self,n_bytes):
+        '''
+        Writes least recently used frames to disk until at least n_bytes are freed
+        Returns the number of bytes freed
+        '''
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='growth_rate_'+self.name+'_')
+            atexit.register(shutil.rmtree,self.spill_dir,True)
+        freed = 0
+        while freed < n_bytes and self.access_order:
+            idx = next(iter(self.access_order))
+            img = self[idx] # unpacks packed masks
+            path = os.path.join(self.spill_dir,'{:06d}.npy'.format(idx))
+            np.save(path,img)
+            freed += self.frames[idx].nbytes
+            del self.access_order[idx]
+            self.packed.pop(idx,None)
+            self.frames[idx] = None
+            self.spilled[idx] = path
+        return freed
+
+class MemoryBudget(object):
+    ''' MemoryBudget
+    Memory accounting for FrameStores and caches, with an optional limit
+    budget_mb = None only counts memory. When the total goes over budget_mb,
+    memory is freed in this order until it fits:
+      1. caches registered with add_cache are cleared (they are recomputed when needed)
+      2. stores with allow_downcast bit pack their binary masks
+      3. least recently used frames are spilled to disk, stores in the order added
+    '''
+    def __init__(self,budget_mb=None):
+        self.budget_mb = budget_mb
+        self.stores = []
+        # name -> (function returning bytes, function clearing the cache)
+        self.caches = OrderedDict()
+        self.enforcing = False
+
+    def add_store(self,store):
+        store.budget = self
+        self.stores.append(store)
+        return store
+
+    def add_cache(self,name,nbytes_func,clear_func):
+        self.caches[name] = (nbytes_func,clear_func)
+
+    def usage(self):
+        # Bytes held by each store and cache
+        usage = OrderedDict((store.name,store.nbytes()) for store in self.stores)
+        for name,(nbytes_func,clear_func) in self.caches.items():
+            usage[name] = nbytes_func()
+        return usage
+
+    def total_bytes(self):
+        return sum(self.usage().values())
+
+    def excess_bytes(self):
+        if self.budget_mb is None:
+            return 0
+        return max(self.total_bytes() - self.budget_mb*1e6,0)
+
+    def enforce(self):
+        '''
+        Frees memory until the total is within budget
+        Returns a list of the actions taken
+        '''
+        if self.enforcing or self.excess_bytes() == 0:
+            return []
+        # Clearing caches or spilling may access the stores again
+        self.enforcing = True
+        actions = []
+        try:
+            for name,(nbytes_func,clear_func) in self.caches.items():
+                if nbytes_func() > 0:
+                    clear_func()
+                    actions.append('cleared ' + name)
+                    if self.excess_bytes() == 0:
+                        return actions
+            for store in self.stores:
+                if store.allow_downcast:
+                    freed = store.downcast()
+                    if freed:
+                        actions.append('packed {} ({:.0f} MB)'.format(store.name,freed/1e6))
+                        if self.excess_bytes() == 0:
+                            return actions
+            for store in self.stores:
+                freed = store.spill(self.excess_bytes())
+                if freed:
+                    actions.append('spilled {} ({:.0f} MB)'.format(store.name,freed/1e6))
+                    if self.excess_bytes() == 0:
+                        return actions
+        finally:
+            self.enforcing = False
+            if actions:
+                print('Memory budget exceeded: ' + ', '.join(actions))
+        return actions
+
+    def format_usage(self):
+        usage = self.usage()
+        text = 'Memory: {:.0f} MB'.format(sum(usage.values())/1e6)
+        if self.budget_mb is not None:
+            text += ' / {:.0f} MB'.format(self.budget_mb)
+        details = ', '.join('{} {:.0f}'.format(name,n_bytes/1e6)
+                            for name,n_bytes in usage.items() if n_bytes > 0)
+        if details:
+            text += ' (' + details + ')'
+        spilled = sum(len(store.spilled) for store in self.stores)
+        if spilled:
+            text += ', {} frames on disk'.format(spilled)
+        return text
@@ -0,0 +1,58 @@
+# Deferred imports, so the analyzer windows appear before the heavy scientific
+# packages (pandas, scikit-image, imageio, palettable) are loaded
+# A module is imported the first time one of its attributes is used or called
+import importlib
+import threading
+
+class LazyImport(object):
+    ''' LazyImport
+    Stands in for a module, or an attribute of a module, until it is first used
+        pd = LazyImport('pandas')
+        median = LazyImport('skimage.filters.rank','median')
+        pd.DataFrame()      # imports pandas
+        median(img,disk(5)) # imports skimage.filters.rank
+    '''
+    def __init__(self,module_name,attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)
+            if self._attribute is not None:
+                target = getattr(target,self._attribute)
+            self._target = target
+        return self._target
+
+    def __getattr__(self,name):
+        # Only called for attributes not set in __init__
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._load(),name)
+
+    def __call__(self,*args,**kwargs):
+        return self._load()(*args,**kwargs)
+
+    def __repr__(self):
+        name = self._module_name
+        if self._attribute is not None:
+            name += '.' + self._attribute
+        state = 'loaded' if self._target is not None else 'not loaded'
+        return '<LazyImport ' + name + ' (' + state + ')>'
+
+def preload(*lazy_imports):
+    '''
+    Imports the given LazyImports in a background thread, so they are usually
+    ready by the time they are first used. Call after the window is shown.
+    '''
+    def load_all():
+        for lazy in lazy_imports:
+            try:
+                lazy._load()
+            except Exception as e:
+                # Report it now, the error is raised again on first use
+                print('Could not import ' + repr(lazy) + ': ' + str(e))
+    thread = threading.Thread(target=load_all,daemon=True)
+    thread.start()
+    return thread
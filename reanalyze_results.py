@@ -0,0 +1,228 @@
+# This program re-runs the analyses stored in saved DataFrames (dataframes/*.pkl)
+# Every row records the files, crop region, direction and settings of its run, so
+# the runs can be reconstructed and processed again without the GUI, e.g. with
+# drift following or front tracking, or with changed thresholds. Each call writes
+# a new numbered result set with a report comparing old and new growth rates:
+#   python reanalyze_results.py dataframes/*.pkl --set drift=Automatic --workers 4
+import os
+import sys
+import glob
+import json
+import argparse
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from GrowthRateAnalyzer import pd
+from batch_analysis import default_settings, run_job, result_rows
+from run_log import settings_hash
+from session_archive import archive_extension, read_session_archive
+
+# Columns written by Save Results that describe the run rather than the sample
+run_columns = ['growth_rate_umps','line','x1,x2,y1,y2','image_files','image_dir',
+               'threshold_lower','threshold_upper','disk','histogram_equalization',
+               'edge_find_method','drift','track_fronts','max_velocity',
+               'batch_job','session_archive']
+
+def archived_settings(row,path_map=(),archives=None):
+    '''
+    Settings stored in the session archive of a row ({} without one, or if it
+    can't be read). archives caches the settings by archive path.
+    '''
+    path = row.get('session_archive')
+    if not isinstance(path,str):
+        return {}
+    path = map_path(path,path_map)
+    if archives is None:
+        archives = {}
+    if path not in archives:
+        archives[path] = {}
+        if os.path.isfile(path):
+            try:
+                archives[path] = read_session_archive(path,keys=())['metadata']['settings']
+            except Exception as e:
+                print('Could not read ' + path + ': ' + str(e))
+    return archives[path]
+
+def row_settings(row,path_map=(),archives=None):
+    '''
+    Settings of the run that saved a row (see batch_analysis.default_settings)
+    They are read from the row's session archive where it can be found. Otherwise
+    they come from the row's columns, and Threshold Out, the clip limit and the
+    time source take their defaults. So do drift, front tracking and the maximum
+    velocity in rows saved before they were stored.
+    '''
+    settings = dict(default_settings)
+    settings.update({'method':row['edge_find_method'],'disk':int(row['disk']),
+                     'threshold_lower':row['threshold_lower'],
+                     'threshold_upper':row['threshold_upper'],
+                     'equalize_hist':bool(row['histogram_equalization'])})
+    for key in ('drift','track_fronts','max_velocity'):
+        value = row.get(key)
+        if value is not None and not (np.isscalar(value) and pd.isnull(value)):
+            settings[key] = value
+    settings.update({key:value for key,value in archived_settings(row,path_map,archives).items()
+                     if key in default_settings and value is not None})
+    return settings
+
+def map_path(path,path_map):
+    # Replaces the first matching prefix of path (old,new pairs), for moved data
+    path = path.replace('\\','/')
+    for old,new in path_map:
+        old = old.replace('\\','/')
+        if path.startswith(old):
+            return new + path[len(old):]
+    return path
+
+def stored_runs(df_files,path_map=()):
+    '''
+    Groups the rows of the DataFrames in df_files into runs: rows of one file with
+    the same files, crop region and settings, one row per direction
+    Returns a list of jobs for batch_analysis.run_job, each with the source rows
+    '''
+    runs = OrderedDict()
+    archives = {}
+    for df_file in df_files:
+        df = pd.read_pickle(df_file)
+        for index,row in df.iterrows():
+            settings = row_settings(row,path_map=path_map,archives=archives)
+            key = (df_file,row['image_dir'],tuple(row['image_files']),
+                   tuple(int(x) for x in row['x1,x2,y1,y2']),
+                   settings_hash(settings))
+            if key not in runs:
+                runs[key] = {'dir':map_path(row['image_dir'],path_map),
+                             'files':list(row['image_files']),
+                             'crop':[int(x) for x in row['x1,x2,y1,y2']],
+                             'lines':[],'settings':settings,'source_df':df_file,
+                             'source_rows':[]}
+            runs[key]['lines'].append([[float(x),float(y)] for x,y in row['line']])
+            runs[key]['source_rows'].append((index,row))
+    jobs = list(runs.values())
+    for job in jobs:
+        job['id'] = settings_hash({key:job[key] for key in ('dir','files','crop','lines',
+                                                            'settings','source_df')})
+    return jobs
+
+def next_version_dir(out_dir):
+    # out_dir/v001, v002, ... so earlier result sets are never overwritten
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    versions = [int(name[1:]) for name in os.listdir(out_dir)
+                if name.startswith('v') and name[1:].isdigit()]
+    version_dir = os.path.join(out_dir,'v{:03d}'.format(max(versions,default=0)+1))
+    os.mkdir(version_dir)
+    return version_dir
+
+def reanalyze(df_files,overrides=None,path_map=(),out_dir='reanalysis',n_workers=None):
+    '''
+    Re-runs every stored run in df_files with the settings in overrides replacing
+    the stored ones, and saves to a new version directory in out_dir:
+      df.pkl / growth_rates_data.csv   new rows, with the columns of the source rows
+                                       and source_df, source_index
+      diff_report.csv                  old and new growth rate of every row
+      reanalysis.json                  sources, overrides and a summary
+      archives/                        a session archive of each run
+    Runs whose files can't be found or that fail are reported, not saved
+    Returns the version directory and the diff report
+    '''
+    overrides = overrides or {}
+    jobs = stored_runs(df_files,path_map=path_map)
+    for job in jobs:
+        job['settings'] = dict(job['settings'],**overrides)
+    version_dir = next_version_dir(out_dir)
+    print('Re-analyzing {} runs ({} rows) from {} files into {}'.format(
+        len(jobs),sum(len(job['lines']) for job in jobs),len(df_files),version_dir))
+    runnable = [job for job in jobs if os.path.isdir(job['dir'])]
+    for job in runnable:
+        job['archive_path'] = os.path.join(version_dir,'archives',job['id'] + archive_extension)
+    results = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        # Only what run_job needs is sent to the workers
+        for job_id,result,run_time,error in executor.map(
+                run_job,[{key:job[key] for key in ('id','dir','files','crop','lines','settings',
+                                                    'archive_path')}
+                         for job in runnable]):
+            results[job_id] = (result,error)
+            if error is not None:
+                print('Run ' + job_id + ' failed:\n' + error)
+    new_rows = []
+    report = []
+    for job in jobs:
+        result,error = results.get(job['id'],(None,'directory not found: ' + job['dir']))
+        rows = None
+        if result is not None:
+            rows = result_rows(result,job['crop'],job['lines'])
+        for line_idx,(index,source_row) in enumerate(job['source_rows']):
+            old_rate = source_row['growth_rate_umps']
+            record = {'source_df':job['source_df'],'source_index':index,
+                      'image_dir':job['dir'],'line_number':line_idx+1,
+                      'old_growth_rate_umps':old_rate,'new_growth_rate_umps':np.nan,
+                      'difference_umps':np.nan,'relative_difference':np.nan,
+                      'status':'failed' if error is not None else 'ok',
+                      'error':error.strip().split('\n')[-1] if error is not None else ''}
+            if rows is not None:
+                # Sample properties and anything else saved with the row are kept
+                row = {key:value for key,value in source_row.items() if key not in run_columns}
+                row.update(rows[line_idx])
+                row['source_df'] = job['source_df']
+                row['source_index'] = index
+                new_rows.append(row)
+                new_rate = rows[line_idx]['growth_rate_umps']
+                record['new_growth_rate_umps'] = new_rate
+                record['difference_umps'] = new_rate-old_rate
+                record['relative_difference'] = (new_rate-old_rate)/old_rate if old_rate else np.nan
+            report.append(record)
+    report = pd.DataFrame(report)
+    df = pd.DataFrame(new_rows)
+    df.to_pickle(os.path.join(version_dir,'df.pkl'))
+    df.to_csv(os.path.join(version_dir,'growth_rates_data.csv'))
+    report.to_csv(os.path.join(version_dir,'diff_report.csv'),index=False)
+    ok = report[report['status']=='ok']
+    summary = {'rows':len(report),'rows_reanalyzed':len(ok),
+               'rows_failed':int((report['status']=='failed').sum()),
+               'median_abs_difference_umps':float(np.nanmedian(np.abs(ok['difference_umps'])))
+                                            if len(ok) else None,
+               'rows_changed_over_10_percent':int((np.abs(ok['relative_difference'])>0.1).sum())}
+    with open(os.path.join(version_dir,'reanalysis.json'),'w') as f:
+        json.dump({'timestamp':datetime.datetime.now().isoformat(),
+                   'command':' '.join(sys.argv),'source_dfs':list(df_files),
+                   'overrides':overrides,'path_map':[list(pair) for pair in path_map],
+                   'summary':summary},f,indent=1,default=str)
+    print('{rows_reanalyzed} of {rows} rows re-analyzed, {rows_failed} failed. Median change '
+          '{median_abs_difference_umps} um/s, {rows_changed_over_10_percent} rows changed '
+          'by more than 10%'.format(**summary))
+    return version_dir,report
+
+def parse_overrides(assignments):
+    # key=value pairs, with values read as JSON where possible (numbers, true, lists)
+    overrides = {}
+    for assignment in assignments:
+        key,value = assignment.split('=',1)
+        if key not in default_settings:
+            raise ValueError('Unknown setting ' + key + ', see batch_analysis.default_settings')
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-run the analyses stored in saved '
+                                     'DataFrames with new settings, and compare the growth rates')
+    parser.add_argument('df_files',nargs='+',help='DataFrame pickles (wildcards are expanded)')
+    parser.add_argument('--set',dest='overrides',action='append',default=[],metavar='KEY=VALUE',
+                        help='setting replacing the stored one, e.g. drift=Automatic '
+                        'or track_fronts=true (repeat for more)')
+    parser.add_argument('--path-map',nargs=2,action='append',default=[],metavar=('OLD','NEW'),
+                        help='replace the start of stored image directories, for moved data')
+    parser.add_argument('--out',default='reanalysis',help='directory for the result sets')
+    parser.add_argument('--workers',type=int,default=None)
+    args = parser.parse_args()
+    df_files = []
+    for pattern in args.df_files:
+        df_files.extend(sorted(glob.glob(pattern)))
+    reanalyze(df_files,overrides=parse_overrides(args.overrides),path_map=args.path_map,
+              out_dir=args.out,n_workers=args.workers)
+
+if __name__ == '__main__':
+    main()
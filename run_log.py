@@ -0,0 +1,66 @@
+# Per-run metrics log for GrowthRateAnalyzer.py
+# Each growth rate extraction appends one JSON line to analysis_results/run_log.jsonl,
+# so run times and memory use can be compared across datasets and settings
+import os
+import sys
+import json
+import hashlib
+import datetime
+
+run_log_name = 'run_log.jsonl'
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of this process (MB) since it started
+    Returns None if it can't be read on this platform
+    '''
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            from ctypes import wintypes
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [('cb',wintypes.DWORD),
+                            ('PageFaultCount',wintypes.DWORD),
+                            ('PeakWorkingSetSize',ctypes.c_size_t),
+                            ('WorkingSetSize',ctypes.c_size_t),
+                            ('QuotaPeakPagedPoolUsage',ctypes.c_size_t),
+                            ('QuotaPagedPoolUsage',ctypes.c_size_t),
+                            ('QuotaPeakNonPagedPoolUsage',ctypes.c_size_t),
+                            ('QuotaNonPagedPoolUsage',ctypes.c_size_t),
+                            ('PagefileUsage',ctypes.c_size_t),
+                            ('PeakPagefileUsage',ctypes.c_size_t)]
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(counters),counters.cb)
+            return counters.PeakWorkingSetSize/1e6
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on mac and kilobytes on linux
+        if sys.platform == 'darwin':
+            return max_rss/1e6
+        return max_rss*1024/1e6
+    except Exception:
+        return None
+
+def settings_hash(settings):
+    '''
+    Short hash of the image processing settings, so runs with the same settings
+    can be grouped. Key order doesn't matter.
+    '''
+    settings_string = json.dumps(settings,sort_keys=True,default=str)
+    return hashlib.sha1(settings_string.encode()).hexdigest()[:12]
+
+def hit_rate(hits,misses):
+    if hits + misses == 0:
+        return None
+    return hits/(hits + misses)
+
+def write_run_log(save_dir,record):
+    # Append one run to the log in save_dir, adding a timestamp
+    if not os.path.isdir(save_dir):
+        os.mkdir(save_dir)
+    record = dict(record,timestamp=datetime.datetime.now().isoformat())
+    with open(os.path.join(save_dir,run_log_name),'a') as f:
+        f.write(json.dumps(record,default=str)+'\n')
@@ -0,0 +1,158 @@
+# Compressed archives of analysis runs
+# One file per run holds the frame times, front distances, fits, masks and settings,
+# so later questions about a run don't need the images processed again.
+# With h5py installed (conda install h5py), archives are HDF5 files (.h5): every
+# array is a chunked, gzip compressed dataset, and the masks are bit packed with one
+# frame per chunk, so single arrays or frames are read without the rest of the file.
+# Without h5py they are compressed .npz files, where arrays are also only read (and
+# decompressed) when used. Loading the distances of many runs in a notebook:
+#   from session_archive import load_archives
+#   runs = load_archives(glob.glob('D:/Data/**/session*.h5',recursive=True))
+#   runs[0]['times'], runs[0]['distances'], runs[0]['metadata']['settings']
+import os
+import json
+import datetime
+import importlib.util
+import numpy as np
+from lazy_imports import LazyImport
+h5py = LazyImport('h5py')
+
+h5py_available = importlib.util.find_spec('h5py') is not None
+# Extension of new archives
+archive_extension = '.h5' if h5py_available else '.npz'
+archive_version = 1
+# Arrays read by default (masks are read with read_masks)
+default_keys = ('times','distances','growth_rate_umps','intercept_um',
+                'growth_rate_stderr_umps','fit_mask','crop_windows')
+
+def pack_mask(mask):
+    # Bit packed rows of a mask (8 pixels per byte), nonzero pixels are True
+    return np.packbits(np.asarray(mask)>0,axis=1)
+
+def write_session_archive(path,times,distances,settings,fit=None,fit_mask=None,masks=None,
+                          lines=None,crop_region=None,crop_windows=None,image_files=None):
+    '''
+    Writes one run to path (.h5 needs h5py, .npz works without it)
+    times (frames), distances (lines x frames, um) and settings (dict) are required
+    fit is (growth rates, intercepts, standard errors) of the lines, and fit_mask the
+        points used in each fit
+    masks are the masks of each frame in time order, stored bit packed
+    lines, crop_region, crop_windows (x1,x2,y1,y2 of each frame) and image_files
+        describe where the distances were measured
+    The file is written under a temporary name and renamed, so an archive is never
+    left half written. Returns path.
+    '''
+    arrays = {'times':np.asarray(times,dtype=float),
+              'distances':np.asarray(distances,dtype=float)}
+    if fit is not None:
+        for key,values in zip(('growth_rate_umps','intercept_um','growth_rate_stderr_umps'),fit):
+            arrays[key] = np.asarray(values,dtype=float)
+    if fit_mask is not None:
+        arrays['fit_mask'] = np.asarray(fit_mask,dtype=bool)
+    if crop_windows is not None:
+        arrays['crop_windows'] = np.asarray(crop_windows,dtype=np.int64)
+    metadata = {'archive_version':archive_version,
+                'created':datetime.datetime.now().isoformat(),
+                'settings':settings,'lines':lines,'crop_region':crop_region,
+                'image_files':image_files,'mask_shape':None,'n_masks':0}
+    if masks is not None and len(masks)>0:
+        metadata['mask_shape'] = list(np.shape(masks[0]))
+        metadata['n_masks'] = len(masks)
+    metadata_string = json.dumps(metadata,default=lambda x: x.tolist() if hasattr(x,'tolist') else str(x))
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = path + '.tmp'
+    if path.endswith('.h5'):
+        if not h5py_available:
+            raise ImportError('h5py is needed for .h5 archives, use .npz instead')
+        with h5py.File(temp_path,'w') as f:
+            f.attrs['metadata'] = metadata_string
+            for key,values in arrays.items():
+                if values.size<1024:
+                    # Chunk and compression overhead would be larger than the data
+                    f.create_dataset(key,data=values)
+                else:
+                    f.create_dataset(key,data=values,chunks=True,compression='gzip',shuffle=True)
+            if metadata['n_masks']:
+                # One frame per chunk, written a frame at a time
+                packed = pack_mask(masks[0])
+                dataset = f.create_dataset('masks',shape=(len(masks),)+packed.shape,
+                                           dtype=np.uint8,chunks=(1,)+packed.shape,
+                                           compression='gzip')
+                for idx,mask in enumerate(masks):
+                    dataset[idx] = pack_mask(mask)
+    else:
+        if metadata['n_masks']:
+            arrays['masks'] = np.stack([pack_mask(mask) for mask in masks])
+        with open(temp_path,'wb') as f:
+            np.savez_compressed(f,metadata=np.array(metadata_string),**arrays)
+    os.replace(temp_path,path)
+    return path
+
+def read_session_archive(path,keys=default_keys):
+    '''
+    Reads the arrays named in keys (those in the archive) and the metadata (settings,
+    lines, crop region, image files) of one run. Other arrays are not read.
+    Returns a dict of the arrays, with the metadata under 'metadata'
+    '''
+    run = {}
+    if path.endswith('.h5'):
+        with h5py.File(path,'r') as f:
+            run['metadata'] = json.loads(f.attrs['metadata'])
+            for key in keys:
+                if key in f:
+                    run[key] = f[key][()]
+    else:
+        with np.load(path,allow_pickle=False) as f:
+            run['metadata'] = json.loads(str(f['metadata']))
+            for key in keys:
+                if key in f.files:
+                    run[key] = f[key]
+    return run
+
+def read_masks(path,frames=None):
+    '''
+    Masks (frames x rows x cols, bool) of the given frame indices of one run, or
+    all of them. From .h5 archives only the chunks of those frames are read.
+    '''
+    if path.endswith('.h5'):
+        with h5py.File(path,'r') as f:
+            shape = json.loads(f.attrs['metadata'])['mask_shape']
+            if 'masks' not in f:
+                return None
+            dataset = f['masks']
+            if frames is None:
+                packed = dataset[()]
+            else:
+                # h5py needs increasing indices
+                frames = np.atleast_1d(np.arange(dataset.shape[0])[frames])
+                order = np.argsort(frames)
+                packed = np.empty((len(frames),)+dataset.shape[1:],dtype=np.uint8)
+                packed[order] = dataset[frames[order].tolist()]
+    else:
+        with np.load(path,allow_pickle=False) as f:
+            shape = json.loads(str(f['metadata']))['mask_shape']
+            if 'masks' not in f.files:
+                return None
+            packed = f['masks']
+            if frames is not None:
+                packed = packed[np.atleast_1d(np.arange(packed.shape[0])[frames])]
+    return np.unpackbits(packed,axis=2)[:,:,:shape[1]].astype(bool)
+
+def load_archives(paths,keys=('times','distances')):
+    '''
+    Reads keys and the metadata from many archives, e.g. just the distances for a
+    campaign. Returns a list of dicts as read_session_archive, each with its 'path'.
+    Archives that can't be read are skipped with a message.
+    '''
+    runs = []
+    for path in paths:
+        try:
+            run = read_session_archive(path,keys=keys)
+        except Exception as e:
+            print('Could not read ' + path + ': ' + str(e))
+            continue
+        run['path'] = path
+        runs.append(run)
+    return runs
@@ -0,0 +1,79 @@
+# Cumulative run time and call counts for named stages of the image processing
+# Timing is off by default. When off, stage() returns a shared do-nothing context,
+# so the instrumented functions run at (nearly) full speed
+import time
+import threading
+from collections import OrderedDict
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+    def __exit__(self,*args):
+        return False
+
+_null_stage = _NullStage()
+
+class _Stage(object):
+    def __init__(self,timer,name):
+        self.timer = timer
+        self.name = name
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+    def __exit__(self,*args):
+        self.timer.record(self.name,time.perf_counter()-self.t_start)
+        return False
+
+class StageTimer(object):
+    ''' StageTimer
+    Usage:
+        timer = StageTimer(enabled=True)
+        with timer.stage('median despeckle'):
+            denoised = median(thresholded,disk(d))
+        print(timer.format_summary('Extract growth rates'))
+    Stages should not be nested, so that the stage times add up to the run time
+    '''
+    def __init__(self,enabled=False):
+        self.enabled = enabled
+        # Stages can be recorded from worker threads (e.g. the parameter sweep)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.totals = OrderedDict()
+        self.counts = OrderedDict()
+
+    def stage(self,name):
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self,name)
+
+    def record(self,name,seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name,0) + seconds
+            self.counts[name] = self.counts.get(name,0) + 1
+
+    def summary(self):
+        # List of dicts with the total time (s) and call count of each stage
+        return [{'stage':name,'total_s':total,'calls':self.counts[name],
+                 'per_call_ms':1e3*total/self.counts[name]}
+                for name,total in self.totals.items()]
+
+    def format_summary(self,title='',run_time=None):
+        '''
+        Table of the stage times, slowest first
+        If run_time (s) is given, the time not spent in any stage is shown as 'other'
+        '''
+        stages = sorted(self.summary(),key=lambda s: s['total_s'],reverse=True)
+        total = sum(s['total_s'] for s in stages)
+        if run_time is not None:
+            stages.append({'stage':'other','total_s':max(run_time-total,0),
+                           'calls':1,'per_call_ms':1e3*max(run_time-total,0)})
+            total = max(run_time,total)
+        lines = [title + ' ({:.2f} s)'.format(total),
+                 '{:<18s}{:>9s}{:>7s}{:>9s}{:>5s}'.format('stage','ms','calls','ms/call','%')]
+        for s in stages:
+            lines.append('{:<18s}{:9.1f}{:7d}{:9.2f}{:5.0f}'.format(
+                s['stage'],1e3*s['total_s'],s['calls'],s['per_call_ms'],
+                100*s['total_s']/total if total else 0))
+        return '\n'.join(lines)
@@ -0,0 +1,110 @@
+# Constant memory linear least squares for growth rate fits
+# Running sums are kept for each line so that points can be added or removed
+# in O(1) without refitting the full time and distance arrays
+from collections import deque
+import numpy as np
+
+class StreamingLinearFit(object):
+    ''' StreamingLinearFit
+    Online least squares fit of distance = slope*time + intercept for n_lines lines
+    forgetting_factor < 1 exponentially down-weights old points each time a new
+        point is added (1 = no forgetting)
+    window keeps only the most recent `window` points, removing the oldest when
+        a new point is added (None = keep all points)
+    Distances are passed as one value per line. NaN values are skipped, so a
+        point can be excluded from one line but kept for the others.
+    '''
+    def __init__(self,n_lines=1,forgetting_factor=1.0,window=None):
+        if not 0 < forgetting_factor <= 1:
+            raise ValueError('forgetting_factor must be in (0,1]')
+        if window is not None and window < 2:
+            raise ValueError('window must hold at least 2 points')
+        if window is not None and forgetting_factor < 1:
+            raise ValueError('Use either a window or exponential forgetting, not both')
+        self.n_lines = n_lines
+        self.forgetting_factor = forgetting_factor
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.t_ref = None
+        self.n_points = 0
+        # Running (weighted) sums per line
+        self.sum_w = np.zeros(self.n_lines)
+        self.sum_t = np.zeros(self.n_lines)
+        self.sum_tt = np.zeros(self.n_lines)
+        self.sum_d = np.zeros(self.n_lines)
+        self.sum_td = np.zeros(self.n_lines)
+        self.sum_dd = np.zeros(self.n_lines)
+        # Points inside the window, only stored when a window is used
+        self.window_points = deque()
+
+    def _update(self,t,d,weight):
+        d = np.broadcast_to(np.asarray(d,dtype=float),(self.n_lines,))
+        w = np.where(np.isnan(d),0,weight)
+        d = np.nan_to_num(d)
+        # Times are shifted by the first time to reduce round-off in the sums
+        t = t - self.t_ref
+        self.sum_w += w
+        self.sum_t += w*t
+        self.sum_tt += w*t*t
+        self.sum_d += w*d
+        self.sum_td += w*t*d
+        self.sum_dd += w*d*d
+
+    def add(self,t,d,weight=1.0):
+        '''
+        Add a point at time t with distance d (scalar or one value per line)
+        '''
+        if self.t_ref is None:
+            self.t_ref = t
+        if self.forgetting_factor < 1:
+            for s in (self.sum_w,self.sum_t,self.sum_tt,
+                      self.sum_d,self.sum_td,self.sum_dd):
+                s *= self.forgetting_factor
+        self._update(t,d,weight)
+        self.n_points += 1
+        if self.window is not None:
+            self.window_points.append((t,d,weight))
+            if len(self.window_points) > self.window:
+                self.remove(*self.window_points.popleft())
+
+    def remove(self,t,d,weight=1.0):
+        '''
+        Remove a point previously added with add(t,d,weight)
+        '''
+        if self.forgetting_factor < 1:
+            raise ValueError('Points cannot be removed when using exponential forgetting')
+        self._update(t,d,-weight)
+        self.n_points -= 1
+
+    def get_params(self):
+        '''
+        Returns slope, intercept and standard error of the slope for each line
+        Lines with fewer than 2 points return NaN (stderr needs 3 points)
+        '''
+        with np.errstate(divide='ignore',invalid='ignore'):
+            s_tt = self.sum_tt - self.sum_t**2/self.sum_w
+            s_td = self.sum_td - self.sum_t*self.sum_d/self.sum_w
+            s_dd = self.sum_dd - self.sum_d**2/self.sum_w
+            slope = s_td/s_tt
+            intercept = (self.sum_d - slope*self.sum_t)/self.sum_w
+            if self.t_ref is not None:
+                intercept = intercept - slope*self.t_ref
+            # Residual sum of squares can go slightly negative after removals
+            ssr = np.clip(s_dd - slope*s_td,0,None)
+            stderr = np.sqrt(ssr/(self.sum_w-2)/s_tt)
+        stderr = np.where(self.sum_w > 2,stderr,np.nan)
+        return slope,intercept,stderr
+
+    @property
+    def slope(self):
+        return self.get_params()[0]
+
+    @property
+    def intercept(self):
+        return self.get_params()[1]
+
+    @property
+    def stderr(self):
+        return self.get_params()[2]